@@ -0,0 +1,157 @@
+'''
+Semantic answer cache for /chatbot.
+
+Answers depend only on the question and the static research corpus, so when a new
+question's embedding is within ANSWER_CACHE_THRESHOLD (cosine) of a previously answered
+question the cached HTML is returned without retrieval or a completion call.
+
+Entries are tied to a corpus version stamp written by every ingest.sync (`python ingest.py`
+or app.initialize_vector_store); when the vector store is re-indexed the stamp changes and
+the cache empties itself. Each
+worker keeps its own cache (the embeddings it needs are already shared through
+the embedding cache).
+'''
+import hashlib
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from embedding_cache import CACHE_DIR
+from query_analyzer import analyze_question
+
+CORPUS_VERSION_PATH = os.environ.get('CORPUS_VERSION_PATH', os.path.join(CACHE_DIR, 'corpus_version'))
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', 512))
+ANSWER_CACHE_TTL = float(os.environ.get('ANSWER_CACHE_TTL', 24 * 3600))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.97))
+SIMILARITY_BUCKETS = [0.5, 0.8, 0.9, 0.95, 0.97, 0.99, 1.0]
+
+
+def write_corpus_version(docs, path=CORPUS_VERSION_PATH):
+    '''stamp the corpus that was just indexed; called by the ingest pipeline'''
+    version = hashlib.sha256("\n".join(docs).encode('utf-8')).hexdigest()[:16]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        f.write(version)
+    os.replace(path + '.tmp', path)
+    return version
+
+def key_terms(question):
+    '''numbers, named states, periods and topics must match exactly; "Alabama 2022 rate" and "Alaska 2023 rate", or
+    "Alabama 2023 compliance rate" and "Alabama 2023 deferred rate", embed almost identically'''
+    analysis = analyze_question(question)
+    return frozenset(re.findall(r'\d+', question)) | frozenset(analysis['states'] + analysis['periods'] + analysis['topics'])
+
+
+class AnswerCache:
+    '''fixed-capacity matrix of normalized question embeddings with LRU eviction'''
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, version_path=CORPUS_VERSION_PATH):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.version_path = version_path
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_mtime = None
+        self._clear()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.invalidations = 0
+        self.similarity_counts = [0] * len(SIMILARITY_BUCKETS)
+
+    def _clear(self):
+        self._matrix = None           # (max_entries, dim) float32, rows normalized
+        self._answers = [None] * self.max_entries
+        self._terms = [None] * self.max_entries
+        self._stored_at = np.zeros(self.max_entries)
+        self._last_used = np.zeros(self.max_entries)
+        self._size = 0
+
+    def _check_version(self):
+        '''empty the cache when ingest has stamped a new corpus version'''
+        try:
+            mtime = os.stat(self.version_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._version_mtime:
+            return
+        version = None
+        if mtime is not None:
+            with open(self.version_path) as f:
+                version = f.read().strip()
+        if version != self._version:
+            if self._size:
+                self.invalidations += 1
+            self._clear()
+            self._version = version
+        self._version_mtime = mtime
+
+    def _observe(self, similarity):
+        for i, bound in enumerate(SIMILARITY_BUCKETS):
+            if similarity <= bound:
+                self.similarity_counts[i] += 1
+                return
+
+    def get(self, question, embedding):
+        '''return (answer, similarity) for the closest cached question above the threshold, or (None, best similarity)'''
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            best = -1.0
+            if self._size:
+                scores = self._matrix[:self._size] @ query
+                expired = now - self._stored_at[:self._size] > self.ttl
+                scores[expired] = -1.0
+                position = int(np.argmax(scores))
+                best = float(scores[position])
+            self._observe(best)
+            if best >= self.threshold and self._terms[position] == key_terms(question):
+                self._last_used[position] = now
+                self.hits += 1
+                return self._answers[position], best
+            self.misses += 1
+            return None, best
+
+    def put(self, question, embedding, answer):
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            if self._size < self.max_entries:
+                position = self._size
+                self._size += 1
+            else:
+                position = int(np.argmin(self._last_used))  # evict the least recently used entry
+            self._matrix[position] = vector
+            self._answers[position] = answer
+            self._terms[position] = key_terms(question)
+            self._stored_at[position] = now
+            self._last_used[position] = now
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypasses += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'pid': os.getpid(),
+            'entries': self._size,
+            'corpus_version': self._version,
+            'threshold': self.threshold,
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypasses': self.bypasses,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'similarity_histogram': {f"le_{bound}": count for bound, count in zip(SIMILARITY_BUCKETS, self.similarity_counts)},
+        }
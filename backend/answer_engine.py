@@ -0,0 +1,155 @@
+'''
+Deterministic fast path for simple lookups.
+
+Many questions are single-fact lookups ("What is the Alabama 2023 tax rate?"). When
+the query analyzer resolves a question to one topic, named states and an unambiguous
+period, the answer is rendered from a template over the structured values the
+research import functions returned (stored on each fact by app.make_doc). No
+embedding, vector query or completion is needed. Anything ambiguous returns None
+and the caller falls back to the RAG path.
+'''
+import html
+import re
+
+from query_analyzer import ANY_YEAR, FUTURE_YEAR, PERIOD_LABELS, PERIOD_TOPICS, PSEUDO_STATES, period_applies
+
+# questions asking for analysis rather than a value are left to the LLM
+OPEN_ENDED = re.compile(r'\b(compar\w*|chang\w*|summar\w*|differ\w*|why|explain\w*|trend\w*|histor\w*|should|impact\w*|effect\w*|recommend\w*|what if)\b', re.I)
+EXCLUSION_CATEGORIES = {
+    'Subpart F': re.compile(r'subpart f', re.I),
+    'Section 78 Gross-Up': re.compile(r'section 78|\b78\b|gross[- ]?up', re.I),
+    'Foreign Dividends': re.compile(r'foreign dividend', re.I),
+    'FDII': re.compile(r'\bfdii\b', re.I),
+}
+
+
+def format_percent(value):
+    '''0.065 -> "6.5%"; text values ("N/A") are shown as they are'''
+    try:
+        return f"{round(float(value) * 100, 4):g}%"
+    except (TypeError, ValueError):
+        return str(value)
+
+def format_number(value):
+    '''500000.0 -> "500,000"'''
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return f"{value:,.0f}" if value.is_integer() else f"{value:,}"
+
+def period_text(year, doc=None):
+    '''"2023", or "2023 current provision" / "deferred (future)" for facts that have a period (tax rates, methodologies)'''
+    year = '' if year in (None, ANY_YEAR, FUTURE_YEAR) else year
+    return sentence(year, PERIOD_LABELS.get((doc or {}).get('period')))
+
+def sentence(*parts):
+    return ' '.join(str(part) for part in parts if part)
+
+
+######################################################################################################
+#                              Templates, one per topic
+######################################################################################################
+
+def render_tax_rate(doc, year):
+    return sentence("The", doc['state'], period_text(year, doc), "tax rate is", format_percent(doc['value'])) + "."
+
+def render_cfp(doc, year):
+    value = doc['value']
+    if isinstance(value, str) and value.lower() == 'unlimited':
+        return sentence("The", doc['state'], period_text(year), "NOL carryforward period is unlimited.")
+    return sentence("The", doc['state'], period_text(year), "NOL carryforward period is", format_number(value), "years.")
+
+def render_limitation(doc, year):
+    if doc['value'] == 1:
+        return sentence(doc['state'], "can utilize an unlimited amount of NOLs", f"in {year}" if period_text(year) else "") + "."
+    return sentence("The", doc['state'], period_text(year), "NOL utilization limitation is", format_percent(doc['value']), "of state taxable income.")
+
+def render_methodology(doc, year):
+    return sentence("The", doc['state'], period_text(year, doc), "apportionment methodology is", doc['value']) + "."
+
+def render_pre_post(doc, year):
+    return sentence(doc['state'], "utilizes net operating losses on a", f"{doc['value']}-apportioned", "basis.")
+
+def render_nexus(doc, year):
+    thresholds = []
+    if doc.get('dollar_threshold'):
+        thresholds.append(f"${format_number(doc['dollar_threshold'])} in sales")
+    if doc.get('transaction_threshold'):
+        thresholds.append(f"{format_number(doc['transaction_threshold'])} transactions")
+    if not thresholds:
+        return None  # nothing on file; let the LLM explain
+    return sentence(doc['state'] + "'s", "economic nexus threshold is", f" {doc.get('and_or') or 'or'} ".join(thresholds)) + "."
+
+def render_exclusion(doc, year):
+    return sentence("The", doc['state'], period_text(year), "exclusion rate for", doc['category'], "is", format_percent(doc['value']),
+                    "of", doc['category'], "income.")
+
+TEMPLATES = {
+    'tax_rate': render_tax_rate,
+    'cfp': render_cfp,
+    'limitation': render_limitation,
+    'methodology': render_methodology,
+    'pre_post': render_pre_post,
+    'nexus': render_nexus,
+    'exclusion': render_exclusion,
+}
+
+
+######################################################################################################
+#                              Engine
+######################################################################################################
+
+def select_facts(question, analysis, fact_index):
+    '''(state, year, doc) rows answering the question, or None if any part of it is ambiguous'''
+    topic = analysis['topics'][0]
+    years = analysis['years']
+    # each period of a tax rate or methodology stands for one year (compliance 2022, current 2023, deferred future),
+    # so a named year or a named period picks the fact
+    named_periods = analysis['periods'] if period_applies(analysis) else []
+    categories = [category for category, pattern in EXCLUSION_CATEGORIES.items() if pattern.search(question)]
+    rows = []
+    for state in analysis['states']:
+        by_year = fact_index.facts(state, topic)
+        if not by_year:
+            return None
+        if ANY_YEAR in by_year:
+            chosen = [(None, by_year[ANY_YEAR])]
+        elif years:
+            if any(year not in by_year for year in years):
+                return None
+            chosen = [(year, by_year[year]) for year in years]
+        elif named_periods and topic in PERIOD_TOPICS:
+            chosen = [(year, docs) for year, docs in by_year.items()
+                      if any(doc.get('period') in named_periods for doc in docs)]
+        elif len(by_year) == 1:
+            chosen = list(by_year.items())
+        else:
+            return None  # several periods on file and the question does not say which
+        for year, docs in chosen:
+            if named_periods:
+                docs = [doc for doc in docs if doc.get('period') in named_periods]
+            if topic == 'exclusion' and categories:
+                docs = [doc for doc in docs if doc.get('category') in categories]
+            if not docs or any('value' not in doc and topic != 'nexus' for doc in docs):
+                return None
+            rows.extend((state, year, doc) for doc in docs)
+    return rows
+
+def structured_answer(question, analysis, fact_index):
+    '''HTML answer for a confidently parsed lookup, or None to fall back to retrieval + completion'''
+    if len(analysis['topics']) != 1 or not analysis['states'] or OPEN_ENDED.search(question):
+        return None
+    if PSEUDO_STATES.intersection(analysis['states']):
+        return None  # "The Foreign 2023 exclusion rate" reads as a state; the LLM explains these rows
+    rows = select_facts(question, analysis, fact_index)
+    if not rows:
+        return None
+    render = TEMPLATES[analysis['topics'][0]]
+    lines = [render(doc, year) for state, year, doc in sorted(rows, key=lambda row: row[0])]
+    if None in lines:
+        return None
+    lines = [html.escape(line, quote=False) for line in lines]
+    if len(lines) == 1:
+        return f"<p>{lines[0]}</p>"
+    return "<ul>" + "".join(f"<li>{line}</li>" for line in lines) + "</ul>"
@@ -1,45 +1,142 @@
+import hashlib
+import html
+import json
 import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
 from dotenv import load_dotenv
 load_dotenv()
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-from openai import OpenAI
-from pinecone import Pinecone, ServerlessSpec
 import numpy as np
+import pandas as pd
+import clients
+import metrics
 import research
+import upstream
+import ingest
+import vector_store
+from embedding_cache import EmbeddingCache, normalize_question
+from answer_cache import AnswerCache
+from upstream import UpstreamError
+from streaming import CodeFenceFilter, sse_event, strip_code_fences
+from query_analyzer import ANY_YEAR, FUTURE_YEAR, PERIOD_LABELS, FactIndex, analyze_question, canonical_state, is_comparative, metadata_filter
+from answer_engine import structured_answer
+from context_builder import COMPLETION_MODEL, build_context, count_tokens, encoding_cached
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
 
 app = Flask(__name__)
 CORS(app)
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+# The OpenAI and Pinecone clients are built on first use (clients.py), so importing the app makes no network calls.
+# The Pinecone index is created by `python ingest.py --provision`.
 
-# Initialize Pinecone
-pc = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
-index_name = "updated-tax-research"
+# Retrieval backend: "pinecone" (hosted index) or "local" (in-process NumPy index built by `python ingest.py --backend local`)
+VECTOR_BACKEND = os.environ.get('VECTOR_BACKEND', 'pinecone')
 
-# Create Pinecone index (vector datastore), this only needs to run once
-if index_name not in pc.list_indexes().names():
-     pc.create_index(
-         name=index_name,
-         dimension=3072,  # text-embedding-3-large dimension
-         metric='cosine',
-         spec=ServerlessSpec(cloud='aws', region='us-east-1')
-     )
+EMBEDDING_MODEL = ingest.EMBEDDING_MODEL
 
-# Connect to Pinecone index
-try:
-    index = pc.Index(index_name)
-except:
-    index = None  #error handler would go here
+# Query embeddings are cached in-process and in a SQLite file shared by all gunicorn workers
+embedding_cache = EmbeddingCache()
+
+# Facts indexed by state -> topic -> year, loaded from the ingest manifest, for exact lookups
+fact_index = FactIndex(ingest.manifest_path(VECTOR_BACKEND))
+TOP_K = 50           # documents retrieved for open-ended questions
+FILTERED_TOP_K = 20  # documents retrieved when the question names states but no exact lookup matched
+
+# Retrieval mode: "hybrid" (BM25 + vectors, fused by reciprocal rank), "vector" or "lexical" (BM25 only, no embedding call)
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'hybrid')
+lexical_index = LexicalIndex(ingest.manifest_path(VECTOR_BACKEND))
+
+# How each answer was served: "structured" (template, no upstream calls), "cache", "rag" or "fallback" (facts only, completion unavailable)
+answer_paths = Counter()
+
+# Answers to near-duplicate questions are served from a semantic cache, invalidated when the corpus is re-indexed
+answer_cache = AnswerCache()
+
+# The tax rate and methodology sheets have one column per provision year. Facts come from this year's column, whose
+# compliance row is this tax year, current row the next tax year and deferred row the future rate
+PROVISION_YEAR = os.environ.get('PROVISION_YEAR', '2022')
+
+# Requests to these endpoints are traced (metrics.py): one JSON log line each, aggregated at /metrics
+TRACED_ENDPOINTS = {'chatbot', 'chatbot_stream', 'chatbot_batch'}
+
+# /chatbot/batch: questions per request, and retrievals/completions run at the same time for one batch
+BATCH_MAX_QUESTIONS = int(os.environ.get('BATCH_MAX_QUESTIONS', 100))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 8))
+
+# /readyz probes the vector index and OpenAI with a short timeout; the result is shared for a few seconds
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', 2))
+READINESS_CACHE_SECONDS = float(os.environ.get('READINESS_CACHE_SECONDS', 5))
+_readiness = {'checked_at': None, 'checks': None}
+_readiness_lock = threading.Lock()
+
+UNAVAILABLE_MESSAGE = "<p>Sorry, the tax research assistant is temporarily unavailable. Please try again in a minute.</p>"
 
 
 ######################################################################################################
 #                              Helper Functions
 ######################################################################################################
 
-#add here as needed
+def make_doc(text, source, row, state, topic, year=ANY_YEAR, **fields):
+    """A research fact with a content-addressed id (the same sentence from the same sheet row always gets the same id),
+    the structured fields used for metadata-filtered retrieval: state, topic (see query_analyzer.TOPICS) and year,
+    and the raw sheet values (value, category, nexus thresholds) used by the answer_engine templates"""
+    doc_id = hashlib.sha1(f"{source}\0{row}\0{text}".encode('utf-8')).hexdigest()
+    return {"id": doc_id, "text": text, "source": source, "row": row, "state": canonical_state(state), "topic": topic, "year": year, **fields}
+
+def period_label(year):
+    """Sheet year cells may be numbers (2019.0) or text ('2019'); store them as '2019'"""
+    if isinstance(year, float) and year.is_integer():
+        year = int(year)
+    return str(year)
+
+def percent_text(values):
+    """Sheet rates as text, 0.065 -> '6.5%', 0.059 -> '5.9%' (not 5.8999999999999995%); cells that are not numbers
+    ('N/A') are kept as they are"""
+    numbers = pd.to_numeric(values, errors='coerce')
+    return (numbers * 100).round(4).map('{:g}%'.format).where(numbers.notna(), values.astype(str))
+
+def provision_rows(table):
+    """Rows of the PROVISION_YEAR column of the tax rate or methodology sheet, with the year each period stands for:
+    compliance is the provision year, current the year after and deferred no particular year"""
+    table = table[table['year'] == PROVISION_YEAR].reset_index(drop=True)
+    next_year = str(int(PROVISION_YEAR) + 1)
+    table['year'] = table['period'].map({'compliance': PROVISION_YEAR, 'current': next_year, 'deferred': FUTURE_YEAR})
+    return table[table['year'].notna()].reset_index(drop=True)
+
+def period_prefix(table):
+    """'2023 current provision' or 'deferred (future)', for the text of a provision fact"""
+    return (table['year'] + " ").where(table['year'] != FUTURE_YEAR, "") + table['period'].map(PERIOD_LABELS)
+
+def make_docs(texts, source, rows, states, topic, years, **fields):
+    """make_doc over columns of a research table (Series of equal length; a field may also be a single value)"""
+    columns = [column.tolist() if isinstance(column, pd.Series) else [column] * len(texts) for column in (texts, rows, states, years, *fields.values())]
+    return [make_doc(text, source, row, state, topic, year, **dict(zip(fields, values))) for text, row, state, year, *values in zip(*columns)]
+
+def get_vector_index():
+    """Return the index selected by VECTOR_BACKEND; both expose the same query() interface"""
+    if VECTOR_BACKEND == 'local':
+        return vector_store.get_local_index()
+    return clients.get_index()
+
+def warm_up():
+    """Load everything that comes from local files (manifest indexes, local vector index, tokenizer) without any
+    network call; run in the gunicorn master under --preload so forked workers start warm. The tokenizer is only
+    loaded when the image pre-fetched it; otherwise each worker downloads it on first use"""
+    len(fact_index)
+    len(lexical_index)
+    if encoding_cached():
+        count_tokens("")
+    if VECTOR_BACKEND == 'local':
+        try:
+            vector_store.get_local_index()
+        except OSError:
+            print("Local vector index not built yet; run `python ingest.py --backend local`")
 
 ######################################################################################################
 #                              Gather all research data 
@@ -47,50 +144,29 @@ except:
 ''' this data must be well structured and organized in order for the chatbot to work properly '''
 def get_cfp_research_data():
     '''retrieve research data related to NOL carryforward periods previously saved to Smartsheets repository'''
-    docs = []
     print("Reformatting CFP data...")
-    for state, data in research.import_cfp_from_ss().items():
-        for year, cfp in data.items():
-            if type(cfp) is not float and cfp.lower() == "unlimited":
-                docs.append(f"{state}'s {year} NOL carryforward period is {cfp}. {state}'s NOL utilization limitation is 80% of state taxable income.")
-            else:
-                docs.append(f"{state}'s {year} NOL carryforward period is {cfp}")
-    return docs
+    cfp = research.import_cfp_from_ss()
+    years = cfp['year'].map(period_label)
+    text = cfp['state'] + "'s " + years + " NOL carryforward period is " + cfp['value'].astype(str)
+    unlimited = cfp['value'].astype(str).str.lower() == "unlimited"
+    text = text.where(~unlimited, text + ". " + cfp['state'] + "'s NOL utilization limitation is 80% of state taxable income.")
+    return make_docs(text, 'cfp_sheet', cfp['state'] + "/" + years, cfp['state'], 'cfp', years, value=cfp['value'])
 
 def get_tax_rate_data():
     '''retrieve research data related to tax rates previously saved to Smartsheets repository'''
-    docs = []
     print("Reformatting tax rate data...")
-    compliance, current, deferred = research.import_tax_rates_from_ss('2022')
-    for state, rate in compliance.items():
-        if type(rate) == float:
-            docs.append(f"{state}'s 2022 or compliance tax rate is {rate * 100}%")
-        else:
-            docs.append(f"{state}'s 2022 or compliance tax rate is {rate}")
-    for state, rate in current.items():
-        if type(rate) == float:
-            docs.append(f"{state}'s 2023 or current tax rate is {rate * 100}%")
-        else:
-            docs.append(f"{state}'s 2023 or current tax rate is {rate}")
-    for state, rate in deferred.items():
-        if type(rate) == float:
-            docs.append(f"{state}'s deferred or future tax rate is {rate * 100}%")
-        else:
-            docs.append(f"{state}'s deferred or future tax rate is {rate}")
-    return docs
+    rates = provision_rows(research.import_tax_rates_from_ss())
+    text = rates['state'] + "'s " + period_prefix(rates) + " tax rate is " + percent_text(rates['value'])
+    return make_docs(text, 'tax_rates_sheet', rates['state'] + "/" + rates['year'] + "/" + rates['period'], rates['state'], 'tax_rate', rates['year'],
+                     period=rates['period'], value=rates['value'])
 
 def get_methodology_data():
     '''retrieve research data related to apportionment methodologies previously saved to Smartsheets repository'''
-    docs = []
-    methodologies = research.import_smartsheets_methodologies('2022')
-    logic = {
-        'compliance': '2022',
-        'current': '2023',
-        'deferred': 'deferred'
-    }
-    for state in methodologies:
-        docs.append(f"{state['state']}'s {logic[state['year']]} apportionment methodology is {state['method']}")
-    return docs
+    print("Reformatting apportionment methodology data...")
+    methods = provision_rows(research.import_smartsheets_methodologies())
+    text = methods['state'] + "'s " + period_prefix(methods) + " apportionment methodology is " + methods['value'].astype(str)
+    return make_docs(text, 'methods_sheet', methods['state'] + "/" + methods['year'] + "/" + methods['period'], methods['state'], 'methodology', methods['year'],
+                     period=methods['period'], value=methods['value'])
 
 def get_pre_post_nol_data():
     '''retrieve research data related to pre/post NOL periods previously saved to Smartsheets repository'''
@@ -98,7 +174,7 @@ def get_pre_post_nol_data():
     print("Reformatting pre/post NOL data...")
     pre_post = research.import_pre_post_nol_from_ss()
     for state, decision in pre_post.items():
-        docs.append(f"{state}'s net operating losses are utilized on a {decision} apportioned basis")
+        docs.append(make_doc(f"{state}'s net operating losses are utilized on a {decision} apportioned basis", 'pre_post_sheet', state, state, 'pre_post', value=decision))
     return docs
 
 def get_nexus_thresholds_data():
@@ -107,58 +183,44 @@ def get_nexus_thresholds_data():
     print("Reformatting nexus thresholds data...")
     thresholds = research.import_nexus_thresholds_from_ss()
     for state, data in thresholds.items():
-        docs.append(f"{state}'s economic nexus threshold is {data['dollar_threshold']} dollars, {data['transaction_threshold']} transactions. And/Or determination is: {data['and_or']}")
+        docs.append(make_doc(f"{state}'s economic nexus threshold is {data['dollar_threshold']} dollars, {data['transaction_threshold']} transactions. And/Or determination is: {data['and_or']}", 'nexus_sheet', state, state, 'nexus', **data))
     return docs
 
 def get_exclusion_rates_data():
     '''retrieve research data related to exclusion rates previously saved to Smartsheets repository'''
-    docs = []
     print("Reformatting exclusion rates data...")
-    exclusions = research.import_exclusion_rates_from_ss('2022')
-    for state, data in exclusions.items():
-        for category, rate in data.items():
-            docs.append(f"{state}'s exclusion rate for {category} is {float(rate) * 100}%) of {category} income")
-    return docs
+    exclusions = research.import_exclusion_rates_from_ss()
+    states = exclusions['state'].map(canonical_state)
+    text = (states + "'s " + exclusions['year'] + " exclusion rate for " + exclusions['category'] + " is " + percent_text(exclusions['value'])
+            + " of " + exclusions['category'] + " income")
+    return make_docs(text, 'exclusions_sheet', states + "/" + exclusions['year'] + "/" + exclusions['category'], states, 'exclusion', exclusions['year'],
+                     category=exclusions['category'], value=exclusions['value'])
 
 def get_limitations_data():
     '''retrieve research data related to NOL utilization limitations previously saved to Smartsheets repository'''
-    docs = []
     print("Reformatting NOL utilization limitations data...")
     limitations = research.import_limitations_from_ss()
-    for state, data in limitations.items(): 
-        for year, limitation in data.items():
-            if limitation == 1:
-                docs.append(f"{state}'s net operating loss (NOL) utilization limitation for {year}. {state} can utilize an unlimited amount of NOLs")
-            else:
-                docs.append(f"{state}'s net operating loss (NOL) utilization limitation for {year} is {float(limitation) * 100}% of state taxable income")
-    return docs
+    years = limitations['year'].map(period_label)
+    unlimited = limitations['value'] == 1
+    text = (limitations['state'] + "'s net operating loss (NOL) utilization limitation for " + years
+            + (" is " + percent_text(limitations['value']) + " of state taxable income").where(~unlimited, ". " + limitations['state'] + " can utilize an unlimited amount of NOLs"))
+    return make_docs(text, 'limitations_sheet', limitations['state'] + "/" + years, limitations['state'], 'limitation', years, value=limitations['value'])
 
 def get_research():
-    '''gather all research data into a single list of documents to be embedded and vectorized with Pinecone'''
-    research = get_cfp_research_data() + get_tax_rate_data() + get_methodology_data() + get_pre_post_nol_data() + get_nexus_thresholds_data() + get_exclusion_rates_data() + get_limitations_data()
-    return research
+    '''gather all research data into a single list of documents (see make_doc) to be embedded and vectorized'''
+    research.load_sheets()  # fetch all sheets concurrently; unchanged sheets come from local snapshots
+    research_docs = get_cfp_research_data() + get_tax_rate_data() + get_methodology_data() + get_pre_post_nol_data() + get_nexus_thresholds_data() + get_exclusion_rates_data() + get_limitations_data()
+    return research_docs
 
 def initialize_vector_store():
-    """Create embeddings and store them in Pinecone or in-memory"""
+    """Sync embeddings in Pinecone with the current research: only new or changed facts are embedded"""
     tax_research = get_research()
     print("Initializing vector store...")
-    
-    # Create embeddings for all research data
-    for idx, doc in enumerate(tax_research):
-        response = openai_client.embeddings.create(
-            input=doc,
-            model="text-embedding-3-large"
-        )
-        embedding = response.data[0].embedding
-        
-        # Store in Pinecone if available
-        if index:
-            index.upsert(vectors=[(f"doc_{idx}", embedding, {"text": doc})])
+    ingest.sync(tax_research, clients.get_openai_client(), clients.get_index(), ingest.manifest_path('pinecone'))
     return tax_research
 
-# Initialize Pinecone on startup - only needs to be run once. Must have pinecone API key set in environment variables.
-#Comment out or remove after first run to avoid duplicate entries. This would time out in production environment.
-#initialize_vector_store()
+# Populating the vector store is a one-off job, run it from the command line instead of at import time:
+#   python ingest.py
 
 def cosine_similarity(vec1, vec2):
     """Calculate cosine similarity between two vectors"""
@@ -166,24 +228,119 @@ def cosine_similarity(vec1, vec2):
     vec2 = np.array(vec2)
     return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
 
-def search_similar_docs(query, top_k):
-    """Search for similar documents using embeddings"""
-    # Create embedding for query
-    response = openai_client.embeddings.create(
-        input=query,
-        model="text-embedding-3-large"
-    )
-    query_embedding = response.data[0].embedding
-    # search Pinecone index
+def embed_query(query):
+    """Embed a user question, reusing cached embeddings of previously asked questions.
+    Concurrent misses for the same question share one API call; raises upstream.UpstreamError"""
+    missed = []
+    def create_embedding(text):
+        missed.append(text)
+        response = upstream.call(
+            'embeddings',
+            metrics.with_usage(EMBEDDING_MODEL, upstream.openai_client(upstream.EMBEDDING_TIMEOUT).embeddings.create),
+            input=text,
+            model=EMBEDDING_MODEL,
+            key=EmbeddingCache.key(text, EMBEDDING_MODEL)
+        )
+        return response.data[0].embedding
+    with metrics.stage('embedding'):
+        embedding = embedding_cache.get_or_create(query, EMBEDDING_MODEL, create_embedding)
+    metrics.record_cache('embedding', 'miss' if missed else 'hit')
+    return embedding
+
+def try_embed_query(query):
+    """Embed the question, or return None (retrieval then uses the lexical index only) in lexical mode or when the embeddings API fails"""
+    if RETRIEVAL_MODE == 'lexical':
+        return None
+    try:
+        return embed_query(query)
+    except Exception as e:
+        print(f"Embedding failed, falling back to lexical retrieval: {str(e)}")
+        return None
+
+def try_embed_queries(queries):
+    """Embed several questions with one embeddings API call for those not cached yet; like try_embed_query,
+    every embedding is None in lexical mode or when the embeddings API fails"""
+    if RETRIEVAL_MODE == 'lexical' or not queries:
+        return [None] * len(queries)
+    def create_embeddings(texts):
+        response = upstream.call(
+            'embeddings',
+            metrics.with_usage(EMBEDDING_MODEL, upstream.openai_client(upstream.EMBEDDING_TIMEOUT).embeddings.create),
+            input=texts,
+            model=EMBEDDING_MODEL
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
     try:
-        results = index.query(
-            vector=query_embedding,
+        with metrics.stage('embedding'):
+            return embedding_cache.get_or_create_many(queries, EMBEDDING_MODEL, create_embeddings)
+    except Exception as e:
+        print(f"Batch embedding failed, falling back to lexical retrieval: {str(e)}")
+        return [None] * len(queries)
+
+def search_similar_docs(query, top_k, query_embedding=None, metadata_filter=None):
+    """Search for similar documents using embeddings, optionally restricted by a metadata filter.
+    Returns the stored facts ({"id", "text", "state", "topic", ...}) with their similarity "score";
+    raises upstream.UpstreamError when the index cannot be queried"""
+    # Create (or reuse a cached) embedding for query
+    if query_embedding is None:
+        query_embedding = embed_query(query)
+    # search the configured vector index; the same question with the same filter is queried once at a time
+    def query_index():
+        return get_vector_index().query(
+            vector=query_embedding.tolist(),
             top_k=top_k,
-            include_metadata=True
+            include_metadata=True,
+            filter=metadata_filter,
+            timeout=upstream.VECTOR_QUERY_TIMEOUT
         )
-        return [match['metadata']['text'] for match in results['matches']]
-    except:
-        pass
+    with metrics.stage('vector_query'):
+        results = upstream.call('vector', query_index, key=(query, top_k, repr(metadata_filter)))
+    return [dict(match['metadata'], id=match['id'], score=match['score']) for match in results['matches']]
+
+def search_docs(query, top_k, query_embedding=None, metadata_filter=None, mode=RETRIEVAL_MODE):
+    """Search in the given mode: BM25 only ("lexical"), embeddings only ("vector") or both fused by reciprocal rank ("hybrid")"""
+    if mode != 'lexical':
+        try:
+            vector_docs = search_similar_docs(query, top_k, query_embedding, metadata_filter)
+        except UpstreamError as e:
+            print(f"Vector search failed, falling back to lexical retrieval: {str(e)}")
+            mode = 'lexical'
+    if mode == 'vector':
+        return vector_docs
+    with metrics.stage('lexical_query'):
+        lexical_docs = lexical_index.search(query, top_k, metadata_filter)
+    if mode == 'lexical':
+        return lexical_docs
+    # facts found only by BM25 carry no similarity score, so the context builder keeps them
+    return reciprocal_rank_fusion(vector_docs, lexical_docs, top_k=top_k)
+
+def retrieve_docs(query, query_embedding):
+    """Exact fact lookup when the question names states and topics, otherwise a metadata-filtered search.
+    Without a query embedding only the lexical index is searched"""
+    analysis = analyze_question(query)
+    facts = fact_index.lookup(analysis) or []
+    if facts and not is_comparative(query):
+        metrics.annotate(retrieval='exact lookup')
+        return facts
+    if is_comparative(query):
+        # the named states' facts come first, followed by a search across every state to compare them with
+        analysis = dict(analysis, states=[])
+    mode = RETRIEVAL_MODE if query_embedding is not None else 'lexical'
+    query_filter = metadata_filter(analysis)
+    if query_filter:
+        top_k = FILTERED_TOP_K if analysis['states'] else TOP_K
+        docs = search_docs(query, top_k, query_embedding, query_filter, mode)
+        if docs:
+            metrics.annotate(retrieval=f"filtered {mode} search", metadata_filter=query_filter)
+            return with_facts(facts, docs)
+    docs = search_docs(query, TOP_K, query_embedding, mode=mode)
+    metrics.annotate(retrieval=f"{mode} search")
+    return with_facts(facts, docs)
+
+def with_facts(facts, docs):
+    '''exact facts followed by the search results that repeat none of them'''
+    texts = {fact['text'] for fact in facts}
+    return facts + [doc for doc in docs if doc['text'] not in texts]
 
 
 
@@ -251,6 +408,27 @@ Respond in HTML format. Return a short, professional response. Review all contex
 Helpful Answer:
 """
 
+@app.before_request
+def start_request_trace():
+    if request.endpoint in TRACED_ENDPOINTS:
+        metrics.start_trace(request.endpoint)
+
+
+@app.after_request
+def finish_request_trace(response):
+    '''log and aggregate the request's trace; a streamed response is finished when the stream closes'''
+    trace = metrics.current_trace()
+    if trace is None or request.endpoint not in TRACED_ENDPOINTS:
+        return response
+    def finish():
+        metrics.finish_trace(trace, response.status_code, path=trace.fields.get('path') or response.headers.get('X-Answer-Path'))
+    if response.is_streamed:
+        response.call_on_close(finish)
+    else:
+        finish()
+    return response
+
+
 @app.route("/hello", methods=["GET"])
 def hello():
     '''initial message to user when the chatbot initially loads.'''
@@ -258,50 +436,350 @@ def hello():
                    """)
 
 
-@app.route("/chatbot", methods=["POST"])
-def chatbot():
-    """Main chatbot interface"""
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    '''liveness: the worker is up and serving requests; no upstream is contacted'''
+    return jsonify({'status': 'ok'})
+
+
+def probe_vector_index():
+    get_vector_index().describe_index_stats(timeout=READINESS_TIMEOUT)
+
+def probe_openai():
+    upstream.openai_client(READINESS_TIMEOUT).models.retrieve(COMPLETION_MODEL)
+
+def readiness_checks():
+    '''live probe of each upstream, re-run at most every READINESS_CACHE_SECONDS per worker'''
+    with _readiness_lock:
+        checked_at = _readiness['checked_at']
+        if checked_at is None or time.monotonic() - checked_at >= READINESS_CACHE_SECONDS:
+            checks = {}
+            for name, probe in (('vector_index', probe_vector_index), ('openai', probe_openai)):
+                try:
+                    probe()
+                    checks[name] = 'ok'
+                except Exception as e:
+                    checks[name] = f"{type(e).__name__}: {str(e)}"
+            _readiness.update(checked_at=time.monotonic(), checks=checks)
+        return _readiness['checks']
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    '''readiness: the vector index and OpenAI answer a cheap request within READINESS_TIMEOUT; 503 with the failing checks otherwise'''
+    checks = readiness_checks()
+    ready = all(result == 'ok' for result in checks.values())
+    return jsonify({'status': 'ready' if ready else 'not ready', 'checks': checks, 'facts': len(fact_index)}), 200 if ready else 503
+
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    '''cache hit/miss counters, answer path counts and upstream coalescing/circuit breaker state for the worker that serves this request'''
+    answered = sum(answer_paths.values())
+    return jsonify({
+        'embedding': embedding_cache.stats(),
+        'answer': answer_cache.stats(),
+        'upstream': upstream.stats(),
+        'answer_paths': dict(answer_paths),
+        'structured_offload_rate': answer_paths['structured'] / answered if answered else 0.0,
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    '''request, stage and context-size histograms, token, cost and cache counters of all workers, in the Prometheus text format'''
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+def get_question():
+    """Read the question from the request body, falling back to a capabilities question"""
     query = request.json.get('question', '')
-    
     if not query or query.strip() == '':
         query = "What types of questions can you answer?"
-    
+    metrics.annotate(question=query)
+    return query
+
+def cache_bypass_requested():
+    """Send X-Cache-Bypass: 1 to skip the answer cache and force a fresh answer"""
+    return request.headers.get('X-Cache-Bypass', '').lower() in ('1', 'true', 'yes')
+
+def answer_response(answer, path, **headers):
+    """JSON answer in the shape the frontend expects, tagged with the path that served it"""
+    answer_paths[path] += 1
+    metrics.annotate(answer_chars=len(answer))
+    response = jsonify(answer, [])
+    response.headers['X-Answer-Path'] = path
+    response.headers.update(headers)
+    return response
+
+def build_messages(query, query_embedding):
+    """Retrieve relevant documents and build the chat completion messages; returns (messages, context)"""
     # Search for relevant documents
-    relevant_docs = search_similar_docs(query, 50)
-    
-    # Create context from relevant documents
-    context = "\n\n".join(relevant_docs)
-    
+    with metrics.stage('retrieval'):
+        relevant_docs = retrieve_docs(query, query_embedding)
+
+    # Create context from relevant documents within the token budget
+    with metrics.stage('context_build'):
+        context, stats = build_context(relevant_docs)
+    metrics.record_context(stats['kept'], stats['retrieved'])
+    metrics.annotate(context_tokens=stats['context_tokens'], context_tokens_saved=stats['tokens_saved'])
+
     # Create prompt
     prompt = create_prompt(context, query)
-    
-    # Call OpenAI API
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_message()},
-                {"role": "user", "content": prompt}
-            ]
+    messages = [
+        {"role": "system", "content": system_message()},
+        {"role": "user", "content": prompt}
+    ]
+    return messages, context
+
+def fallback_answer(context):
+    """Answer from the retrieved facts alone when the completion API is unavailable; None if nothing was retrieved"""
+    facts = [line for line in context.split("\n") if line.strip()]
+    if not facts:
+        return None
+    items = "".join(f"<li>{html.escape(fact, quote=False)}</li>" for fact in facts)
+    return f"<p>The answer service is unavailable right now. These research facts match your question:</p><ul>{items}</ul>"
+
+def complete(query, messages, context):
+    """Chat completion for the built messages; identical prompts in flight at the same time share one call.
+    Raises upstream.UpstreamError"""
+    with metrics.stage('completion'):
+        response = upstream.call(
+            'completion',
+            metrics.with_usage(COMPLETION_MODEL, upstream.openai_client(upstream.COMPLETION_TIMEOUT).chat.completions.create),
+            model=COMPLETION_MODEL,
+            messages=messages,
+            key=(query, context)
         )
-        answer = response.choices[0].message.content
-        # Strip markdown code block formatting if present
-        if answer.startswith('```html'):
-            answer = answer[7:]  # Remove ```html
-        elif answer.startswith('```'):
-            answer = answer[3:]  # Remove ```
-        if answer.endswith('```'):
-            answer = answer[:-3]  # Remove trailing ```
-        answer = answer.strip()  # Remove any extra whitespace
-        
-        print(f"Question: {query}")
-        print(f"Answer: {answer}")
-        return jsonify(answer, [])
+    # Strip markdown code block formatting if present
+    return strip_code_fences(response.choices[0].message.content)
+
+def unavailable_response():
+    """503 with a retry hint when there is nothing to answer from"""
+    response = jsonify(UNAVAILABLE_MESSAGE, [])
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(upstream.BREAKER_RESET_SECONDS))
+    return response
+
+
+@app.route("/chatbot", methods=["POST"])
+def chatbot():
+    """Main chatbot interface"""
+    query = get_question()
+
+    # Simple lookups are answered from templates without any upstream call
+    structured = structured_answer(query, analyze_question(query), fact_index)
+    if structured is not None:
+        return answer_response(structured, 'structured')
+
+    # Serve near-duplicate questions from the answer cache (keyed by the question embedding)
+    query_embedding = try_embed_query(query)
+    bypass_cache = cache_bypass_requested() or query_embedding is None
+    if bypass_cache:
+        answer_cache.record_bypass()
+        metrics.record_cache('answer', 'bypass')
+    else:
+        cached_answer, similarity = answer_cache.get(query, query_embedding)
+        metrics.record_cache('answer', 'miss' if cached_answer is None else 'hit')
+        if cached_answer is not None:
+            return answer_response(cached_answer, 'cache', **{'X-Cache': 'HIT', 'X-Cache-Similarity': f"{similarity:.4f}"})
+
+    # Retrieve and call OpenAI API; every failure answers in JSON, never with an HTML error page
+    context = ""
+    try:
+        messages, context = build_messages(query, query_embedding)
+        answer = complete(query, messages, context)
+        if query_embedding is not None:
+            answer_cache.put(query, query_embedding, answer)
+        return answer_response(answer, 'rag', **{'X-Cache': 'BYPASS' if bypass_cache else 'MISS'})
+    except UpstreamError as e:
+        print(f"Completion failed: {str(e)}")
+        answer = fallback_answer(context)
+        return answer_response(answer, 'fallback') if answer else unavailable_response()
     except Exception as e:
         print(f"Error: {str(e)}")
         return jsonify(f"<p>Sorry, an error occurred: {str(e)}</p>", []), 500
 
 
+@app.route("/chatbot/stream", methods=["POST"])
+def chatbot_stream():
+    """Streaming chatbot interface: completion tokens are sent as Server-Sent Events as they arrive.
+
+    Events: `data: {"delta": "<html>"}` for each piece of the answer, then `event: done` with
+    the answer path, time-to-first-token and total latency (or `event: error`)."""
+    start = time.perf_counter()
+    query = get_question()
+    bypass_cache = cache_bypass_requested()
+    query_embedding = None
+
+    ready_answer, path = structured_answer(query, analyze_question(query), fact_index), 'structured'
+    if ready_answer is None:
+        query_embedding = try_embed_query(query)
+        bypass_cache = bypass_cache or query_embedding is None
+        if bypass_cache:
+            answer_cache.record_bypass()
+            metrics.record_cache('answer', 'bypass')
+        else:
+            (ready_answer, _), path = answer_cache.get(query, query_embedding), 'cache'
+            metrics.record_cache('answer', 'miss' if ready_answer is None else 'hit')
+
+    def generate():
+        if ready_answer is not None:
+            answer_paths[path] += 1
+            metrics.annotate(path=path, answer_chars=len(ready_answer))
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            yield sse_event({"delta": ready_answer})
+            yield sse_event({"path": path, "cache": "HIT" if path == 'cache' else None, "ttft_ms": elapsed_ms, "total_ms": elapsed_ms, "history": []}, event="done")
+            return
+        first_token = None
+        parts = []
+        fence_filter = CodeFenceFilter()
+        context = ""
+        try:
+            messages, context = build_messages(query, query_embedding)
+            completion_start = time.perf_counter()
+            stream = upstream.call(
+                'completion',
+                upstream.openai_client(upstream.COMPLETION_TIMEOUT).chat.completions.create,
+                model=COMPLETION_MODEL,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+        except UpstreamError as e:
+            print(f"Completion failed: {str(e)}")
+            answer = fallback_answer(context)
+            if answer is None:
+                yield sse_event({"message": UNAVAILABLE_MESSAGE}, event="error")
+                return
+            answer_paths['fallback'] += 1
+            metrics.annotate(path='fallback', answer_chars=len(answer))
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            yield sse_event({"delta": answer})
+            yield sse_event({"path": "fallback", "cache": None, "ttft_ms": elapsed_ms, "total_ms": elapsed_ms, "history": []}, event="done")
+            return
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            yield sse_event({"message": f"<p>Sorry, an error occurred: {str(e)}</p>"}, event="error")
+            return
+        try:
+            for chunk in stream:
+                # with include_usage the last chunk carries the token counts and no choices
+                metrics.record_usage(COMPLETION_MODEL, getattr(chunk, 'usage', None))
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                text = fence_filter.feed(chunk.choices[0].delta.content)
+                if text:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    parts.append(text)
+                    yield sse_event({"delta": text})
+            text = fence_filter.finish()
+            if text:
+                parts.append(text)
+                yield sse_event({"delta": text})
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            yield sse_event({"message": f"<p>Sorry, an error occurred: {str(e)}</p>"}, event="error")
+            return
+        answer = "".join(parts)
+        if query_embedding is not None:
+            answer_cache.put(query, query_embedding, answer)
+        answer_paths['rag'] += 1
+        metrics.record_stage('completion', time.perf_counter() - completion_start)
+        total_ms = (time.perf_counter() - start) * 1000
+        ttft_ms = (first_token - start) * 1000 if first_token else total_ms
+        metrics.annotate(path='rag', answer_chars=len(answer), ttft_ms=round(ttft_ms, 1))
+        yield sse_event({"path": "rag", "cache": "BYPASS" if bypass_cache else "MISS", "ttft_ms": ttft_ms, "total_ms": total_ms, "history": []}, event="done")
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+def answer_for_batch(query, query_embedding, bypass_cache):
+    """Answer one question of a batch that has no structured answer; returns (answer, path)"""
+    if bypass_cache or query_embedding is None:
+        answer_cache.record_bypass()
+        metrics.record_cache('answer', 'bypass')
+    else:
+        cached_answer, _ = answer_cache.get(query, query_embedding)
+        metrics.record_cache('answer', 'miss' if cached_answer is None else 'hit')
+        if cached_answer is not None:
+            return cached_answer, 'cache'
+    context = ""
+    try:
+        messages, context = build_messages(query, query_embedding)
+        answer = complete(query, messages, context)
+    except UpstreamError as e:
+        print(f"Completion failed: {str(e)}")
+        answer = fallback_answer(context)
+        return (answer, 'fallback') if answer else (UNAVAILABLE_MESSAGE, 'unavailable')
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return f"<p>Sorry, an error occurred: {str(e)}</p>", 'error'
+    if query_embedding is not None:
+        answer_cache.put(query, query_embedding, answer)
+    return answer, 'rag'
+
+def answer_batch(queries, bypass_cache):
+    """Answer a list of questions, yielding {"index", "question", "answer", "path"} in input order.
+    Questions that differ only in case, spacing or trailing punctuation are answered once. The questions left after
+    the structured answers are embedded with one API call, then retrieved and completed BATCH_CONCURRENCY at a time"""
+    first = {}  # normalized question -> first question asked with that text
+    for query in queries:
+        first.setdefault(normalize_question(query), query)
+    results = {}  # normalized question -> (answer, path), or a Future of it
+    pending = []
+    for key, query in first.items():
+        structured = structured_answer(query, analyze_question(query), fact_index)
+        if structured is not None:
+            results[key] = (structured, 'structured')
+        else:
+            pending.append(key)
+    trace = metrics.current_trace()
+    embeddings = try_embed_queries([first[key] for key in pending])
+    metrics.annotate(path='batch', questions=len(queries), distinct_questions=len(first), structured=len(first) - len(pending))
+    pool = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY)
+    try:
+        for key, query_embedding in zip(pending, embeddings):
+            results[key] = pool.submit(metrics.run_traced, answer_for_batch, first[key], query_embedding, bypass_cache)
+        for i, query in enumerate(queries):
+            key = normalize_question(query)
+            if isinstance(results[key], Future):
+                results[key], worker_trace = results[key].result()
+                if trace is not None:
+                    trace.merge(worker_trace)
+            answer, path = results[key]
+            answer_paths[path] += 1
+            yield {"index": i, "question": query, "answer": answer, "path": path}
+    finally:
+        # all done, or the client went away mid-stream (GeneratorExit): questions not started yet are dropped
+        # instead of spending completions on an abandoned request
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+@app.route("/chatbot/batch", methods=["POST"])
+def chatbot_batch():
+    """Answer many questions in one request: {"questions": ["...", ...]} -> {"results": [{"index", "question", "answer", "path"}, ...]}
+    in the order asked. With "stream": true (or Accept: application/x-ndjson) each result is sent as one NDJSON line
+    as soon as it and every earlier result are ready"""
+    body = request.json or {}
+    queries = body.get('questions')
+    if not isinstance(queries, list) or not queries or not all(isinstance(query, str) and query.strip() for query in queries):
+        return jsonify({'error': 'questions must be a non-empty list of non-empty strings'}), 400
+    if len(queries) > BATCH_MAX_QUESTIONS:
+        return jsonify({'error': f"at most {BATCH_MAX_QUESTIONS} questions per batch"}), 413
+    results = answer_batch(queries, cache_bypass_requested())
+    if body.get('stream') or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        def lines():
+            with closing(results):  # closing the response (client disconnect) cancels the questions not started yet
+                for result in results:
+                    yield json.dumps(result) + "\n"
+        return Response(stream_with_context(lines()), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+    return jsonify({'results': list(results)})
+
+
 ######################################################################################################
 
 if __name__ == "__main__":
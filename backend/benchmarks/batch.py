@@ -0,0 +1,64 @@
+'''
+/chatbot/batch against the same questions sent as separate /chatbot requests.
+
+Run from the backend directory once `python ingest.py --backend local` has built the index:
+    python -m benchmarks.batch --sizes 10 50 --latency 0.5
+
+The app runs in-process against the OpenAI-compatible fake (benchmarks.fakes), which
+takes --latency seconds per call and counts the embedding and chat calls it serves.
+Questions are open-ended and sent with X-Cache-Bypass, so every one is retrieved and
+completed; separate requests are sent --concurrency at a time.
+'''
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakes import FakeOpenAIServer
+
+STATES = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado', 'Connecticut', 'Delaware', 'Florida', 'Georgia']
+
+
+def questions(size, run):
+    '''distinct questions per run, so neither run is served embeddings cached by the other'''
+    return [f"Summarize how {STATES[i % len(STATES)]} treats net operating losses ({run} {size}/{i})" for i in range(size)]
+
+def measure(fake, send):
+    before = dict(fake.calls)
+    start = time.perf_counter()
+    send()
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, **{f"{kind}_calls": fake.calls[kind] - before[kind] for kind in fake.calls}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare /chatbot/batch with separate /chatbot requests.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--latency", type=float, default=0.5, help="fake upstream latency per call in seconds")
+    parser.add_argument("--concurrency", type=int, default=4, help="separate /chatbot requests in flight at once")
+    args = parser.parse_args(argv)
+
+    with FakeOpenAIServer(latency=args.latency) as fake:
+        os.environ.update(OPENAI_BASE_URL=fake.base_url, OPENAI_API_KEY='fake', SECRET_KEY=os.environ.get('SECRET_KEY', 'fake'))
+        import app  # after OPENAI_BASE_URL is set, so the client talks to the fake
+        client = app.app.test_client()
+        headers = {'X-Cache-Bypass': '1'}
+        report = []
+        for size in args.sizes:
+            def separate():
+                with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                    list(pool.map(lambda query: app.app.test_client().post('/chatbot', json={'question': query}, headers=headers), questions(size, 'separate')))
+            def batch():
+                client.post('/chatbot/batch', json={'questions': questions(size, 'batch')}, headers=headers)
+            separate_run, batch_run = measure(fake, separate), measure(fake, batch)
+            report.append({
+                'questions': size,
+                'separate': {**separate_run, 'throughput_qps': size / separate_run['seconds']},
+                'batch': {**batch_run, 'throughput_qps': size / batch_run['seconds']},
+            })
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+'''
+Local stand-ins for upstream services, for benchmarks that must run without API keys.
+
+Each fake is an HTTP server on a background thread that sleeps `latency` seconds per
+request and counts the requests it serves (`calls`). Point the app at them with
+the environment returned by `env()`:
+    FakeOpenAIServer       embeddings and chat completions (streamed or not)   OPENAI_BASE_URL
+    FakePineconeServer     query/upsert/delete of a Pinecone serverless index  PINECONE_INDEX_HOST
+    FakeSmartsheetServer   sheets from recorded JSON, with ETags and 304s      ss_url, ss_token and the sheet ids
+'''
+import base64
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import vector_store
+
+FAKE_ANSWER = "<p>The Alabama 2023 tax rate is 6.5%.</p>"
+RECORDED_SHEETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smartsheets.json')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # load tests open hundreds of connections at once
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):  # the client timed out or went away; nothing to report
+            super().handle_error(request, client_address)
+
+
+def fake_embedding(text, dimension, encoding_format='float'):
+    '''deterministic unit vector for a text, so repeated questions embed identically; as a list of floats or, like the
+    API when the client asks for encoding_format="base64" (the openai client's default), as base64 float32 bytes'''
+    seed = int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:4], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    vector /= np.linalg.norm(vector)
+    return base64.b64encode(vector.tobytes()).decode('ascii') if encoding_format == 'base64' else vector.tolist()
+
+
+class FakeServer:
+    '''HTTP server on a background thread; subclasses answer requests in get()/post()'''
+
+    def __init__(self, latency, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.calls = {}
+        self._calls_lock = threading.Lock()
+        self._server = _Server((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self):
+        '''environment variables that point the app at this fake'''
+        return {}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, kind):
+        with self._calls_lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def get(self, handler, path):
+        handler.send_error(404)
+
+    def post(self, handler, path, body):
+        handler.send_error(404)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, body, status=200):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                time.sleep(fake.latency)
+                fake.get(self, self.path)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                time.sleep(fake.latency)
+                fake.post(self, self.path, body)
+
+        return Handler
+
+
+class FakeOpenAIServer(FakeServer):
+    '''OpenAI-compatible /v1/embeddings, /v1/chat/completions and /v1/models/{model}'''
+
+    def __init__(self, latency=0.5, dimension=3072, answer=FAKE_ANSWER, host='127.0.0.1', port=0):
+        super().__init__(latency, host, port)
+        self.dimension = dimension
+        self.answer = answer
+        self.calls = {'embeddings': 0, 'chat': 0}
+
+    @property
+    def base_url(self):
+        return super().base_url + "/v1"
+
+    def env(self):
+        return {'OPENAI_BASE_URL': self.base_url, 'OPENAI_API_KEY': 'fake'}
+
+    def get(self, handler, path):
+        if path.startswith('/v1/models/'):
+            handler.send_json({'id': path.rsplit('/', 1)[1], 'object': 'model', 'created': 0, 'owned_by': 'openai'})
+        else:
+            handler.send_error(404)
+
+    def post(self, handler, path, request):
+        if path.endswith('/embeddings'):
+            self._count('embeddings')
+            inputs = request['input'] if isinstance(request['input'], list) else [request['input']]
+            tokens = sum(len(text.split()) for text in inputs)
+            handler.send_json({
+                'object': 'list',
+                'model': request.get('model'),
+                'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(text, self.dimension, request.get('encoding_format', 'float'))} for i, text in enumerate(inputs)],
+                'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+            })
+        elif path.endswith('/chat/completions'):
+            self._count('chat')
+            prompt_tokens = sum(len(message['content'].split()) for message in request.get('messages', []))
+            completion_tokens = len(self.answer.split())
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+            if request.get('stream'):
+                self.stream_answer(handler, request.get('model'), usage if (request.get('stream_options') or {}).get('include_usage') else None)
+            else:
+                handler.send_json({
+                    'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': request.get('model'),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': self.answer}, 'finish_reason': 'stop'}],
+                    'usage': usage,
+                })
+        else:
+            handler.send_error(404)
+
+    def stream_answer(self, handler, model, usage=None):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        for i in range(0, len(self.answer), 8):
+            chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                     'choices': [{'index': 0, 'delta': {'content': self.answer[i:i + 8]}, 'finish_reason': None}]}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        if usage is not None:
+            chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model, 'choices': [], 'usage': usage}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.close_connection = True
+
+
+class FakePineconeServer(FakeServer):
+    '''the data-plane REST API of a Pinecone serverless index (query, upsert, delete, stats), backed by an in-memory
+    vector_store.LocalIndex; the Pinecone client talks to it when PINECONE_INDEX_HOST is its base_url'''
+
+    def __init__(self, latency=0.05, host='127.0.0.1', port=0):
+        super().__init__(latency, host, port)
+        self.index = vector_store.LocalIndex()
+        self.calls = {'query': 0, 'upsert': 0, 'delete': 0}
+
+    def env(self):
+        return {'PINECONE_INDEX_HOST': self.base_url, 'PINECONE_API_KEY': 'fake'}
+
+    def get(self, handler, path):
+        if path.startswith('/describe_index_stats'):
+            self.describe_index_stats(handler)
+        else:
+            handler.send_error(404)
+
+    def post(self, handler, path, request):
+        if path == '/query':
+            self._count('query')
+            results = self.index.query(request['vector'], request.get('topK', 10), request.get('includeMetadata', False), request.get('filter'))
+            handler.send_json({'matches': [dict(match, values=[]) for match in results['matches']], 'namespace': request.get('namespace', ''), 'usage': {'readUnits': 1}})
+        elif path == '/vectors/upsert':
+            self._count('upsert')
+            vectors = [(vector['id'], vector['values'], vector.get('metadata') or {}) for vector in request['vectors']]
+            handler.send_json({'upsertedCount': self.index.upsert(vectors)['upserted_count']})
+        elif path == '/vectors/delete':
+            self._count('delete')
+            handler.send_json(self.index.delete(request.get('ids'), request.get('deleteAll', False)))
+        elif path.startswith('/describe_index_stats'):
+            self.describe_index_stats(handler)
+        else:
+            handler.send_error(404)
+
+    def describe_index_stats(self, handler):
+        count = len(self.index)
+        dimension = self.index.embeddings.shape[1] if count else 0
+        handler.send_json({'namespaces': {'': {'vectorCount': count}}, 'dimension': dimension, 'indexFullness': 0.0, 'totalVectorCount': count})
+
+
+def load_recorded_sheets(path=RECORDED_SHEETS_PATH):
+    '''sheet name -> sheet JSON, from one JSON file ({"cfp_sheet": {...}, ...}) or from a directory of snapshots
+    saved by research.py (SMARTSHEET_SNAPSHOT_DIR, files named <sheet>_<sheet id>.json)'''
+    if os.path.isdir(path):
+        sheets = {}
+        for name in sorted(os.listdir(path)):
+            sheet = name.rsplit('_', 1)[0]
+            if name.endswith('.json') and sheet not in sheets:
+                with open(os.path.join(path, name)) as f:
+                    sheets[sheet] = json.load(f)['data']
+        return sheets
+    with open(path) as f:
+        return json.load(f)
+
+
+class FakeSmartsheetServer(FakeServer):
+    '''Smartsheet sheets API serving recorded sheet JSON: GET /<sheet id> with an ETag (304 on If-None-Match)
+    and GET /<sheet id>/version'''
+
+    def __init__(self, sheets=None, latency=0.2, host='127.0.0.1', port=0):
+        super().__init__(latency, host, port)
+        self.sheets = sheets if sheets is not None else load_recorded_sheets()
+        self.sheet_ids = {name: str(7000000000000000 + i) for i, name in enumerate(sorted(self.sheets))}
+        self._bodies = {}  # sheet id -> (body, etag, version)
+        for name, sheet_id in self.sheet_ids.items():
+            body = json.dumps(self.sheets[name]).encode('utf-8')
+            self._bodies[sheet_id] = (body, '"' + hashlib.sha1(body).hexdigest() + '"', self.sheets[name].get('version'))
+        self.calls = {'download': 0, 'not_modified': 0, 'version': 0}
+
+    def env(self):
+        return {'ss_url': self.base_url + "/", 'ss_token': 'fake', **self.sheet_ids}
+
+    def get(self, handler, path):
+        parts = path.strip('/').split('/')
+        if parts[0] not in self._bodies:
+            handler.send_error(404)
+            return
+        body, etag, version = self._bodies[parts[0]]
+        if parts[1:] == ['version']:
+            self._count('version')
+            handler.send_json({'version': version})
+        elif handler.headers.get('If-None-Match') == etag:
+            self._count('not_modified')
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+        else:
+            self._count('download')
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'application/json')
+            handler.send_header('ETag', etag)
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
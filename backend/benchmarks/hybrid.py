@@ -0,0 +1,104 @@
+'''
+Recall and latency of lexical (BM25), vector and hybrid retrieval on a labeled query set.
+
+Run from the backend directory once `python ingest.py` has written the manifest:
+    python -m benchmarks.hybrid                       # all three modes; embeds the questions once (needs API keys)
+    python -m benchmarks.hybrid --modes lexical       # BM25 only, no API keys needed
+    python -m benchmarks.hybrid --k 1 5 10 --queries benchmarks/queries.json
+
+Each entry in queries.json labels the facts that answer it by metadata ({"state", "topic",
+"year", "period", "category"}), so the labels stay valid when the sheets are re-imported and fact ids
+change. Searches are unfiltered, to compare how well each mode ranks the right state's
+facts on its own. recall@k is the share of a question's relevant facts (at most k) in its top k.
+'''
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import ingest
+from benchmarks.retrieval import percentile
+from lexical_index import LexicalIndex
+
+QUERIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'queries.json')
+MODES = ['lexical', 'vector', 'hybrid']
+
+
+def relevant_ids(manifest, label):
+    return {doc_id for doc_id, doc in manifest.items() if all(doc.get(field) == value for field, value in label.items())}
+
+def recall_at_k(relevant, ranked_ids, k):
+    return len(relevant & set(ranked_ids[:k])) / min(len(relevant), k)
+
+def run_mode(search, queries, ks, repeat):
+    '''search(question, top_k) -> ranked docs; returns latencies (seconds) and mean recall per k'''
+    latencies = []
+    recalls = {k: [] for k in ks}
+    for query in queries:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            docs = search(query['question'], max(ks))
+            latencies.append(time.perf_counter() - start)
+        ranked_ids = [doc['id'] for doc in docs]
+        for k in ks:
+            recalls[k].append(recall_at_k(query['relevant_ids'], ranked_ids, k))
+    return latencies, {f"recall_at_{k}": float(np.mean(values)) for k, values in recalls.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare recall@k and latency of lexical, vector and hybrid retrieval.")
+    parser.add_argument("--queries", default=QUERIES_PATH, help="labeled query set")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 5, 10, 20])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    path = ingest.manifest_path(os.environ.get('VECTOR_BACKEND', 'pinecone'))
+    manifest = ingest.load_manifest(path)
+    if not manifest:
+        parser.error(f"no manifest at {path}; run `python ingest.py` first")
+    with open(args.queries) as f:
+        queries = json.load(f)
+    for query in queries:
+        query['relevant_ids'] = relevant_ids(manifest, query['relevant'])
+    skipped = [query['question'] for query in queries if not query['relevant_ids']]
+    queries = [query for query in queries if query['relevant_ids']]
+    if skipped:
+        print(f"Skipping {len(skipped)} questions with no matching facts in the corpus: {skipped}")
+
+    searches = {}
+    embedding_latencies = []
+    if 'lexical' in args.modes:
+        lexical = LexicalIndex(path)
+        len(lexical)  # build before timing
+        searches['lexical'] = lambda question, top_k: lexical.search(question, top_k)
+    if set(args.modes) - {'lexical'}:
+        import app  # clients are built on first use
+        embeddings = {}
+        for query in queries:
+            start = time.perf_counter()
+            embeddings[query['question']] = app.embed_query(query['question'])
+            embedding_latencies.append(time.perf_counter() - start)
+        for mode in set(args.modes) - {'lexical'}:
+            searches[mode] = lambda question, top_k, mode=mode: app.search_docs(question, top_k, embeddings[question], mode=mode)
+
+    report = []
+    for mode in args.modes:
+        latencies, recalls = run_mode(searches[mode], queries, args.k, args.repeat)
+        report.append({
+            'mode': mode,
+            'queries': len(queries),
+            **recalls,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'mean_ms': float(np.mean(latencies) * 1000),
+            # vector and hybrid searches also need the question embedded first (cached after the first call)
+            'embedding_mean_ms': float(np.mean(embedding_latencies) * 1000) if mode != 'lexical' and embedding_latencies else None,
+        })
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
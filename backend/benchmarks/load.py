@@ -0,0 +1,146 @@
+'''
+Concurrent load test for /chatbot.
+
+Run from the backend directory:
+    python -m benchmarks.load --url http://localhost:5000 --concurrency 8 32 128    # against a running server
+    python -m benchmarks.load --compare --latency 1.0                              # sync vs gevent workers, offline
+
+--compare starts an OpenAI-compatible fake (benchmarks.fakes) that takes --latency seconds
+per call, then runs gunicorn with GUNICORN_WORKER_CLASS=sync and with gevent against it,
+using the same number of workers. Questions are open-ended and sent with X-Cache-Bypass,
+so every request embeds the question, retrieves and calls the completion API.
+Exits with status 1 when any request failed; with --compare, the end of the gunicorn log is printed.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import requests
+
+from benchmarks.fakes import FakeOpenAIServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def ask(session, url, i):
+    start = time.perf_counter()
+    try:
+        response = session.post(f"{url}/chatbot", json={'question': f"Summarize the differences in apportionment rules between states ({i})"},
+                                headers={'X-Cache-Bypass': '1'}, timeout=300)
+        ok = response.status_code == 200
+    except requests.RequestException:
+        ok = False
+    return time.perf_counter() - start, ok
+
+def run_level(url, concurrency, total):
+    '''send `total` requests from `concurrency` clients; returns throughput and latency percentiles'''
+    sessions = [requests.Session() for _ in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda i: ask(sessions[i % concurrency], url, i), range(total)))
+    elapsed = time.perf_counter() - start
+    latencies = np.array([latency for latency, ok in results if ok]) * 1000
+    return {
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': sum(1 for _, ok in results if not ok),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        'max_ms': float(latencies.max()) if len(latencies) else None,
+    }
+
+def run_levels(url, levels, rounds):
+    return [run_level(url, concurrency, concurrency * rounds) for concurrency in levels]
+
+def errors_in(levels):
+    return sum(level['errors'] for level in levels)
+
+def print_log(path, lines=40):
+    '''the end of a gunicorn log, to show why requests failed'''
+    with open(path, errors='replace') as f:
+        tail = f.readlines()[-lines:]
+    print(f"--- last {len(tail)} lines of {path} ---")
+    print(''.join(tail), end='')
+
+def wait_until_healthy(url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode}")
+        try:
+            if requests.get(f"{url}/healthz", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("gunicorn did not become healthy")
+
+@contextmanager
+def gunicorn(env, port, workers, worker_class='gevent'):
+    '''run the app under gunicorn (gunicorn.conf.py) with extra environment variables; yields (URL, log path) once
+    healthy. The server's output goes to the log, which is removed on exit.'''
+    env = {'SECRET_KEY': 'fake', **os.environ, **env,
+           'GUNICORN_WORKER_CLASS': worker_class, 'GUNICORN_BIND': f"127.0.0.1:{port}", 'GUNICORN_WORKERS': str(workers)}
+    log_fd, log_path = tempfile.mkstemp(prefix=f"gunicorn-{worker_class}-", suffix='.log')
+    with os.fdopen(log_fd, 'w') as log:
+        process = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app'], cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        try:
+            wait_until_healthy(url, process)
+        except RuntimeError:
+            print_log(log_path)
+            raise
+        yield url, log_path
+    finally:
+        process.terminate()
+        process.wait()
+        os.remove(log_path)
+
+def compare(args):
+    '''load-test sync and gevent workers against the fake OpenAI server'''
+    report = {}
+    scratch = tempfile.mkdtemp()
+    with FakeOpenAIServer(latency=args.latency) as fake:
+        for worker_class in ('sync', 'gevent'):
+            env = dict(fake.env(), PINECONE_API_KEY='fake',
+                       VECTOR_BACKEND='local', VECTOR_STORE_DIR=os.path.join(scratch, 'vector_store'), METRICS_PATH=os.path.join(scratch, f"{worker_class}_metrics.sqlite3"),
+                       EMBEDDING_CACHE_PATH=os.path.join(scratch, f"{worker_class}.sqlite3"), CORPUS_VERSION_PATH=os.path.join(scratch, 'corpus_version'))
+            with gunicorn(env, args.port, args.workers, worker_class) as (url, log_path):
+                print(f"Load testing {args.workers} {worker_class} workers...")
+                report[worker_class] = run_levels(url, args.concurrency, args.rounds)
+                if errors_in(report[worker_class]):
+                    print_log(log_path)
+    return {'upstream_latency_s': args.latency, 'workers': args.workers, 'results': report}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure /chatbot throughput and latency under concurrent load.")
+    parser.add_argument("--url", default="http://localhost:5000", help="server to load-test (ignored with --compare)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--rounds", type=int, default=3, help="requests per client at each concurrency level")
+    parser.add_argument("--compare", action="store_true", help="start gunicorn with sync and gevent workers against a fake OpenAI upstream")
+    parser.add_argument("--latency", type=float, default=1.0, help="fake upstream latency per call in seconds (--compare)")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers (--compare)")
+    parser.add_argument("--port", type=int, default=5055, help="port for the gunicorn server (--compare)")
+    args = parser.parse_args(argv)
+    report = compare(args) if args.compare else {'url': args.url, 'results': run_levels(args.url, args.concurrency, args.rounds)}
+    print(json.dumps(report, indent=2))
+    results = report['results'].values() if args.compare else [report['results']]
+    errors = sum(errors_in(levels) for levels in results)
+    if errors:
+        print(f"{errors} requests failed; the numbers above are not valid", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
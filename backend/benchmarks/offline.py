@@ -0,0 +1,194 @@
+'''
+Offline benchmark suite: OpenAI, Pinecone and Smartsheet are all local fakes (benchmarks.fakes),
+so it runs without API keys and its numbers can be compared from one run to the next.
+
+Run from the backend directory:
+    python -m benchmarks.offline                                  # writes benchmarks/results/offline-<time>.json
+    python -m benchmarks.offline --concurrency 1 8 32 --openai-latency 0.3 --output results.json
+    python -m benchmarks.offline --sheets cache/smartsheets       # serve sheets recorded by a live ingest run
+    python -m benchmarks.offline --baseline benchmarks/results/offline-20240101-120000.json
+
+Measures, in order:
+    corpus    get_research() cold (every sheet downloaded and parsed) and warm (conditional
+              requests answered 304, parsed sheets reused)
+    ingest    initialize_vector_store(): a full sync into the fake Pinecone index, then a
+              re-sync with nothing changed
+    chatbot   /chatbot served by gunicorn (settings from gunicorn.conf.py) at each concurrency
+              level: p50/p95/p99 latency and throughput, using the index and manifest from the
+              ingest step
+The sheets served by default are benchmarks/smartsheets.json, recorded in the shape research.py
+parses. With --baseline, the key numbers are printed next to an earlier result file.
+A run in which any /chatbot request failed prints the end of the gunicorn log, writes no
+result file and exits with status 1.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.fakes import RECORDED_SHEETS_PATH, FakeOpenAIServer, FakePineconeServer, FakeSmartsheetServer, load_recorded_sheets
+from benchmarks.load import BACKEND_DIR, errors_in, gunicorn, print_log, run_levels
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def scratch_env(scratch):
+    '''caches, snapshots and manifests of the run go to a scratch directory instead of backend/cache'''
+    return {
+        'SECRET_KEY': 'fake',
+        'VECTOR_BACKEND': 'pinecone',
+        'MANIFEST_DIR': os.path.join(scratch, 'manifests'),
+        'SMARTSHEET_SNAPSHOT_DIR': os.path.join(scratch, 'smartsheets'),
+        'EMBEDDING_CACHE_PATH': os.path.join(scratch, 'embeddings.sqlite3'),
+        'CORPUS_VERSION_PATH': os.path.join(scratch, 'corpus_version'),
+        'METRICS_PATH': os.path.join(scratch, 'metrics.sqlite3'),
+    }
+
+def milliseconds(samples):
+    samples = np.asarray(samples) * 1000
+    return {'p50_ms': float(np.percentile(samples, 50)), 'min_ms': float(samples.min()), 'max_ms': float(samples.max())}
+
+def bench_corpus(app, research, sheets_fake, repeat):
+    '''time get_research() with no snapshots (cold) and with every sheet unchanged since the last call (warm)'''
+    cold, warm = [], []
+    docs = []
+    for _ in range(repeat):
+        shutil.rmtree(research.SNAPSHOT_DIR, ignore_errors=True)
+        research._sheets.clear()
+        research._parsed.clear()
+        start = time.perf_counter()
+        docs = app.get_research()
+        cold.append(time.perf_counter() - start)
+    calls_before = dict(sheets_fake.calls)
+    for _ in range(repeat):
+        start = time.perf_counter()
+        app.get_research()
+        warm.append(time.perf_counter() - start)
+    return {
+        'documents': len(docs),
+        'sheets': len(research.SHEETS),
+        'cold': milliseconds(cold),
+        'warm': milliseconds(warm),
+        'warm_sheet_requests': {kind: sheets_fake.calls[kind] - calls_before[kind] for kind in sheets_fake.calls},
+    }
+
+def bench_ingest(app, openai_fake, pinecone_fake):
+    '''full sync of the corpus into the fake Pinecone index, then a re-sync with nothing changed'''
+    start = time.perf_counter()
+    docs = app.initialize_vector_store()
+    full = time.perf_counter() - start
+    full_calls = {'embeddings_calls': openai_fake.calls['embeddings'], 'upsert_calls': pinecone_fake.calls['upsert']}
+    start = time.perf_counter()
+    app.initialize_vector_store()
+    resync = time.perf_counter() - start
+    return {
+        'documents': len(docs),
+        'full_sync_s': full,
+        'documents_per_s': len(docs) / full,
+        **full_calls,
+        'resync_s': resync,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def key_numbers(report):
+    '''flat {name: value} of the numbers worth comparing between runs'''
+    numbers = {
+        'corpus cold p50 ms': report['corpus']['cold']['p50_ms'],
+        'corpus warm p50 ms': report['corpus']['warm']['p50_ms'],
+        'ingest documents/s': report['ingest']['documents_per_s'],
+        'ingest re-sync s': report['ingest']['resync_s'],
+    }
+    for level in report['chatbot']:
+        for field in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps'):
+            numbers[f"chatbot c={level['concurrency']} {field}"] = level[field]
+    return numbers
+
+def print_comparison(report, baseline_path):
+    with open(baseline_path) as f:
+        baseline = key_numbers(json.load(f))
+    print(f"{'metric':<34}{'baseline':>12}{'this run':>12}{'change':>10}")
+    for name, value in key_numbers(report).items():
+        before = baseline.get(name)
+        change = f"{(value - before) / before * 100:+.1f}%" if before and value is not None else ''
+        print(f"{name:<34}{before if before is not None else float('nan'):>12.1f}{value if value is not None else float('nan'):>12.1f}{change:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark corpus build, ingest and /chatbot against local fakes of every upstream.")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/offline-<time>.json)")
+    parser.add_argument("--baseline", help="earlier result file to compare with")
+    parser.add_argument("--sheets", default=RECORDED_SHEETS_PATH, help="recorded sheets: a JSON file or a SMARTSHEET_SNAPSHOT_DIR")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--rounds", type=int, default=5, help="/chatbot requests per client at each concurrency level")
+    parser.add_argument("--repeat", type=int, default=3, help="corpus builds timed cold and warm")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--port", type=int, default=5057, help="port for the gunicorn server")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="fake OpenAI latency per call in seconds")
+    parser.add_argument("--pinecone-latency", type=float, default=0.05, help="fake Pinecone latency per call in seconds")
+    parser.add_argument("--smartsheet-latency", type=float, default=0.2, help="fake Smartsheet latency per call in seconds")
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp()
+    openai_fake = FakeOpenAIServer(latency=args.openai_latency)
+    pinecone_fake = FakePineconeServer(latency=args.pinecone_latency)
+    sheets_fake = FakeSmartsheetServer(load_recorded_sheets(args.sheets), latency=args.smartsheet_latency)
+    with openai_fake, pinecone_fake, sheets_fake:
+        env = {**scratch_env(scratch), **openai_fake.env(), **pinecone_fake.env(), **sheets_fake.env()}
+        os.environ.update(env)
+        import app  # after the environment points every client at the fakes
+        import research
+
+        print("Timing corpus builds...")
+        corpus = bench_corpus(app, research, sheets_fake, args.repeat)
+        print("Timing ingest...")
+        ingest_report = bench_ingest(app, openai_fake, pinecone_fake)
+        print(f"Load testing /chatbot on {args.workers} gunicorn workers...")
+        calls_before = {name: dict(fake.calls) for name, fake in (('openai', openai_fake), ('pinecone', pinecone_fake))}
+        with gunicorn(env, args.port, args.workers) as (url, log_path):
+            chatbot = run_levels(url, args.concurrency, args.rounds)
+            if errors_in(chatbot):
+                print_log(log_path)
+        chatbot_calls = {name: {kind: fake.calls[kind] - calls_before[name][kind] for kind in fake.calls}
+                         for name, fake in (('openai', openai_fake), ('pinecone', pinecone_fake))}
+
+    report = {
+        'benchmark': 'offline',
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'corpus': corpus,
+        'ingest': ingest_report,
+        'chatbot': chatbot,
+        'chatbot_upstream_calls': chatbot_calls,
+    }
+    if errors_in(chatbot):
+        print(json.dumps(report, indent=2))
+        print(f"{errors_in(chatbot)} /chatbot requests failed; not writing or comparing results", file=sys.stderr)
+        shutil.rmtree(scratch, ignore_errors=True)
+        sys.exit(1)
+    output = args.output or os.path.join(RESULTS_DIR, f"offline-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print(f"Wrote {output}")
+    if args.baseline:
+        print_comparison(report, args.baseline)
+    shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
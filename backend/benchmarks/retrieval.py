@@ -0,0 +1,86 @@
+'''
+Latency and recall comparison between the local NumPy index and Pinecone.
+
+Run from the backend directory:
+    python -m benchmarks.retrieval --synthetic 5000     # local index only, random vectors, no API keys needed
+    python -m benchmarks.retrieval --queries 50         # live: both backends, requires a saved local index
+
+The local index does exact search, so its results are used as ground truth for recall@k.
+'''
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+import clients
+import vector_store
+
+
+def percentile(samples, q):
+    return float(np.percentile(np.asarray(samples) * 1000, q)) if samples else None
+
+def time_queries(index, query_vectors, top_k, repeat):
+    '''run every query `repeat` times; returns per-call latencies (seconds) and the last result ids per query'''
+    latencies = []
+    results = []
+    for vector in query_vectors:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = index.query(vector=vector, top_k=top_k, include_metadata=True)
+            latencies.append(time.perf_counter() - start)
+        results.append([match['id'] for match in response['matches']])
+    return latencies, results
+
+def summarize(name, latencies, recall=None):
+    return {
+        'backend': name,
+        'queries': len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'mean_ms': float(np.mean(latencies) * 1000) if latencies else None,
+        'recall_at_k': recall,
+    }
+
+def recall_at_k(expected, actual):
+    hits = sum(len(set(e) & set(a)) for e, a in zip(expected, actual))
+    total = sum(len(e) for e in expected)
+    return hits / total if total else None
+
+def synthetic(args):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((args.synthetic, args.dimension), dtype=np.float32)
+    index = vector_store.LocalIndex()
+    index.upsert([(f"doc_{i}", vector, {"text": f"doc {i}"}) for i, vector in enumerate(vectors)])
+    len(index)  # merge pending rows before timing
+    picks = rng.choice(args.synthetic, size=args.queries, replace=False)
+    query_vectors = vectors[picks] + 0.1 * rng.standard_normal((args.queries, args.dimension), dtype=np.float32)
+    latencies, results = time_queries(index, query_vectors, args.top_k, args.repeat)
+    recall = float(np.mean([f"doc_{p}" in ids for p, ids in zip(picks, results)]))
+    return [summarize('local', latencies, recall)]
+
+def live(args):
+    local = vector_store.get_local_index()
+    texts = random.Random(0).sample([meta['text'] for meta in local.metadata], min(args.queries, len(local.metadata)))
+    response = clients.get_openai_client().embeddings.create(input=texts, model="text-embedding-3-large")
+    query_vectors = [item.embedding for item in response.data]
+    local_latencies, expected = time_queries(local, query_vectors, args.top_k, args.repeat)
+    remote_latencies, actual = time_queries(clients.get_index(), query_vectors, args.top_k, args.repeat)
+    return [summarize('local', local_latencies, 1.0), summarize('pinecone', remote_latencies, recall_at_k(expected, actual))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare retrieval latency and recall of the local and Pinecone backends.")
+    parser.add_argument("--synthetic", type=int, default=0, help="benchmark the local index on N random vectors instead of the live corpus")
+    parser.add_argument("--dimension", type=int, default=3072)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    report = synthetic(args) if args.synthetic else live(args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
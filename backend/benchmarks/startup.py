@@ -0,0 +1,69 @@
+'''
+Cold import time of the Flask app, i.e. what every gunicorn worker (or the master with --preload) pays on boot.
+
+Run from the backend directory:
+    python -m benchmarks.startup                 # 5 fresh interpreters, each running `import app`
+    python -m benchmarks.startup --top 15        # also list the slowest imports (python -X importtime)
+
+Importing app must not touch the network, so this works without API keys or connectivity.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_import(module, env):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', f"import {module}"], cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    error = result.stderr.strip().splitlines()[-1] if result.returncode else None
+    return elapsed, error
+
+def slowest_imports(module, env, top):
+    '''cumulative microseconds per imported package from python -X importtime'''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len('import time:'):].split('|')]
+        if not name.startswith(' ') and '.' not in name.strip():
+            rows.append((int(cumulative), name.strip()))
+    return [{'module': name, 'cumulative_ms': us / 1000} for us, name in sorted(rows, reverse=True)[:top]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the cold import time of the backend app.")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0, help="also report the N slowest top-level imports")
+    args = parser.parse_args(argv)
+    # dummy credentials: importing must succeed without real keys
+    env = dict(os.environ)
+    for name in ('SECRET_KEY', 'OPENAI_API_KEY', 'PINECONE_API_KEY'):
+        env.setdefault(name, 'unset')
+
+    samples = [time_import(args.module, env) for _ in range(args.repeat)]
+    seconds = [elapsed for elapsed, _ in samples]
+    report = {
+        'module': args.module,
+        'runs': len(samples),
+        'failures': sum(1 for _, error in samples if error),
+        'error': next((error for _, error in samples if error), None),
+        'p50_ms': float(np.percentile(seconds, 50) * 1000),
+        'max_ms': float(max(seconds) * 1000),
+    }
+    if args.top:
+        report['slowest_imports'] = slowest_imports(args.module, env, args.top)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+'''
+Lazily built OpenAI and Pinecone clients.
+
+Nothing here touches the network at import time: each client is created on first
+use, once per process, behind a lock. Under gunicorn --preload the master imports
+the app without building any client, and a client that was built before a fork
+is dropped in the child so workers never share connection pools.
+
+The OpenAI client sends every call through one pooled HTTP transport sized for the
+many requests a gevent worker keeps in flight (see gunicorn.conf.py), so concurrent
+chats reuse warm connections.
+
+Creating the Pinecone index is a provisioning step, not a request-time one:
+    python ingest.py --provision
+'''
+import os
+import threading
+
+import httpx
+from openai import OpenAI
+from pinecone import Pinecone, ServerlessSpec
+
+INDEX_NAME = os.environ.get('PINECONE_INDEX_NAME', 'updated-tax-research')
+EMBEDDING_DIMENSION = 3072  # text-embedding-3-large dimension
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', 500))  # concurrent upstream calls per process
+OPENAI_MAX_KEEPALIVE = int(os.environ.get('OPENAI_MAX_KEEPALIVE', 100))      # idle connections kept open for reuse
+
+_lock = threading.Lock()
+_openai_client = None
+_pinecone = None
+_index = None
+
+
+def _reset():
+    global _openai_client, _pinecone, _index
+    _openai_client = _pinecone = _index = None
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def get_openai_client():
+    '''the process-wide OpenAI client'''
+    global _openai_client
+    if _openai_client is None:
+        with _lock:
+            if _openai_client is None:
+                limits = httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_KEEPALIVE)
+                _openai_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"], http_client=httpx.Client(limits=limits))
+    return _openai_client
+
+def get_pinecone():
+    global _pinecone
+    if _pinecone is None:
+        with _lock:
+            if _pinecone is None:
+                _pinecone = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
+    return _pinecone
+
+def get_index():
+    '''handle to the Pinecone index; set PINECONE_INDEX_HOST to skip the host lookup on first use'''
+    global _index
+    if _index is None:
+        pc = get_pinecone()
+        with _lock:
+            if _index is None:
+                host = os.environ.get('PINECONE_INDEX_HOST')
+                _index = pc.Index(INDEX_NAME, host=host) if host else pc.Index(INDEX_NAME)
+    return _index
+
+def provision_index():
+    '''create the Pinecone index if it does not exist yet; returns True when it was created'''
+    pc = get_pinecone()
+    if INDEX_NAME in pc.list_indexes().names():
+        return False
+    pc.create_index(
+        name=INDEX_NAME,
+        dimension=EMBEDDING_DIMENSION,
+        metric='cosine',
+        spec=ServerlessSpec(cloud='aws', region='us-east-1')
+    )
+    return True
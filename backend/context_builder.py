@@ -0,0 +1,128 @@
+'''
+Token-budgeted context assembly for the completion prompt.
+
+Retrieved facts are
+    1. cut at a minimum similarity and adaptively (only facts close to the best match),
+    2. de-duplicated: exact repeats are dropped and facts that differ only by year
+       ("Alabama's 2018 NOL carryforward period is 15", "... 2019 ... is 15") are merged,
+    3. grouped by state and topic, so the state name is written once per group,
+    4. packed in relevance order until CONTEXT_TOKEN_BUDGET tokens are used.
+Tokens are counted with tiktoken when it is installed, otherwise estimated.
+'''
+import os
+import re
+from collections import OrderedDict
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1500))
+MIN_SIMILARITY = float(os.environ.get('CONTEXT_MIN_SIMILARITY', 0.2))
+SCORE_MARGIN = float(os.environ.get('CONTEXT_SCORE_MARGIN', 0.15))  # keep facts scoring within this of the best match
+COMPLETION_MODEL = "gpt-4o-mini"
+TOPIC_LABELS = {
+    'tax_rate': 'tax rates', 'cfp': 'NOL carryforward periods', 'nexus': 'economic nexus', 'exclusion': 'exclusion rates',
+    'limitation': 'NOL utilization limitations', 'methodology': 'apportionment methodology', 'pre_post': 'pre/post apportioned NOLs',
+}
+_YEAR = re.compile(r'\b(?:19|20)\d{2}\b')
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+_encoding = None
+_encoding_loaded = False
+
+
+def get_encoding():
+    '''tokenizer of the completion model, loaded on first use (tiktoken may download it); None without tiktoken'''
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            _encoding = tiktoken.encoding_for_model(COMPLETION_MODEL) if tiktoken else None
+        except Exception:  # the encoding could not be loaded, e.g. offline
+            _encoding = None
+        _encoding_loaded = True
+    return _encoding
+
+def encoding_cached():
+    '''whether tiktoken can load the tokenizer from TIKTOKEN_CACHE_DIR (pre-fetched in the Docker image) without a download'''
+    cache_dir = os.environ.get('TIKTOKEN_CACHE_DIR')
+    return bool(tiktoken and cache_dir and os.path.isdir(cache_dir) and os.listdir(cache_dir))
+
+def count_tokens(text):
+    '''tokens in text for the completion model (about 4 characters per token without tiktoken)'''
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return (len(text) + 3) // 4
+
+def select_relevant(docs, min_similarity=MIN_SIMILARITY, margin=SCORE_MARGIN):
+    '''drop facts below the similarity floor or far below the best match; docs without a score always pass'''
+    scores = [doc['score'] for doc in docs if doc.get('score') is not None]
+    if not scores:
+        return list(docs)
+    floor = max(min_similarity, max(scores) - margin)
+    return [doc for doc in docs if doc.get('score') is None or doc['score'] >= floor]
+
+def merge_duplicates(docs):
+    '''drop repeated facts and merge facts that only differ by the year they mention'''
+    merged = OrderedDict()  # masked text -> (first doc, [years])
+    for doc in docs:
+        years = _YEAR.findall(doc['text'])
+        key = (doc.get('state'), doc.get('topic'), _YEAR.sub('{year}', doc['text']))
+        if key in merged:
+            for year in years:
+                if year not in merged[key][1]:
+                    merged[key][1].append(year)
+        else:
+            merged[key] = (doc, list(years))
+    facts = []
+    for (_, _, masked), (doc, years) in merged.items():
+        text = masked.replace('{year}', ', '.join(sorted(years))) if len(years) > 1 else doc['text']
+        facts.append(dict(doc, text=text))
+    return facts
+
+def strip_state(text, state):
+    '''"Alabama's 2023 rate is 5%" -> "2023 rate is 5%" when written under an Alabama heading'''
+    prefix = f"{state}'s "
+    return text[len(prefix):] if state and text.lower().startswith(prefix.lower()) else text
+
+def build_context(docs, budget=CONTEXT_TOKEN_BUDGET, min_similarity=MIN_SIMILARITY, margin=SCORE_MARGIN):
+    '''return (context, stats) for retrieved docs ({"text", "score", "state", "topic", ...}), most relevant first'''
+    baseline_tokens = count_tokens("\n\n".join(doc['text'] for doc in docs))
+    facts = merge_duplicates(select_relevant(docs, min_similarity, margin))
+
+    groups = OrderedDict()  # (state, topic) -> (header, [lines without the state], [fact texts]), most relevant first
+    used = 0
+    kept = 0
+    for fact in facts:
+        key = (fact.get('state'), fact.get('topic'))
+        if key[0] and key[1]:
+            header = f"{key[0]} - {TOPIC_LABELS.get(key[1], key[1])}:"
+            line = strip_state(fact['text'], key[0])
+        else:
+            header, line = None, fact['text']
+        cost = count_tokens(line) + 1 + (count_tokens(header) + 1 if key not in groups and header else 0)
+        if used + cost > budget:
+            continue  # a shorter fact further down may still fit
+        groups.setdefault(key, (header, [], []))[1].append(line)
+        groups[key][2].append(fact['text'])
+        used += cost
+        kept += 1
+
+    # alphabetical by state, matching the order the answer is asked to use
+    lines = []
+    for key in sorted(groups, key=lambda key: (key[0] or '', key[1] or '')):
+        header, group_lines, texts = groups[key]
+        if header and len(group_lines) > 1:
+            lines.append(f"{header} " + "; ".join(group_lines))
+        else:
+            lines.extend(texts)  # a heading costs more than it saves for a single fact
+    context = "\n".join(lines)
+    context_tokens = count_tokens(context)
+    stats = {
+        'retrieved': len(docs),
+        'kept': kept,
+        'baseline_tokens': baseline_tokens,
+        'context_tokens': context_tokens,
+        'tokens_saved': baseline_tokens - context_tokens,
+    }
+    return context, stats
@@ -0,0 +1,229 @@
+'''
+Two-tier cache for query embeddings.
+
+Users ask the same few hundred questions over and over, so the embedding of a
+normalized question is cached:
+    1. an in-process LRU with a TTL (no I/O on a hit)
+    2. a SQLite file shared by all gunicorn workers, so a question embedded by one
+       worker is a hit for the others and survives restarts
+Requests only read the file, with a short busy timeout that turns a locked file into
+a miss; new embeddings are written by a background thread every
+EMBEDDING_CACHE_FLUSH_SECONDS, so no request (or gevent worker) waits on another
+worker's write lock.
+
+Embeddings are stored as float32 bytes (12KB for text-embedding-3-large).
+'''
+import atexit
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', os.path.join(CACHE_DIR, 'embeddings.sqlite3'))
+EMBEDDING_CACHE_SIZE = int(os.environ.get('EMBEDDING_CACHE_SIZE', 1024))
+EMBEDDING_CACHE_DISK_SIZE = int(os.environ.get('EMBEDDING_CACHE_DISK_SIZE', 100000))
+EMBEDDING_CACHE_TTL = float(os.environ.get('EMBEDDING_CACHE_TTL', 7 * 24 * 3600))
+EMBEDDING_CACHE_FLUSH_SECONDS = float(os.environ.get('EMBEDDING_CACHE_FLUSH_SECONDS', 1))
+EMBEDDING_CACHE_READ_TIMEOUT = 0.05   # seconds a request waits for a locked file before treating it as a miss
+EMBEDDING_CACHE_WRITE_TIMEOUT = 0.25  # seconds the flusher waits for another worker's write lock before trying again next flush
+
+
+def normalize_question(text):
+    '''case, surrounding whitespace/punctuation and repeated spaces do not change the embedding we want'''
+    text = re.sub(r'\s+', ' ', text.strip().lower())
+    return text.rstrip('?.! ')
+
+
+class EmbeddingCache:
+    '''size-bounded LRU with TTL in front of a shared SQLite tier'''
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL, disk_max_entries=EMBEDDING_CACHE_DISK_SIZE,
+                 flush_interval=EMBEDDING_CACHE_FLUSH_SECONDS):
+        self.path = path  # empty/None disables the disk tier
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_max_entries = disk_max_entries
+        self.flush_interval = flush_interval
+        self._memory = OrderedDict()  # key -> (stored_at, embedding)
+        self._pending = OrderedDict()  # key -> (stored_at, embedding) waiting for the next flush
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._puts = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+
+    @staticmethod
+    def key(text, model):
+        return hashlib.sha1(f"{model}\0{normalize_question(text)}".encode('utf-8')).hexdigest()
+
+    ##################################################################################################
+    #                          SQLite tier
+    ##################################################################################################
+
+    def _connection(self, timeout):
+        '''one connection per thread, re-opened after a fork so workers never share a handle; request threads only read
+        and the flush thread only writes, so each thread keeps the busy timeout it was opened with'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, stored_at REAL NOT NULL, vector BLOB NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_stored_at ON embeddings (stored_at)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _disk_get(self, key, now):
+        try:
+            row = self._connection(EMBEDDING_CACHE_READ_TIMEOUT).execute("SELECT stored_at, vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Embedding cache read failed, treated as a miss: {e}")
+            return None
+        if row is None or now - row[0] > self.ttl:
+            return None
+        return row[0], np.frombuffer(row[1], dtype=np.float32)
+
+    def _disk_put(self, key, stored_at, embedding):
+        '''queue the write for the flush thread'''
+        with self._lock:
+            self._pending[key] = (stored_at, embedding)
+            self._pending.move_to_end(key)
+            while len(self._pending) > self.max_entries:  # the file stays locked for long: drop the oldest writes
+                self._pending.popitem(last=False)
+        self.start_flusher()
+
+    def start_flusher(self):
+        '''start this process's background flush thread, once per process (threads do not survive a fork)'''
+        if self._flusher_pid == os.getpid() or not self.path:
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        atexit.register(self.flush)  # what the last interval queued when a worker stops
+        threading.Thread(target=self._flush_periodically, name='embedding-cache-flush', daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        '''write the queued embeddings; kept for the next flush if the file cannot be written'''
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        if not pending or not self.path:
+            return
+        try:
+            conn = self._connection(EMBEDDING_CACHE_WRITE_TIMEOUT)
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT OR REPLACE INTO embeddings (key, stored_at, vector) VALUES (?, ?, ?)",
+                                 [(key, stored_at, embedding.tobytes()) for key, (stored_at, embedding) in pending.items()])
+                self._puts += len(pending)
+                if self._puts >= 100:
+                    # expire old rows and keep the newest disk_max_entries
+                    self._puts = 0
+                    newest = max(stored_at for stored_at, _ in pending.values())
+                    conn.execute("DELETE FROM embeddings WHERE stored_at < ?", (newest - self.ttl,))
+                    conn.execute("DELETE FROM embeddings WHERE key NOT IN (SELECT key FROM embeddings ORDER BY stored_at DESC LIMIT ?)", (self.disk_max_entries,))
+        except sqlite3.Error as e:
+            print(f"Embedding cache write failed: {e}")
+            with self._lock:
+                for key, entry in pending.items():
+                    self._pending.setdefault(key, entry)
+
+    ##################################################################################################
+    #                          Public API
+    ##################################################################################################
+
+    def _remember(self, key, stored_at, embedding):
+        with self._lock:
+            self._memory[key] = (stored_at, embedding)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, text, model):
+        '''return the cached float32 embedding or None'''
+        key = self.key(text, model)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._memory[key]
+        if self.path:
+            entry = self._disk_get(key, now)
+            if entry is not None:
+                self._remember(key, *entry)
+                with self._lock:
+                    self.disk_hits += 1
+                return entry[1]
+        return None
+
+    def put(self, text, model, embedding):
+        key = self.key(text, model)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        stored_at = time.time()
+        self._remember(key, stored_at, embedding)
+        if self.path:
+            self._disk_put(key, stored_at, embedding)
+        return embedding
+
+    def get_or_create(self, text, model, embed_fn):
+        '''return a cached embedding, calling embed_fn(text) on a miss'''
+        embedding = self.get(text, model)
+        if embedding is not None:
+            return embedding
+        start = time.perf_counter()
+        embedding = embed_fn(text)
+        with self._lock:
+            self.miss_seconds += time.perf_counter() - start
+            self.misses += 1
+        return self.put(text, model, embedding)
+
+    def get_or_create_many(self, texts, model, embed_many_fn):
+        '''return embeddings for all texts, calling embed_many_fn(missed_texts) once for the cache misses'''
+        embeddings = [self.get(text, model) for text in texts]
+        missed = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if not missed:
+            return embeddings
+        start = time.perf_counter()
+        created = embed_many_fn([texts[i] for i in missed])
+        with self._lock:
+            self.miss_seconds += time.perf_counter() - start
+            self.misses += len(missed)
+        for i, embedding in zip(missed, created):
+            embeddings[i] = self.put(texts[i], model, embedding)
+        return embeddings
+
+    def stats(self):
+        '''hit/miss counters for this worker; saved time is estimated from the mean miss latency'''
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        mean_miss = self.miss_seconds / self.misses if self.misses else 0.0
+        return {
+            'pid': os.getpid(),
+            'entries': len(self._memory),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'mean_miss_ms': mean_miss * 1000,
+            'estimated_seconds_saved': hits * mean_miss,
+        }
@@ -0,0 +1,37 @@
+'''
+gunicorn settings, read from the working directory by `gunicorn app:app`.
+
+Workers are gevent workers by default: blocking socket I/O (the OpenAI embedding
+and completion calls, Pinecone queries) yields to other requests, so one worker
+holds up to GUNICORN_WORKER_CONNECTIONS chats in flight instead of one. Set
+GUNICORN_WORKER_CLASS=sync for the previous one-request-per-worker behaviour.
+
+The app is imported once in the master (preload) and workers fork from it, so
+library imports and the file-backed indexes are loaded once and shared
+copy-on-write. Importing the app makes no network calls; each worker builds its
+own OpenAI and Pinecone clients on first use.
+'''
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+if worker_class == 'gevent':
+    # httpcore runs `import trio` at import time when trio is installed, and trio needs select.epoll,
+    # which patch_all() removes; import the HTTP stack first (its sockets and SSL contexts are only
+    # created later, on first use, so they are still gevent's)
+    import httpcore
+    import httpx
+    # patch before the app (and with it ssl, socket and threading users) is preloaded
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = os.environ.get('GUNICORN_BIND', "0.0.0.0:5000")
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 500))
+timeout = 120
+preload_app = True
+
+
+def when_ready(server):
+    '''runs in the master after the app is loaded, before workers are forked'''
+    import app
+    app.warm_up()
@@ -0,0 +1,165 @@
+'''
+Batched embedding + upsert pipeline used to (re)build the vector store.
+
+Run from the backend directory:
+    python ingest.py --provision          # first run: create the Pinecone index if it does not exist
+    python ingest.py
+    python ingest.py --batch-size 256 --workers 8
+    python ingest.py --backend local      # build the in-process NumPy index instead
+    python ingest.py --full --reset       # wipe the index and re-embed everything
+
+Documents carry content-addressed ids (see app.make_doc) and a manifest of what is in
+each index is kept next to the caches, so a sync is a diff: only new or changed facts
+are embedded and upserted, and vectors of removed facts are deleted.
+
+Documents are embedded in large batches (the embeddings API accepts a list input),
+upserted in chunks and processed by a bounded worker pool. Rate limits and transient
+upstream errors are retried with jittered exponential backoff.
+'''
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import clients
+import vector_store
+from answer_cache import write_corpus_version
+from embedding_cache import CACHE_DIR
+from upstream import with_backoff
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBED_BATCH_SIZE = 512      # the embeddings API accepts up to 2048 inputs per request
+UPSERT_BATCH_SIZE = 100     # 100 x 3072-dim vectors stays well under Pinecone's 2MB request limit
+MAX_WORKERS = 4
+DELETE_BATCH_SIZE = 1000   # Pinecone accepts up to 1000 ids per delete
+MANIFEST_DIR = os.environ.get('MANIFEST_DIR', CACHE_DIR)
+
+
+######################################################################################################
+#                              Helper Functions
+######################################################################################################
+
+def chunked(items, size):
+    '''split a list into consecutive chunks of at most `size` items'''
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+######################################################################################################
+#                              Embed + upsert pipeline
+######################################################################################################
+
+def document_metadata(doc):
+    '''everything but the id is stored as vector metadata (Pinecone rejects null values)'''
+    return {key: value for key, value in doc.items() if key != 'id' and value is not None}
+
+def embed_batch(client, texts, model=EMBEDDING_MODEL):
+    '''embed a list of texts with a single API call, preserving input order'''
+    response = with_backoff(client.embeddings.create, input=texts, model=model)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+def upsert_vectors(index, vectors, batch_size=UPSERT_BATCH_SIZE):
+    '''upsert (id, embedding, metadata) tuples in chunks'''
+    for chunk in chunked(vectors, batch_size):
+        with_backoff(index.upsert, vectors=chunk)
+
+def process_batch(client, index, docs, upsert_batch_size=UPSERT_BATCH_SIZE):
+    '''embed one batch of documents and upsert the resulting vectors'''
+    embeddings = embed_batch(client, [doc['text'] for doc in docs])
+    vectors = [(doc['id'], embedding, document_metadata(doc)) for doc, embedding in zip(docs, embeddings)]
+    upsert_vectors(index, vectors, upsert_batch_size)
+    return len(vectors)
+
+def run_pipeline(docs, client, index, batch_size=EMBED_BATCH_SIZE, workers=MAX_WORKERS, upsert_batch_size=UPSERT_BATCH_SIZE):
+    '''embed and upsert every document using a bounded worker pool; returns the number of vectors written'''
+    total = len(docs)
+    done = 0
+    start = time.perf_counter()
+    print(f"Indexing {total} documents in batches of {batch_size} with {workers} workers...")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(process_batch, client, index, docs[offset:offset + batch_size], upsert_batch_size)
+            for offset in range(0, total, batch_size)
+        ]
+        for future in as_completed(futures):
+            done += future.result()
+            print(f"Indexed {done}/{total} documents ({time.perf_counter() - start:.1f}s)")
+    print(f"Finished indexing {done} documents in {time.perf_counter() - start:.1f}s")
+    return done
+
+
+######################################################################################################
+#                              Incremental sync
+######################################################################################################
+
+def manifest_path(backend):
+    return os.path.join(MANIFEST_DIR, f"manifest_{backend}.json")
+
+def load_manifest(path):
+    '''ids (and metadata) of every document currently in the index'''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+def sync(docs, client, index, path, full=False, batch_size=EMBED_BATCH_SIZE, workers=MAX_WORKERS, upsert_batch_size=UPSERT_BATCH_SIZE):
+    '''make the index match docs: embed only documents missing from the manifest and delete removed ones, then stamp
+    the corpus version, which invalidates every worker's answer cache'''
+    current = {doc['id']: doc for doc in docs}
+    manifest = load_manifest(path)
+    added = list(current.values()) if full else [doc for doc_id, doc in current.items() if doc_id not in manifest]
+    removed = [doc_id for doc_id in manifest if doc_id not in current]
+    print(f"Sync: {len(added)} to embed, {len(removed)} to delete, {len(current) - len(added)} unchanged")
+    if added:
+        run_pipeline(added, client, index, batch_size, workers, upsert_batch_size)
+    for chunk in chunked(removed, DELETE_BATCH_SIZE):
+        with_backoff(index.delete, ids=chunk)
+    save_manifest(path, {doc_id: document_metadata(doc) for doc_id, doc in current.items()})
+    version = write_corpus_version(sorted(current))
+    return {'added': len(added), 'removed': len(removed), 'unchanged': len(current) - len(added), 'corpus_version': version}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Embed the Smartsheets research corpus and upsert it into the vector store.")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="documents per embeddings API call")
+    parser.add_argument("--upsert-batch-size", type=int, default=UPSERT_BATCH_SIZE, help="vectors per upsert request")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="concurrent embed/upsert batches")
+    parser.add_argument("--backend", choices=["pinecone", "local"], default=os.environ.get('VECTOR_BACKEND', 'pinecone'), help="vector store to populate")
+    parser.add_argument("--full", action="store_true", help="re-embed every document instead of only new or changed ones")
+    parser.add_argument("--provision", action="store_true", help="create the Pinecone index first if it does not exist")
+    parser.add_argument("--reset", action="store_true", help="delete every vector in the index first, e.g. to drop vectors stored under old positional ids, then re-embed everything")
+    args = parser.parse_args(argv)
+
+    import app  # imported here so the pipeline helpers can be used without loading the app
+    path = manifest_path(args.backend)
+    if args.backend == 'local':
+        try:
+            target = vector_store.LocalIndex.load(vector_store.VECTOR_STORE_DIR, mmap=False)
+        except OSError:
+            target = vector_store.LocalIndex()
+            save_manifest(path, {})  # nothing has been indexed locally yet
+    else:
+        if args.provision and clients.provision_index():
+            print(f"Created Pinecone index {clients.INDEX_NAME}")
+        target = clients.get_index()
+    if args.reset:
+        print("Deleting every vector in the index...")
+        target.delete(delete_all=True)
+        save_manifest(path, {})
+    docs = app.get_research()
+    result = sync(docs, clients.get_openai_client(), target, path, args.full, args.batch_size, args.workers, args.upsert_batch_size)
+    if args.backend == 'local':
+        target.save(vector_store.VECTOR_STORE_DIR)
+        print(f"Saved local index to {vector_store.VECTOR_STORE_DIR}")
+    print(f"Corpus version {result['corpus_version']}")
+
+
+if __name__ == "__main__":
+    main()
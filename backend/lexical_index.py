@@ -0,0 +1,143 @@
+'''
+In-memory BM25 inverted index over the research facts.
+
+Tax questions hinge on exact tokens (state names, years, "FDII", "Section 78",
+"Subpart F") that embeddings blur: "Alabama 2023 rate" and "Alaska 2023 rate" are
+close neighbours in embedding space but share no state token. The index is built
+from the ingest manifest, i.e. the facts get_research() produced, and is either
+used on its own (RETRIEVAL_MODE=lexical: no embedding call, so retrieval keeps
+working when the embeddings API is slow or down) or fused with the vector results
+by reciprocal rank fusion (RETRIEVAL_MODE=hybrid).
+'''
+import json
+import math
+import os
+import re
+import threading
+from collections import defaultdict
+from functools import partial
+
+import numpy as np
+
+from query_analyzer import analyze_question
+from vector_store import filter_mask
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60  # rank constant from the original reciprocal rank fusion paper
+
+STOP_WORDS = frozenset('a an and are as at be by can do does for from has have how i in is it its my of on or per the their to was what when which with'.split())
+_TOKEN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+_POSSESSIVE = re.compile(r"'s\b")
+
+
+def tokenize(text):
+    '''lower-case words and numbers without stop words, plus adjacent word pairs ("west virginia", "subpart f", "section 78")'''
+    words = [word for word in _TOKEN.findall(_POSSESSIVE.sub('', text.lower())) if word not in STOP_WORDS]
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+def query_terms(query):
+    '''distinct terms of a question; states named by postal code ("AL") are searched by name'''
+    terms = set(tokenize(query))
+    for state in analyze_question(query)['states']:
+        terms.update(tokenize(state))
+    return terms
+
+def reciprocal_rank_fusion(*rankings, k=RRF_K, top_k=None):
+    '''merge ranked lists of docs (each with an "id") by the sum of 1 / (k + rank);
+    a doc keeps the fields of its first appearance, so pass the vector results first to keep their similarity "score"'''
+    fused = {}
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, 1):
+            scores[doc['id']] += 1.0 / (k + rank)
+            fused[doc['id']] = dict(doc, **fused.get(doc['id'], {}))
+    ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [dict(fused[doc_id], rrf_score=scores[doc_id]) for doc_id in ranked]
+
+
+class LexicalIndex:
+    '''BM25 over fact texts; postings hold precomputed per-document term weights so a query is a few vector adds'''
+
+    def __init__(self, path=None, k1=BM25_K1, b=BM25_B):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.build([])
+
+    def __len__(self):
+        self._refresh()
+        return len(self._snapshot[0])
+
+    def build(self, docs):
+        '''index docs ({"id", "text", ...metadata}) in place of the current contents'''
+        ids = [doc['id'] for doc in docs]
+        metadata = [{key: value for key, value in doc.items() if key != 'id'} for doc in docs]
+        term_counts = [defaultdict(int) for _ in docs]
+        for counts, doc in zip(term_counts, docs):
+            for term in tokenize(doc['text']):
+                counts[term] += 1
+        lengths = np.array([sum(counts.values()) for counts in term_counts], dtype=np.float32)
+        average_length = float(lengths.mean()) if len(docs) else 0.0
+        postings = defaultdict(lambda: ([], []))
+        for position, counts in enumerate(term_counts):
+            for term, count in counts.items():
+                postings[term][0].append(position)
+                postings[term][1].append(count)
+        weights = {}
+        for term, (positions, counts) in postings.items():
+            positions = np.array(positions)
+            counts = np.array(counts, dtype=np.float32)
+            idf = math.log(1 + (len(docs) - len(positions) + 0.5) / (len(positions) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths[positions] / average_length)
+            weights[term] = (positions, idf * counts * (self.k1 + 1) / (counts + norm))
+        # swapped in one assignment so a concurrent search never mixes old postings with new ids
+        self._snapshot = (ids, metadata, weights, {})
+
+    def _refresh(self):
+        '''(re)build when ingest has written a new manifest'''
+        if self.path is None:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            with open(self.path) as f:
+                manifest = json.load(f)
+            self.build([dict(doc, id=doc_id) for doc_id, doc in manifest.items() if doc.get('text')])
+            self._mtime = mtime
+
+    @staticmethod
+    def _column(metadata, columns, field):
+        '''metadata field as an object array, cached per snapshot'''
+        column = columns.get(field)
+        if column is None:
+            column = np.array([meta.get(field) for meta in metadata], dtype=object)
+            columns[field] = column
+        return column
+
+    def search(self, query, top_k, metadata_filter=None):
+        '''top_k facts containing any query term, best BM25 first, as {"id", "lexical_score", ...metadata}'''
+        self._refresh()
+        ids, metadata, postings, columns = self._snapshot
+        if not ids:
+            return []
+        scores = np.zeros(len(ids), dtype=np.float32)
+        for term in query_terms(query):
+            posting = postings.get(term)
+            if posting is not None:
+                scores[posting[0]] += posting[1]
+        if metadata_filter:
+            scores[~filter_mask(partial(self._column, metadata, columns), len(ids), metadata_filter)] = 0.0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        ranked = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [dict(metadata[i], id=ids[i], lexical_score=float(scores[i])) for i in ranked]
@@ -0,0 +1,360 @@
+'''
+Per-request tracing and Prometheus metrics.
+
+Every chatbot request gets a Trace that collects
+    - the time spent in each stage (embedding, retrieval, vector query, context build, completion),
+    - the prompt and completion tokens from the OpenAI usage field, and their estimated cost,
+    - how many facts went into the context and whether the embedding and answer caches hit.
+When the request ends the trace is logged as one JSON line on stdout and folded into
+histograms and counters.
+
+The aggregates of each process are kept in memory and added to a SQLite file shared by all
+gunicorn workers (METRICS_PATH) by a background thread every METRICS_FLUSH_SECONDS, so
+GET /metrics reports totals for the whole server whichever worker serves it. Chat requests
+never write to the file: a write waiting on another worker's lock would stall every greenlet
+of a gevent worker. An empty METRICS_PATH keeps the aggregates per process.
+
+Set PROFILE_SLOW_REQUESTS_MS to profile requests with pyinstrument (a sampling profiler,
+`pip install pyinstrument`) and save the profile of every request slower than that
+under PROFILE_DIR.
+'''
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+METRICS_PATH = os.environ.get('METRICS_PATH', os.path.join(CACHE_DIR, 'metrics.sqlite3'))
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+METRICS_WRITE_TIMEOUT = 0.25  # seconds to wait for another worker's write lock before trying again next flush
+PROFILE_SLOW_REQUESTS_MS = float(os.environ.get('PROFILE_SLOW_REQUESTS_MS', 0))  # 0 disables profiling
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(CACHE_DIR, 'profiles'))
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DOCS_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# USD per million (prompt, completion) tokens, list prices when this was written
+PRICES_PER_MILLION = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'text-embedding-3-large': (0.13, 0.0),
+}
+
+HISTOGRAMS = {
+    'chatbot_request_seconds': ("Time to answer a request, by endpoint and answer path", SECONDS_BUCKETS),
+    'chatbot_stage_seconds': ("Time spent in each stage of answering a question", SECONDS_BUCKETS),
+    'chatbot_context_docs': ("Facts placed in the completion context", DOCS_BUCKETS),
+}
+COUNTERS = {
+    'chatbot_tokens_total': "Tokens reported in the OpenAI usage field, by model and kind",
+    'chatbot_cost_dollars_total': "Estimated OpenAI spend from token usage and list prices, by model",
+    'chatbot_cache_total': "Cache lookups, by cache and result",
+}
+
+
+def label_string(labels):
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ",".join(f'{name}="{escape(value)}"' for name, value in sorted(labels.items()))
+
+def braced(labels):
+    return "{" + labels + "}" if labels else ""
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+######################################################################################################
+#                              Aggregates
+######################################################################################################
+
+class Registry:
+    '''histograms and counters as rows (name, labels, le) -> value; bucket rows count the observations that fell
+    in that bucket only and are made cumulative when rendered. Increments are kept in memory until flush(), which a
+    background thread of each process runs every `flush_interval` seconds (see start_flusher)'''
+
+    def __init__(self, path=METRICS_PATH, flush_interval=METRICS_FLUSH_SECONDS):
+        self.path = path  # empty/None keeps the aggregates in this process
+        self.flush_interval = flush_interval
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pending = defaultdict(float)
+        self._totals = defaultdict(float)
+
+    def _connection(self):
+        '''one connection per thread, re-opened after a fork so workers never share a handle'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=METRICS_WRITE_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS metrics (name TEXT NOT NULL, labels TEXT NOT NULL, le TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (name, labels, le))")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def start_flusher(self):
+        '''start this process's background flush thread, once per process (gunicorn workers fork from a preloaded
+        master, and threads do not survive a fork)'''
+        if self._flusher_pid == os.getpid() or not self.path:
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_periodically, name='metrics-flush', daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._pending[(name, label_string(labels), '')] += amount
+
+    def observe(self, name, value, **labels):
+        buckets = HISTOGRAMS[name][1]
+        le = next((format_value(bound) for bound in buckets if value <= bound), '+Inf')
+        labels = label_string(labels)
+        with self._lock:
+            self._pending[(name + '_bucket', labels, le)] += 1
+            self._pending[(name + '_sum', labels, '')] += value
+            self._pending[(name + '_count', labels, '')] += 1
+
+    def flush(self):
+        '''add the pending increments to the shared totals; kept for the next flush if the file cannot be written'''
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+        if not pending:
+            return
+        if not self.path:
+            with self._lock:
+                for key, amount in pending.items():
+                    self._totals[key] += amount
+            return
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT INTO metrics (name, labels, le, value) VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT (name, labels, le) DO UPDATE SET value = value + excluded.value",
+                                 [(*key, amount) for key, amount in pending.items()])
+        except sqlite3.Error as e:
+            print(f"Metrics write failed: {e}")
+            with self._lock:
+                for key, amount in pending.items():
+                    self._pending[key] += amount
+
+    def totals(self):
+        '''{(name, labels, le): value} for every process sharing the metrics file'''
+        self.flush()
+        if not self.path:
+            with self._lock:
+                return dict(self._totals)
+        try:
+            rows = self._connection().execute("SELECT name, labels, le, value FROM metrics").fetchall()
+        except sqlite3.Error as e:
+            print(f"Metrics read failed: {e}")
+            return {}
+        return {(name, labels, le): value for name, labels, le, value in rows}
+
+    def render(self):
+        '''the aggregates in the Prometheus text exposition format'''
+        totals = self.totals()
+        lines = []
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for labels in sorted({labels for (series, labels, _) in totals if series == name + '_count'}):
+                prefix = labels + "," if labels else ""
+                cumulative = 0
+                for bound in [format_value(bound) for bound in buckets] + ['+Inf']:
+                    cumulative += totals.get((name + '_bucket', labels, bound), 0)
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {format_value(cumulative)}')
+                lines.append(f"{name}_sum{braced(labels)} {format_value(totals[(name + '_sum', labels, '')])}")
+                lines.append(f"{name}_count{braced(labels)} {format_value(totals[(name + '_count', labels, '')])}")
+        for name, help_text in COUNTERS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (series, labels, _), value in sorted(totals.items()):
+                if series == name:
+                    lines.append(f"{name}{braced(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+atexit.register(registry.flush)  # what the last interval collected when a worker stops
+
+
+######################################################################################################
+#                              Request traces
+######################################################################################################
+
+class Trace:
+    '''what one request spent; see finish_trace'''
+
+    def __init__(self, endpoint, profile=True, **fields):
+        self.endpoint = endpoint
+        self.fields = fields
+        self.start = time.perf_counter()
+        self.stages = defaultdict(float)
+        self.tokens = defaultdict(int)
+        self.cost = 0.0
+        self.cache = {}
+        self.finished = False
+        self.profiler = start_profiler() if profile else None
+
+    def merge(self, other):
+        '''add what a trace recorded on another thread (see run_traced) to this one; stage times are summed, so
+        stages that ran in parallel can add up to more than the request took. Cache lookups become counts,
+        e.g. {"answer": {"hit": 2, "miss": 1}}'''
+        for name, seconds in other.stages.items():
+            self.stages[name] += seconds
+        for kind, count in other.tokens.items():
+            self.tokens[kind] += count
+        self.cost += other.cost
+        for cache, result in other.cache.items():
+            counts = self.cache.get(cache)
+            if not isinstance(counts, dict):
+                counts = self.cache[cache] = {counts: 1} if counts else {}
+            counts[result] = counts.get(result, 0) + 1
+
+
+_local = threading.local()  # the trace of the request this thread (or greenlet) is serving
+_profiler_missing_reported = False
+
+
+def start_profiler():
+    global _profiler_missing_reported
+    if PROFILE_SLOW_REQUESTS_MS <= 0:
+        return None
+    if Profiler is None:
+        if not _profiler_missing_reported:
+            print("PROFILE_SLOW_REQUESTS_MS is set but pyinstrument is not installed; requests are not profiled")
+            _profiler_missing_reported = True
+        return None
+    try:
+        profiler = Profiler(async_mode='disabled')
+        profiler.start()
+        return profiler
+    except RuntimeError:  # another request on this thread is being profiled (gevent workers run many per thread)
+        return None
+
+def start_trace(endpoint, **fields):
+    trace = Trace(endpoint, **fields)
+    _local.trace = trace
+    return trace
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+def run_traced(fn, *args):
+    '''fn(*args) on a pool thread, recording its stages, tokens and cache lookups on a trace of its own (the request's
+    trace is local to the request thread); returns (result, trace) for the request thread to merge'''
+    trace = Trace('worker', profile=False)
+    _local.trace = trace
+    try:
+        return fn(*args), trace
+    finally:
+        _local.trace = None
+
+def annotate(**fields):
+    '''add fields (question, answer path, ...) to the current request's log line'''
+    trace = current_trace()
+    if trace is not None:
+        trace.fields.update(fields)
+
+@contextmanager
+def stage(name):
+    '''time a stage of answering; recorded in the aggregates even outside a request'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+def record_stage(name, seconds):
+    registry.observe('chatbot_stage_seconds', seconds, stage=name)
+    trace = current_trace()
+    if trace is not None:
+        trace.stages[name] += seconds
+
+def record_usage(model, usage):
+    '''count the tokens of an OpenAI response usage field (embeddings report prompt tokens only)'''
+    if usage is None:
+        return
+    prompt_price, completion_price = PRICES_PER_MILLION.get(model, (0.0, 0.0))
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+    registry.inc('chatbot_tokens_total', prompt_tokens, model=model, kind='prompt')
+    if completion_tokens:
+        registry.inc('chatbot_tokens_total', completion_tokens, model=model, kind='completion')
+    registry.inc('chatbot_cost_dollars_total', cost, model=model)
+    trace = current_trace()
+    if trace is not None:
+        trace.tokens['prompt'] += prompt_tokens
+        trace.tokens['completion'] += completion_tokens
+        trace.cost += cost
+
+def with_usage(model, create):
+    '''wrap an OpenAI create() so each response's usage is counted once, also when coalesced callers share it'''
+    def call(*args, **kwargs):
+        response = create(*args, **kwargs)
+        record_usage(model, getattr(response, 'usage', None))
+        return response
+    return call
+
+def record_cache(cache, result):
+    '''result: "hit", "miss" or "bypass"'''
+    registry.inc('chatbot_cache_total', cache=cache, result=result)
+    trace = current_trace()
+    if trace is not None:
+        trace.cache[cache] = result
+
+def record_context(kept, retrieved):
+    registry.observe('chatbot_context_docs', kept)
+    annotate(context_docs=kept, retrieved_docs=retrieved)
+
+def finish_trace(trace, status=200, **fields):
+    '''log the request as one JSON line and add it to the aggregates; runs once per trace'''
+    if trace.finished:
+        return
+    trace.finished = True
+    trace.fields.update(fields)
+    elapsed = time.perf_counter() - trace.start
+    registry.observe('chatbot_request_seconds', elapsed, endpoint=trace.endpoint, path=trace.fields.get('path') or 'none')
+    record = {
+        'event': 'request',
+        'endpoint': trace.endpoint,
+        'status': status,
+        'total_ms': round(elapsed * 1000, 1),
+        'stages_ms': {name: round(seconds * 1000, 1) for name, seconds in trace.stages.items()},
+        'tokens': dict(trace.tokens),
+        'cost_usd': round(trace.cost, 6),
+        'cache': trace.cache,
+        **trace.fields,
+    }
+    if trace.profiler is not None:
+        trace.profiler.stop()
+        if elapsed * 1000 >= PROFILE_SLOW_REQUESTS_MS:
+            record['profile'] = save_profile(trace, elapsed)
+    print(json.dumps(record, default=str), flush=True)
+    if current_trace() is trace:
+        _local.trace = None
+    registry.start_flusher()
+
+def save_profile(trace, elapsed):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{trace.endpoint}-{elapsed * 1000:.0f}ms.html")
+    with open(path, 'w') as f:
+        f.write(trace.profiler.output_html())
+    return path
@@ -0,0 +1,177 @@
+'''
+Fast rule-based analysis of a user question.
+
+Picks out the states (from research.state_listing), research topics and years a
+question is about. The result becomes a metadata filter on the vector query, or an
+exact lookup in the in-memory FactIndex (state -> topic -> year -> facts), so a
+question about one state's 2023 rate no longer drags dozens of unrelated facts into
+the prompt.
+'''
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+
+from research import state_listing
+
+TOPICS = ['tax_rate', 'cfp', 'nexus', 'exclusion', 'limitation', 'methodology', 'pre_post']
+ANY_YEAR = 'any'  # year stored on facts that do not vary by year (nexus thresholds, pre/post NOL)
+
+# tax rate and methodology facts come in three periods, stored as their `period` field: the compliance rate of the
+# provision year, the current provision rate of the year after, and the deferred rate, which has no tax year
+PERIOD_TOPICS = {'tax_rate', 'methodology'}
+PERIOD_ALIASES = {'compliance': 'compliance', 'current': 'current', 'deferred': 'deferred', 'future': 'deferred'}
+PERIOD_LABELS = {'compliance': 'compliance', 'current': 'current provision', 'deferred': 'deferred (future)'}
+FUTURE_YEAR = 'future'  # year stored on deferred facts
+
+STATE_ABBREVIATIONS = {
+    'AL': 'Alabama', 'AK': 'Alaska', 'AZ': 'Arizona', 'AR': 'Arkansas', 'CA': 'California', 'CO': 'Colorado',
+    'CT': 'Connecticut', 'DE': 'Delaware', 'DC': 'District of Columbia', 'FL': 'Florida', 'GA': 'Georgia',
+    'HI': 'Hawaii', 'ID': 'Idaho', 'IL': 'Illinois', 'IN': 'Indiana', 'IA': 'Iowa', 'KS': 'Kansas',
+    'KY': 'Kentucky', 'LA': 'Louisiana', 'ME': 'Maine', 'MD': 'Maryland', 'MA': 'Massachusetts',
+    'MI': 'Michigan', 'MN': 'Minnesota', 'MS': 'Mississippi', 'MO': 'Missouri', 'MT': 'Montana',
+    'NE': 'Nebraska', 'NV': 'Nevada', 'NH': 'New Hampshire', 'NJ': 'New Jersey', 'NM': 'New Mexico',
+    'NY': 'New York', 'NC': 'North Carolina', 'ND': 'North Dakota', 'OH': 'Ohio', 'OK': 'Oklahoma',
+    'OR': 'Oregon', 'PA': 'Pennsylvania', 'RI': 'Rhode Island', 'SC': 'South Carolina', 'SD': 'South Dakota',
+    'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah', 'VT': 'Vermont', 'VA': 'Virginia', 'WA': 'Washington',
+    'WV': 'West Virginia', 'WI': 'Wisconsin', 'WY': 'Wyoming',
+}
+
+# rows of the research sheets that are not states; their names are ordinary words ("foreign dividends", "other states")
+PSEUDO_STATES = {'Foreign', 'Other'}
+
+_STATES_BY_NAME = {state.lower(): state for state in state_listing}
+# longest names first so "West Virginia" wins over "Virginia"
+_STATE_NAMES = re.compile(r'\b(' + '|'.join(re.escape(state) for state in sorted(_STATES_BY_NAME, key=len, reverse=True)
+                                             if _STATES_BY_NAME[state] not in PSEUDO_STATES) + r')\b', re.I)
+# postal codes only count in upper case and as whole tokens
+_STATE_CODES = re.compile(r'\b(' + '|'.join(STATE_ABBREVIATIONS) + r')\b')
+# codes that are also common words or abbreviations ("IN", "OR", "ME", "OK", "ID", "CO", ...) additionally need
+# state or tax context: "the rate in OR", "CA, OR", "OR's rate", "OK tax rate"
+AMBIGUOUS_CODES = {'CO', 'DE', 'HI', 'ID', 'IN', 'LA', 'MA', 'ME', 'OH', 'OK', 'OR', 'PA'}
+_CODE_CONTEXT_BEFORE = re.compile(r'(?:\b(?:in|for|of|from|vs\.?|versus|and)|\b[A-Z]{2},)\s*$')
+_CODE_CONTEXT_AFTER = re.compile(r"^(?:'s\b|\s+(?:corporate\s+|state\s+)?(?:tax|rates?\b|nexus|apportion|nols?\b|net operating|methodolog|exclu|carry[- ]?forward|limitation))", re.I)
+_YEARS = re.compile(r'\b((?:19|20)\d{2})\b')
+_PERIODS = re.compile(r'\b(' + '|'.join(PERIOD_ALIASES) + r')\b', re.I)
+_NOL = re.compile(r'\bnols?\b|net operating loss', re.I)
+# questions that measure the named states against others need facts about every state
+_COMPARATIVE = re.compile(r'\b(compar\w*|versus|vs\.?|(?:higher|lower|greater|more|less) than|highest|lowest|other states|all states|which states|rank\w*)(?!\w)', re.I)
+
+TOPIC_PATTERNS = {
+    'exclusion': re.compile(r'exclu|subpart f|section 78|\b78\b|gross[- ]?up|foreign dividend|\bfdii\b', re.I),
+    'cfp': re.compile(r'carry[- ]?forward|\bcfp\b|expir', re.I),
+    'limitation': re.compile(r'limitation|\blimit|utiliz', re.I),
+    'pre_post': re.compile(r'\bpre\b|\bpost\b|pre[- ]apportion|post[- ]apportion|apportioned basis', re.I),
+    'methodology': re.compile(r'apportionment|methodolog|\bmethod|sales factor|three[- ]factor|formula', re.I),
+    'nexus': re.compile(r'nexus|threshold', re.I),
+    'tax_rate': re.compile(r'(?<!exclusion )\brates?\b|tax rate', re.I),
+}
+
+
+def canonical_state(name):
+    '''map any capitalisation of a state name (exclusion rows are lower case) onto research.state_listing'''
+    return _STATES_BY_NAME.get(str(name).strip().lower(), name)
+
+def state_codes(question):
+    '''states named by postal code, in order; ambiguous codes only with state or tax context around them'''
+    states = []
+    for match in _STATE_CODES.finditer(question):
+        code = match.group(1)
+        if code in AMBIGUOUS_CODES and not (_CODE_CONTEXT_BEFORE.search(question, 0, match.start())
+                                            or _CODE_CONTEXT_AFTER.match(question[match.end():])):
+            continue
+        states.append(STATE_ABBREVIATIONS[code])
+    return states
+
+def analyze_question(question):
+    '''return {"states": [...], "topics": [...], "years": [...], "periods": [...]} in order of first mention'''
+    states = [canonical_state(match) for match in _STATE_NAMES.findall(question)]
+    states += state_codes(question)
+    topics = [topic for topic, pattern in TOPIC_PATTERNS.items() if pattern.search(question)]
+    if 'pre_post' in topics and 'methodology' in topics and re.search(r'apportioned basis|pre[- ]apportion|post[- ]apportion', question, re.I):
+        topics.remove('methodology')
+    if not topics and _NOL.search(question):
+        topics = ['cfp', 'limitation', 'pre_post']
+    periods = [PERIOD_ALIASES[period.lower()] for period in _PERIODS.findall(question)]
+    return {
+        'states': list(dict.fromkeys(states)),
+        'topics': list(dict.fromkeys(topics)),
+        'years': list(dict.fromkeys(_YEARS.findall(question))),
+        'periods': list(dict.fromkeys(periods)),
+    }
+
+def is_comparative(question):
+    '''"Which states have a higher rate than Texas?", "How does Texas compare with other states?"'''
+    return bool(_COMPARATIVE.search(question))
+
+def period_applies(analysis):
+    '''periods named in the question only narrow topics that have periods ("current" is also an everyday word)'''
+    return bool(analysis['periods']) and bool(analysis['topics']) and set(analysis['topics']) <= PERIOD_TOPICS
+
+def metadata_filter(analysis):
+    '''Pinecone-style metadata filter for an analysis, or None when nothing was recognised'''
+    clauses = {}
+    if analysis['states']:
+        clauses['state'] = {'$in': analysis['states']}
+    if analysis['topics']:
+        clauses['topic'] = {'$in': analysis['topics']}
+    if analysis['years']:
+        clauses['year'] = {'$in': analysis['years'] + [ANY_YEAR]}
+    if period_applies(analysis):
+        clauses['period'] = {'$in': analysis['periods']}
+    return clauses or None
+
+
+class FactIndex:
+    '''in-memory state -> topic -> year -> [fact] index built from the ingest manifest'''
+
+    def __init__(self, path):
+        self.path = path
+        self._facts = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        '''(re)load when ingest has written a new manifest'''
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            with open(self.path) as f:
+                manifest = json.load(f)
+            facts = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+            for doc in manifest.values():
+                if doc.get('state') and doc.get('topic'):
+                    facts[doc['state']][doc['topic']][doc.get('year', ANY_YEAR)].append(doc)
+            self._facts = facts
+            self._mtime = mtime
+
+    def __len__(self):
+        self._refresh()
+        return sum(len(docs) for topics in self._facts.values() for years in topics.values() for docs in years.values())
+
+    def facts(self, state, topic):
+        '''{year: [fact, ...]} for one state and topic'''
+        self._refresh()
+        return self._facts.get(state, {}).get(topic, {})
+
+    def lookup(self, analysis):
+        '''exact facts for questions naming both states and topics; None when the question is too open for a lookup'''
+        if not analysis['states'] or not analysis['topics']:
+            return None
+        self._refresh()
+        years = set(analysis['years'])
+        periods = set(analysis['periods']) if period_applies(analysis) else None
+        found = []
+        for state in analysis['states']:
+            for topic in analysis['topics']:
+                for year, docs in self._facts.get(state, {}).get(topic, {}).items():
+                    if not years or year in years or year == ANY_YEAR:
+                        found.extend(doc for doc in docs if not periods or doc.get('period') in periods)
+        return found or None
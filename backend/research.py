@@ -3,31 +3,199 @@ from dotenv import load_dotenv
 load_dotenv()
 state_listing = ['Alabama',	'Alaska',	'Arizona',	'Arkansas',	'California',	'Colorado',	'Connecticut',	'Delaware',	'District of Columbia',	'Florida',	'Georgia',	'Hawaii',	'Idaho',	'Illinois',	'Indiana',	'Iowa',	'Kansas',	'Kentucky',	'Louisiana',	'Maine',	'Maryland',	'Massachusetts',	'Michigan',	'Minnesota',	'Mississippi',	'Missouri',	'Montana',	'Nebraska',	'Nevada',	'New Hampshire',	'New Jersey',	'New Mexico',	'New York',	'North Carolina',	'North Dakota',	'Ohio',	'Oklahoma',	'Oregon',	'Pennsylvania',	'Rhode Island',	'South Carolina',	'South Dakota',	'Tennessee',	'Texas',	'Utah',	'Vermont',	'Virginia',	'Washington',	'West Virginia',	'Wisconsin', 'Wyoming',	'Foreign',	'Other']
 import requests
+import hashlib
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 
-def import_exclusion_rates_from_ss(tax_year):
-    url = os.environ['ss_url'] + os.environ['exclusions_sheet']
-    header = {"Authorization": "Bearer " + os.environ['ss_token']}
-    r = requests.get(url, headers=header)
+import numpy as np
+import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+######################################################################################################
+#                              Smartsheet loader
+######################################################################################################
+''' all sheets are fetched through one pooled session, concurrently, with conditional requests against a
+local JSON snapshot of each sheet. Unchanged sheets are served from the snapshot and are not re-parsed. '''
+SHEETS = ['exclusions_sheet', 'nexus_sheet', 'pre_post_sheet', 'tax_rates_sheet', 'cfp_sheet', 'limitations_sheet', 'methods_sheet']
+SNAPSHOT_DIR = os.environ.get('SMARTSHEET_SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'smartsheets'))
+REQUEST_TIMEOUT = float(os.environ.get('SMARTSHEET_TIMEOUT', 30))
+
+_session = None
+_session_lock = threading.Lock()
+_sheets = {}  # sheet name -> snapshot {'etag', 'last_modified', 'version', 'digest', 'data'}
+_parsed = {}  # (parser, args) -> (snapshot digest, parsed result)
+
+def get_session():
+    '''one pooled session shared by every sheet request, retrying rate limits and server errors'''
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+            adapter = HTTPAdapter(pool_connections=len(SHEETS), pool_maxsize=len(SHEETS), max_retries=retries)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({"Authorization": "Bearer " + os.environ['ss_token']})
+            _session = session
+    return _session
+
+def snapshot_path(sheet):
+    return os.path.join(SNAPSHOT_DIR, f"{sheet}_{os.environ[sheet]}.json")
+
+def read_snapshot(sheet):
+    try:
+        with open(snapshot_path(sheet)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_snapshot(sheet, snapshot):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = snapshot_path(sheet)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + '.tmp', path)
+
+def sheet_unchanged(url, snapshot):
+    '''conditional check against the snapshot: ETag/Last-Modified when the API sent them, otherwise the sheet version number'''
+    headers = {}
+    if snapshot.get('etag'):
+        headers['If-None-Match'] = snapshot['etag']
+    if snapshot.get('last_modified'):
+        headers['If-Modified-Since'] = snapshot['last_modified']
+    if headers:
+        return None, headers
+    if snapshot.get('version') is not None:
+        r = get_session().get(url.rstrip('/') + '/version', timeout=REQUEST_TIMEOUT)
+        if r.ok and r.json().get('version') == snapshot['version']:
+            return True, headers
+    return False, headers
+
+def fetch_sheet(sheet):
+    '''download a sheet unless the local snapshot is still current; returns the snapshot'''
+    url = os.environ['ss_url'] + os.environ[sheet]
+    snapshot = _sheets.get(sheet) or read_snapshot(sheet)
+    headers = {}
+    try:
+        if snapshot:
+            unchanged, headers = sheet_unchanged(url, snapshot)
+            if unchanged:
+                return snapshot
+        r = get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if r.status_code == 304 and snapshot:
+            return snapshot
+        r.raise_for_status()
+    except requests.RequestException as e:
+        if snapshot:
+            print(f"Error fetching {sheet}, using local snapshot: {e}")
+            return snapshot
+        raise
     response = r.json()
-    results = {}
-    for state in state_listing:
-        results[state.lower()] = {}
-    for column in response["columns"]:
-        if column['title'] == tax_year:
-            column_index = int(column['index'])
-            for row in response["rows"]:
-                category = row["cells"][1]["value"]
-                exclusion_rate = row["cells"][column_index]["value"]
-                state = row["cells"][0]["value"]
-                results[state].update({category: exclusion_rate})
-    return results
+    snapshot = {
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'version': response.get('version'),
+        'digest': hashlib.sha1(r.content).hexdigest(),
+        'data': response,
+    }
+    write_snapshot(sheet, snapshot)
+    print(f"Downloaded {sheet}")
+    return snapshot
+
+def load_sheets(sheets=SHEETS):
+    '''refresh every sheet concurrently; a rebuild is limited by the slowest sheet rather than the sum of all of them'''
+    with ThreadPoolExecutor(max_workers=len(sheets)) as pool:
+        for sheet, snapshot in zip(sheets, pool.map(fetch_sheet, sheets)):
+            _sheets[sheet] = snapshot
+    return _sheets
+
+def get_sheet(sheet):
+    '''sheet JSON from this process's last refresh, fetching it on first use'''
+    if sheet not in _sheets:
+        _sheets[sheet] = fetch_sheet(sheet)
+    return _sheets[sheet]['data']
+
+def parsed_from(sheet):
+    '''memoize a sheet parser on the snapshot it read, so an unchanged sheet is not parsed twice'''
+    def decorator(parser):
+        @wraps(parser)
+        def wrapper(*args):
+            get_sheet(sheet)
+            digest = _sheets[sheet]['digest']
+            key = (parser.__name__, args)
+            cached = _parsed.get(key)
+            if cached is None or cached[0] != digest:
+                cached = (digest, parser(*args))
+                _parsed[key] = cached
+            return cached[1]
+        return wrapper
+    return decorator
+
+######################################################################################################
+#                              Columnar tables
+######################################################################################################
+''' each sheet response is parsed once (per snapshot, see parsed_from) into a DataFrame, cells matched to columns by
+column id rather than by position, so inserted or re-ordered columns do not shift values. Sheets with one column per
+tax year are melted into long tables holding every year, so a new year column costs no extra fetch or parse. '''
+YEAR_COLUMN = re.compile(r'^(?:19|20)\d{2}$')
+
+def sheet_table(sheet):
+    '''the sheet as a DataFrame with one column per sheet column, named by title; the title of the primary column
+    is in table.attrs['primary']'''
+    response = get_sheet(sheet)
+    titles = {column['id']: column['title'] for column in response['columns']}
+    records = [{titles[cell['columnId']]: cell.get('value') for cell in row['cells'] if cell.get('columnId') in titles}
+               for row in response['rows']]
+    table = pd.DataFrame.from_records(records, columns=list(titles.values()))
+    table.attrs['primary'] = next(column['title'] for column in response['columns'] if column.get('primary'))
+    return table
+
+def year_columns(table):
+    return [title for title in table.columns if YEAR_COLUMN.match(str(title))]
 
+def unpivot(table, id_columns, value_columns, name):
+    '''long table with one row per (row, value column): the id columns, the value column title in `name` and the cell in
+    `value`, column by column. Does what DataFrame.melt does without its per-column cost on wide mixed-type sheets.'''
+    long = {column: np.tile(table[column].to_numpy(dtype=object), len(value_columns)) for column in id_columns}
+    long[name] = np.repeat(np.asarray(value_columns, dtype=object), len(table))
+    long['value'] = table[value_columns].to_numpy(dtype=object).T.ravel()
+    return pd.DataFrame(long)
+
+def melt_years(sheet, label):
+    '''long table of a sheet with rows (state, <label>) and one column per tax year: columns state, <label>, year, value.
+    The label column is the one non-year column besides the primary (state) column; empty cells are dropped.'''
+    table = sheet_table(sheet)
+    primary = table.attrs['primary']
+    years = year_columns(table)
+    other = next(title for title in table.columns if title != primary and title not in years)
+    table = unpivot(table.rename(columns={primary: 'state', other: label}), ['state', label], years, 'year')
+    return table[table['value'].notna()].reset_index(drop=True)
+
+def melt_states(sheet):
+    '''long table of a sheet with one row per year and one column per state: columns year, state, value; empty cells are 0'''
+    table = sheet_table(sheet)
+    primary = table.attrs['primary']
+    table = unpivot(table.rename(columns={primary: 'year'}), ['year'], [title for title in table.columns if title != primary], 'state')
+    table['value'] = table['value'].where(table['value'].notna(), 0)
+    return table
+
+######################################################################################################
+#                              Sheet parsers
+######################################################################################################
+
+@parsed_from('exclusions_sheet')
+def import_exclusion_rates_from_ss():
+    '''exclusion rates for every tax year: columns state (lower case in the sheet), category, year, value'''
+    return melt_years('exclusions_sheet', 'category')
+
+@parsed_from('nexus_sheet')
 def import_nexus_thresholds_from_ss():
-    url = os.environ['ss_url'] + os.environ['nexus_sheet']
-    header = {"Authorization": "Bearer " + os.environ['ss_token']}
     temp_table = {"Table": {}}
-    r = requests.get(url, headers=header)
-    response = r.json()
+    response = get_sheet('nexus_sheet')
     for row in response["rows"]:
       state = row["cells"][0]["value"]
       try:
@@ -41,12 +209,10 @@ def import_nexus_thresholds_from_ss():
       temp_table["Table"].update({state: thresholds})
     return temp_table['Table']
 
+@parsed_from('pre_post_sheet')
 def import_pre_post_nol_from_ss():
-    url = os.environ['ss_url'] + os.environ['pre_post_sheet']
-    header = {"Authorization": "Bearer " + os.environ['ss_token']}
     temp_table = {"Table": {}}
-    r = requests.get(url, headers=header)
-    response = r.json()
+    response = get_sheet('pre_post_sheet')
     for row in response["rows"]:
       state = row["cells"][0]["value"]
       try:
@@ -56,84 +222,26 @@ def import_pre_post_nol_from_ss():
       temp_table["Table"].update({state: imported_data})
     return temp_table['Table']
 
-def import_tax_rates_from_ss(tax_year):
-    url = os.environ['ss_url'] + os.environ['tax_rates_sheet']
-    header = {"Authorization": "Bearer " + os.environ['ss_token']}
-    r = requests.get(url, headers=header)
-    response = r.json()
-    compliance_table = {"compliance": {}}
-    current_table = {"current_provision": {}}
-    deferred_table = {"deferred_provision": {}}
-    for column in response['columns']: #column represents a json object/python dictionary
-       if column['title'] == tax_year:
-            column_index = int(column['index'])
-    for row in response["rows"]:
-        state = row["cells"][0]["value"]
-        state = state[0:len(state)-5]
-        if row['cells'][1]["value"] == 'compliance':
-            compliance_rate = row["cells"][column_index]["value"]
-            compliance_table["compliance"].update({state: compliance_rate})
-        elif row['cells'][1]["value"] == 'current':
-            current_provision_rate = row["cells"][column_index]["value"]
-            current_table["current_provision"].update({state: current_provision_rate})
-        elif row['cells'][1]["value"] == 'deferred':
-            deferred_provision_rate = row["cells"][column_index]["value"]
-            deferred_table["deferred_provision"].update({state: deferred_provision_rate})
-    #print(compliance_table['compliance'])
-    return [compliance_table['compliance'], current_table['current_provision'], deferred_table['deferred_provision']]
+@parsed_from('tax_rates_sheet')
+def import_tax_rates_from_ss():
+    '''tax rates for every tax year: columns state, period (compliance, current or deferred), year, value'''
+    rates = melt_years('tax_rates_sheet', 'period')
+    rates['state'] = rates['state'].str[:-5]  # "Alabama comp" -> "Alabama"
+    return rates
 
+@parsed_from('cfp_sheet')
 def import_cfp_from_ss():
-    url = os.environ['ss_url'] + os.environ['cfp_sheet']
-    header = {"Authorization": "Bearer " + os.environ['ss_token']}
-    r = requests.get(url, headers=header)
-    response = r.json()
-    full_table={}
-    for column in response["columns"]:
-      if column['index'] != 0:
-        full_table[column["title"]] = {}
-        for row in response["rows"]:
-          year = row["cells"][0]["value"]
-          try:
-            data = row["cells"][column["index"]]["value"]
-          except:
-            data =0
-          full_table[column["title"]].update({year: data})
-    return full_table
+    '''NOL carryforward periods: columns year, state, value'''
+    return melt_states('cfp_sheet')
 
+@parsed_from('limitations_sheet')
 def import_limitations_from_ss():
-    url = os.environ['ss_url'] + os.environ['limitations_sheet']
-    header = {"Authorization": "Bearer " + os.environ['ss_token']}
-    r = requests.get(url, headers=header)
-    response = r.json()
-    full_table={}
-    for column in response["columns"]:
-      if column['index'] != 0:
-        full_table[column["title"]] = {}
-        for row in response["rows"]:
-          year = row["cells"][0]["value"]
-          try:
-            data = row["cells"][column["index"]]["value"]
-          except:
-            data =0
-          full_table[column["title"]].update({year: data})
-    return full_table
-
-def import_smartsheets_methodologies(tax_year):
-    url = os.environ['ss_url'] + os.environ['methods_sheet']
-    header = {"Authorization": "Bearer " + os.environ['ss_token']}
-    r = requests.get(url, headers=header)
-    print(r.status_code)
-    response = r.json()
-    for column in response['columns']: #column represents a json object/python dictionary
-       if column['title'] == tax_year:
-            column_index = int(column['index'])
-    #column index 6 is deferred, column index 5 is 2023 and so on (response['cells'][5]). If column index changes in smartsheets when new columsn are added this will have to be revised. Consider using column ID intead of index.
-    #state = response['rows'][0]['cells'][0]['value']
-    method_listing = [] #will be formatted as list of dictionaries: [{state: 'alabama', method: 'single sales factor', year: 'current'}, {state: 'alabama', method:'single sales factor', year: 'deferred'}]
-    for row in response["rows"]:
-        state = row["cells"][0]["value"]
-        state = state[0:len(state)-5]
-        year = row['cells'][1]['value']
-        method = row['cells'][column_index]["value"]
-        method_listing.append({'state': state, 'method': method, 'year':year })
-    return method_listing
\ No newline at end of file
+    '''NOL utilization limitations: columns year, state, value'''
+    return melt_states('limitations_sheet')
+
+@parsed_from('methods_sheet')
+def import_smartsheets_methodologies():
+    '''apportionment methodologies for every tax year: columns state, period (compliance, current or deferred), year, value'''
+    methods = melt_years('methods_sheet', 'period')
+    methods['state'] = methods['state'].str[:-5]
+    return methods
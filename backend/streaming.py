@@ -0,0 +1,72 @@
+'''
+Helpers for streaming chat completions to the browser as Server-Sent Events.
+
+The model sometimes wraps its HTML in a markdown code fence (```html ... ```).
+CodeFenceFilter removes the fence incrementally: it holds back only the few
+characters that could still turn out to be part of an opening or closing fence,
+and passes everything else through as soon as it arrives.
+'''
+import json
+import re
+
+OPENING_FENCES = ('```html', '```')
+_TRAILING = re.compile(r'\s*`{0,3}\s*$')  # text at the end that could still be (part of) a closing fence
+
+
+class CodeFenceFilter:
+    '''strip a leading ```html / ``` fence and a trailing ``` fence from a stream of text chunks'''
+
+    def __init__(self):
+        self._head = ''        # buffered text until we know whether an opening fence is present
+        self._started = False
+        self._leading = True   # drop whitespace before the first real character
+        self._tail = ''        # held-back text that may belong to a closing fence
+
+    def _open(self, text, final=False):
+        stripped = text.lstrip()
+        if not final and any(fence.startswith(stripped) and fence != stripped for fence in OPENING_FENCES):
+            return None  # could still become "```html"
+        for fence in OPENING_FENCES:
+            if stripped.startswith(fence):
+                return stripped[len(fence):]
+        return stripped
+
+    def feed(self, chunk):
+        '''add a chunk of model output; returns the text that is safe to emit now'''
+        if not self._started:
+            self._head += chunk
+            chunk = self._open(self._head)
+            if chunk is None:
+                return ''
+            self._started = True
+        if self._leading:
+            chunk = chunk.lstrip()
+            if not chunk:
+                return ''
+            self._leading = False
+        text = self._tail + chunk
+        hold = _TRAILING.search(text).start()
+        self._tail = text[hold:]
+        return text[:hold]
+
+    def finish(self):
+        '''flush whatever is left once the stream has ended'''
+        if not self._started:
+            self._started = True
+            self._tail = self._open(self._head, final=True)
+        tail = self._tail.rstrip()
+        if tail.endswith('```'):
+            tail = tail[:-3]
+        self._tail = ''
+        return tail.rstrip() if not self._leading else tail.strip()
+
+
+def strip_code_fences(answer):
+    '''non-streaming equivalent of CodeFenceFilter'''
+    fence_filter = CodeFenceFilter()
+    return fence_filter.feed(answer) + fence_filter.finish()
+
+def sse_event(data, event=None):
+    '''format one Server-Sent Event; data is JSON-encoded so newlines in HTML cannot break framing'''
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
@@ -1,4 +1,43 @@
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from functools import partial
+from types import SimpleNamespace
+
+# every cache, manifest and metrics file the suite writes goes to a scratch directory, never to backend/cache (the
+# backend-cache volume under docker compose): fake embeddings and token counts must not reach production
+SCRATCH_DIR = tempfile.mkdtemp(prefix='chatbot-test-')
+os.environ.update({
+    'EMBEDDING_CACHE_PATH': os.path.join(SCRATCH_DIR, 'embeddings.sqlite3'),
+    'METRICS_PATH': os.path.join(SCRATCH_DIR, 'metrics.sqlite3'),
+    'PROFILE_DIR': os.path.join(SCRATCH_DIR, 'profiles'),
+    'CORPUS_VERSION_PATH': os.path.join(SCRATCH_DIR, 'corpus_version'),
+    'MANIFEST_DIR': SCRATCH_DIR,
+    'SMARTSHEET_SNAPSHOT_DIR': os.path.join(SCRATCH_DIR, 'smartsheets'),
+    'VECTOR_STORE_DIR': os.path.join(SCRATCH_DIR, 'vector_store'),
+})
+
+import app as backend
 from app import app
+import clients
+import ingest
+import research
+import upstream
+from answer_cache import AnswerCache, key_terms, write_corpus_version
+from answer_engine import format_number, format_percent, structured_answer
+from context_builder import build_context, count_tokens
+from embedding_cache import EmbeddingCache
+from lexical_index import LexicalIndex, reciprocal_rank_fusion, tokenize
+from query_analyzer import ANY_YEAR, FactIndex, analyze_question, metadata_filter
+from streaming import CodeFenceFilter, sse_event, strip_code_fences
+from upstream import CircuitBreaker, CircuitOpenError, SingleFlight, with_backoff
+from vector_store import LocalIndex
+from benchmarks.fakes import FakeOpenAIServer, FakePineconeServer, load_recorded_sheets
 
 def test_chatbot():
     test_client = app.test_client()
@@ -8,6 +47,603 @@ def test_chatbot():
     assert response.status_code ==  200, f"Expected 200, got {response.status_code}"    
     print("✓ Backend test passed!")
 
+def test_healthz():
+    test_client = app.test_client()
+    response = test_client.get('/healthz')
+
+    print(f'status code: {response.status_code}')
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    print("✓ Liveness test passed!")
+
+def test_readyz():
+    test_client = app.test_client()
+    response = test_client.get('/readyz')
+
+    print(f'status code: {response.status_code}, checks: {response.json["checks"]}')
+    assert response.status_code in (200, 503), f"Expected 200 or 503, got {response.status_code}"
+    assert set(response.json['checks']) == {'vector_index', 'openai'}
+    print("✓ Readiness test passed!")
+
+def test_readyz_probe():
+    # readiness is probed live with a short timeout, so a slow upstream is noticed once the cached result expires
+    test_client = app.test_client()
+    saved = dict(os.environ)
+    timeout, cache_seconds = backend.READINESS_TIMEOUT, backend.READINESS_CACHE_SECONDS
+    backend.READINESS_TIMEOUT = 0.5
+    backend._readiness['checked_at'] = None
+    try:
+        with FakeOpenAIServer(latency=0) as openai_fake, FakePineconeServer(latency=0) as pinecone_fake:
+            os.environ.update({**openai_fake.env(), **pinecone_fake.env()})
+            clients._reset()
+            ready = test_client.get('/readyz')
+            pinecone_fake.latency = 1.0
+            cached = test_client.get('/readyz')
+            backend.READINESS_CACHE_SECONDS = 0
+            slow = test_client.get('/readyz')
+    finally:
+        backend.READINESS_TIMEOUT, backend.READINESS_CACHE_SECONDS = timeout, cache_seconds
+        backend._readiness['checked_at'] = None
+        os.environ.clear()
+        os.environ.update(saved)
+        clients._reset()
+
+    print(f'status codes: {ready.status_code}, {cached.status_code}, {slow.status_code}, checks: {slow.json["checks"]}')
+    assert ready.status_code == 200 and cached.status_code == 200, f"Expected 200, got {ready.status_code}, {cached.status_code}"
+    assert slow.status_code == 503 and slow.json['checks']['openai'] == 'ok' and slow.json['checks']['vector_index'] != 'ok'
+    print("✓ Readiness probe test passed!")
+
+def test_chatbot_batch_validation():
+    test_client = app.test_client()
+    response = test_client.post('/chatbot/batch', json={'questions': []})
+
+    print(f'status code: {response.status_code}')
+    assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+    print("✓ Batch validation test passed!")
+
+def test_chatbot_retrieval_error():
+    # a failure while retrieving must still answer in JSON, not with Flask's HTML error page
+    test_client = app.test_client()
+    retrieve_docs = backend.retrieve_docs
+    def failing_retrieve(query, query_embedding):
+        raise RuntimeError("index unavailable")
+    backend.retrieve_docs = failing_retrieve
+    try:
+        with redirect_stdout(io.StringIO()):
+            response = test_client.post('/chatbot', json={'question': "Explain apportionment rules"}, headers={'X-Cache-Bypass': '1'})
+    finally:
+        backend.retrieve_docs = retrieve_docs
+
+    print(f'status code: {response.status_code}')
+    assert response.status_code == 500, f"Expected 500, got {response.status_code}"
+    assert response.is_json and "index unavailable" in response.get_json()[0]
+    print("✓ Retrieval error test passed!")
+
+def test_metrics():
+    test_client = app.test_client()
+    response = test_client.get('/metrics')
+
+    print(f'status code: {response.status_code}')
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    assert "# TYPE chatbot_request_seconds histogram" in response.get_data(as_text=True)
+    print("✓ Metrics test passed!")
+
+def test_chatbot_batch_trace():
+    # questions of a batch are retrieved and completed on pool threads; their stages must reach the request's log line
+    test_client = app.test_client()
+    saved = dict(os.environ)
+    with FakeOpenAIServer(latency=0) as openai_fake, FakePineconeServer(latency=0) as pinecone_fake:
+        os.environ.update({**openai_fake.env(), **pinecone_fake.env()})
+        clients._reset()
+        output = io.StringIO()
+        with redirect_stdout(output):
+            response = test_client.post('/chatbot/batch', json={'questions': ["Explain apportionment rules", "Summarize NOL rules"]},
+                                        headers={'X-Cache-Bypass': '1'})
+    os.environ.clear()
+    os.environ.update(saved)
+    clients._reset()
+    trace = [json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"event": "request", "endpoint": "chatbot_batch"')][-1]
+
+    print(f'status code: {response.status_code}, stages: {trace["stages_ms"]}, tokens: {trace["tokens"]}, cache: {trace["cache"]}')
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    assert {'embedding', 'vector_query', 'completion'} <= set(trace['stages_ms'])
+    assert trace['tokens']['completion'] > 0
+    assert trace['cache'] == {'answer': {'bypass': 2}}
+    print("✓ Batch trace test passed!")
+
+def test_single_flight():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+    def slow_call():
+        calls.append(1)
+        release.wait(5)
+        return "answer"
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do('question', slow_call))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while flights.calls + flights.coalesced < 5:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    # one call for the overlapping requests; a later request makes a new one
+    assert calls == [1] and results == ["answer"] * 5 and flights.coalesced == 4
+    flights.do('question', lambda: None)
+    assert flights.calls == 2
+    try:
+        flights.do('failing', lambda: 1 / 0)
+        assert False, "expected ZeroDivisionError"
+    except ZeroDivisionError:
+        pass
+    print("✓ Single-flight test passed!")
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+    with redirect_stdout(io.StringIO()):
+        breaker.record_failure()
+        assert breaker.state == 'closed'
+        breaker.record_failure()
+    assert breaker.state == 'open'
+    try:
+        breaker.before_call()
+        assert False, "expected CircuitOpenError"
+    except CircuitOpenError:
+        assert breaker.rejected == 1
+    # after the cool-down one trial call goes through; its failure re-opens the circuit at once
+    time.sleep(0.06)
+    assert breaker.state == 'half-open'
+    breaker.before_call()
+    try:
+        breaker.before_call()
+        assert False, "only one trial call at a time"
+    except CircuitOpenError:
+        pass
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.failures == 0
+    # a trial call killed by a BaseException (GreenletExit, gevent Timeout) must not keep the circuit open for good
+    class Killed(BaseException):
+        pass
+    def killed():
+        raise Killed()
+    upstream.breakers['test'] = breaker
+    try:
+        with redirect_stdout(io.StringIO()):
+            breaker.record_failure()
+            breaker.record_failure()
+        time.sleep(0.06)
+        try:
+            upstream.call('test', killed)
+            assert False, "expected Killed"
+        except Killed:
+            pass
+        assert not breaker.trial_running
+        assert upstream.call('test', lambda: "ok") == "ok"
+        assert breaker.state == 'closed'
+    finally:
+        del upstream.breakers['test']
+    print("✓ Circuit breaker test passed!")
+
+def test_with_backoff():
+    attempts = []
+    def flaky(fail_times, error):
+        attempts.append(1)
+        if len(attempts) <= fail_times:
+            raise error
+        return "ok"
+    with redirect_stdout(io.StringIO()):
+        assert with_backoff(flaky, 2, TimeoutError("slow"), retries=3, base_delay=0) == "ok"
+        assert len(attempts) == 3
+        # errors that are not worth retrying, or that outlast the retries, are raised
+        for fail_times, error, retries, expected_attempts in ((5, ValueError("bad request"), 3, 1), (5, TimeoutError("slow"), 2, 3)):
+            attempts.clear()
+            try:
+                with_backoff(flaky, fail_times, error, retries=retries, base_delay=0)
+                assert False, f"expected {type(error).__name__}"
+            except type(error):
+                assert len(attempts) == expected_attempts
+    print("✓ Backoff test passed!")
+
+def test_local_index():
+    index = LocalIndex()
+    index.upsert([
+        ('a', [1.0, 0.0], {'state': 'Alabama', 'topic': 'tax_rate'}),
+        ('b', [0.8, 0.6], {'state': 'Alaska', 'topic': 'tax_rate'}),
+        ('c', [0.0, 1.0], {'state': 'Alabama', 'topic': 'nexus'}),
+    ])
+    assert len(index) == 3
+    # top-k is ranked by cosine similarity, whatever the vector's length
+    matches = index.query([2.0, 0.0], top_k=2)['matches']
+    assert [match['id'] for match in matches] == ['a', 'b']
+    assert abs(matches[0]['score'] - 1.0) < 1e-6
+    assert len(index.query([1.0, 0.0], top_k=10)['matches']) == 3
+    # metadata filters: plain value, $eq and $in
+    assert [m['id'] for m in index.query([1.0, 0.0], top_k=3, filter={'state': 'Alabama'})['matches']] == ['a', 'c']
+    assert [m['id'] for m in index.query([1.0, 0.0], top_k=3, filter={'topic': {'$eq': 'nexus'}})['matches']] == ['c']
+    assert [m['id'] for m in index.query([0.0, 1.0], top_k=1, filter={'state': {'$in': ['Alaska', 'Texas']}})['matches']] == ['b']
+    assert index.query([1.0, 0.0], top_k=3, filter={'state': 'Texas'})['matches'] == []
+    # upserting an existing id replaces it in place
+    index.upsert([('c', [1.0, 0.0], {'state': 'Alabama', 'topic': 'nexus', 'text': 'updated'})])
+    matches = index.query([1.0, 0.0], top_k=3, filter={'topic': 'nexus'})['matches']
+    assert len(index) == 3 and matches[0]['metadata']['text'] == 'updated' and matches[0]['score'] > 0.99
+    index.delete(ids=['a'])
+    assert [m['id'] for m in index.query([1.0, 0.0], top_k=3)['matches']] == ['c', 'b']
+    # a saved index loads (memory-mapped) with the same answers
+    with tempfile.TemporaryDirectory() as directory:
+        index.save(directory)
+        loaded = LocalIndex.load(directory)
+        assert [m['id'] for m in loaded.query([1.0, 0.0], top_k=3)['matches']] == ['c', 'b']
+    index.delete(delete_all=True)
+    assert len(index) == 0 and index.query([1.0, 0.0], top_k=3)['matches'] == []
+    print("✓ Local index test passed!")
+
+def test_embedding_cache():
+    cache = EmbeddingCache(path='', max_entries=2, ttl=3600)
+    cache.put("What is the rate?", 'model', [1.0, 0.0])
+    # lookups ignore case, whitespace and trailing punctuation, but not the model
+    assert cache.get("  what is the RATE ", 'model') is not None
+    assert cache.get("What is the rate?", 'other-model') is None
+    # least recently used entries are evicted first
+    cache.put("second", 'model', [0.0, 1.0])
+    cache.get("what is the rate", 'model')
+    cache.put("third", 'model', [1.0, 1.0])
+    assert cache.get("second", 'model') is None and cache.get("third", 'model') is not None
+    assert cache.get("what is the rate", 'model') is not None
+
+    # one embed call for all the misses of a batch, in order
+    calls = []
+    def embed_many(texts):
+        calls.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+    embeddings = cache.get_or_create_many(["third", "a", "bb"], 'model', embed_many)
+    assert calls == [["a", "bb"]]
+    assert [list(embedding) for embedding in embeddings] == [[1.0, 1.0], [1.0, 1.0], [2.0, 1.0]]
+    assert cache.misses == 2
+
+    # expired entries are misses, in memory and on disk
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'embeddings.sqlite3')
+        short = EmbeddingCache(path=path, max_entries=10, ttl=0.5, flush_interval=3600)
+        short.put("question", 'model', [1.0, 0.0])
+        # requests never write the shared file; the flush thread does
+        assert EmbeddingCache(path=path, max_entries=10, ttl=0.5).get("question", 'model') is None
+        short.flush()
+        assert EmbeddingCache(path=path, max_entries=10, ttl=0.5).get("question", 'model') is not None
+        # a flush that cannot get the write lock keeps its embeddings for the next one
+        locker = sqlite3.connect(path, isolation_level=None)
+        locker.execute("BEGIN IMMEDIATE")
+        short.put("locked", 'model', [0.0, 1.0])
+        with redirect_stdout(io.StringIO()):
+            short.flush()
+        locker.execute("ROLLBACK")
+        locker.close()
+        assert EmbeddingCache(path=path, max_entries=10, ttl=0.5).get("locked", 'model') is None
+        short.flush()
+        assert EmbeddingCache(path=path, max_entries=10, ttl=0.5).get("locked", 'model') is not None
+        time.sleep(0.6)
+        assert short.get("question", 'model') is None
+        assert EmbeddingCache(path=path, max_entries=10, ttl=0.5).get("question", 'model') is None
+    print("✓ Embedding cache test passed!")
+
+def test_code_fence_filter():
+    cases = {
+        "```html\n<p>Hi</p>\n```": "<p>Hi</p>",
+        "```\n<p>a `x` b</p>```  ": "<p>a `x` b</p>",
+        "  <p>use ``` fences</p>": "<p>use ``` fences</p>",
+        "<p>Hi</p>": "<p>Hi</p>",
+    }
+    for answer, expected in cases.items():
+        # the same result whether the answer arrives at once or one character at a time
+        fence_filter = CodeFenceFilter()
+        streamed = "".join(fence_filter.feed(char) for char in answer) + fence_filter.finish()
+        assert streamed == expected, f"{answer!r}: got {streamed!r}"
+        assert strip_code_fences(answer) == expected
+    # text is passed on as soon as it cannot be part of a fence
+    fence_filter = CodeFenceFilter()
+    assert fence_filter.feed("```html\n<p>Hel") == "<p>Hel"
+    assert fence_filter.feed("lo</p>\n``") == "lo</p>"
+    assert fence_filter.feed("`") == "" and fence_filter.finish() == ""
+    assert sse_event({"delta": "a\nb"}, event="done") == 'event: done\ndata: {"delta": "a\\nb"}\n\n'
+    print("✓ Code fence filter test passed!")
+
+def test_context_builder():
+    docs = [
+        {'text': "Alabama's 2018 NOL carryforward period is 15 years", 'score': 0.9, 'state': 'Alabama', 'topic': 'cfp'},
+        {'text': "Alabama's 2019 NOL carryforward period is 15 years", 'score': 0.88, 'state': 'Alabama', 'topic': 'cfp'},
+        {'text': "Alabama's 2018 NOL carryforward period is 15 years", 'score': 0.87, 'state': 'Alabama', 'topic': 'cfp'},
+        {'text': "Alaska's 2023 tax rate is 9.4%", 'score': 0.86, 'state': 'Alaska', 'topic': 'tax_rate'},
+        {'text': "Alaska's 2022 tax rate is 9.4%", 'score': 0.85, 'state': 'Alaska', 'topic': 'tax_rate'},
+        {'text': "Alaska's 2023 tax rate is 9.3%", 'score': 0.84, 'state': 'Alaska', 'topic': 'tax_rate'},
+        {'text': "Texas has no corporate income tax", 'score': 0.5, 'state': 'Texas', 'topic': 'tax_rate'},
+        {'text': "A fact found by keyword search only", 'score': None},
+    ]
+    context, stats = build_context(docs, budget=1500, min_similarity=0.2, margin=0.15)
+    print(context)
+    # repeats are dropped, year-only differences merged, groups written under one heading, weak matches cut
+    assert context.split("\n") == [
+        "A fact found by keyword search only",
+        "Alabama's 2018, 2019 NOL carryforward period is 15 years",
+        "Alaska - tax rates: 2022, 2023 tax rate is 9.4%; 2023 tax rate is 9.3%",
+    ]
+    assert (stats['retrieved'], stats['kept']) == (8, 4)
+    assert stats['context_tokens'] == count_tokens(context) and stats['tokens_saved'] > 0
+    # facts that no longer fit the budget are skipped
+    context, stats = build_context(docs, budget=count_tokens(docs[-1]['text']) + 1)
+    assert context == docs[-1]['text'] and stats['kept'] == 1
+    assert build_context([]) == ("", {'retrieved': 0, 'kept': 0, 'baseline_tokens': 0, 'context_tokens': 0, 'tokens_saved': 0})
+    print("✓ Context builder test passed!")
+
+def test_lexical_index():
+    assert tokenize("Alabama's Subpart F rate") == ['alabama', 'subpart', 'f', 'rate', 'alabama subpart', 'subpart f', 'f rate']
+    index = LexicalIndex()
+    index.build([
+        {'id': 'al_rate', 'text': "Alabama's 2023 tax rate is 6.5%", 'state': 'Alabama'},
+        {'id': 'ak_rate', 'text': "Alaska's 2023 tax rate is 9.4%", 'state': 'Alaska'},
+        {'id': 'al_subpart_f', 'text': "Alabama's 2023 exclusion rate for Subpart F is 50%", 'state': 'Alabama'},
+        {'id': 'tx_nexus', 'text': "Texas's economic nexus threshold is $500,000 in sales", 'state': 'Texas'},
+    ])
+    assert len(index) == 4
+    # exact state tokens decide what embeddings blur; postal codes are searched by state name
+    assert index.search("Alabama 2023 rate", top_k=1)[0]['id'] == 'al_rate'
+    assert index.search("AK 2023 rate", top_k=1)[0]['id'] == 'ak_rate'
+    assert index.search("Subpart F", top_k=4)[0]['id'] == 'al_subpart_f'
+    assert [doc['id'] for doc in index.search("2023 rate", top_k=4, metadata_filter={'state': 'Alaska'})] == ['ak_rate']
+    assert index.search("what is it", top_k=4) == []
+
+    # a doc found by both rankings outranks docs found by one; it keeps the fields of its first appearance
+    vector = [{'id': 'a', 'score': 0.9}, {'id': 'b', 'score': 0.8}]
+    lexical = [{'id': 'b', 'lexical_score': 3.0}, {'id': 'c', 'lexical_score': 2.0}]
+    fused = reciprocal_rank_fusion(vector, lexical, k=60)
+    assert [doc['id'] for doc in fused] == ['b', 'a', 'c']
+    assert fused[0]['score'] == 0.8 and fused[0]['lexical_score'] == 3.0
+    assert abs(fused[0]['rrf_score'] - (1 / 62 + 1 / 61)) < 1e-12
+    assert len(reciprocal_rank_fusion(vector, lexical, top_k=2)) == 2
+    print("✓ Lexical index test passed!")
+
+def test_ingest_sync():
+    embedded = []
+    def create_embeddings(input, model):
+        embedded.extend(input)
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[1.0, float(i)]) for i in range(len(input))])
+    client = SimpleNamespace(embeddings=SimpleNamespace(create=create_embeddings))
+    index = LocalIndex()
+    docs = [{'id': doc_id, 'text': f"fact {doc_id}", 'state': 'Alabama'} for doc_id in ('a', 'b', 'c')]
+    write_version = ingest.write_corpus_version
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'manifest.json')
+        ingest.write_corpus_version = partial(write_corpus_version, path=os.path.join(directory, 'corpus_version'))
+        try:
+            with redirect_stdout(io.StringIO()):
+                first = ingest.sync(docs, client, index, path)
+                again = ingest.sync(docs, client, index, path)
+                # only the new document is embedded; the removed one leaves the index
+                changed = ingest.sync(docs[:1] + docs[2:] + [{'id': 'd', 'text': "fact d", 'state': 'Alaska'}], client, index, path)
+                full = ingest.sync(docs, client, index, path, full=True)
+        finally:
+            ingest.write_corpus_version = write_version
+        manifest = ingest.load_manifest(path)
+    assert (first['added'], first['removed']) == (3, 0)
+    assert (again['added'], again['removed'], again['unchanged']) == (0, 0, 3)
+    assert (changed['added'], changed['removed'], changed['unchanged']) == (1, 1, 2)
+    assert (full['added'], full['removed']) == (3, 1)
+    assert embedded == ["fact a", "fact b", "fact c", "fact d", "fact a", "fact b", "fact c"]
+    assert first['corpus_version'] == again['corpus_version'] != changed['corpus_version']
+    assert sorted(manifest) == ['a', 'b', 'c'] and manifest['a'] == {'text': "fact a", 'state': 'Alabama'}
+    assert sorted(index.ids) == ['a', 'b', 'c']
+    print("✓ Ingest sync test passed!")
+
+def test_answer_cache_key_terms():
+    # questions that embed almost identically must not share an answer when they name another period, state or topic
+    same = key_terms("Alabama 2023 compliance rate") == key_terms("alabama 2023 compliance rate?")
+    print(f'same question: {same}')
+    assert same
+    assert key_terms("Alabama 2023 compliance rate") != key_terms("Alabama 2023 deferred rate")
+    assert key_terms("Alabama 2023 compliance rate") != key_terms("Alaska 2023 compliance rate")
+    assert key_terms("Alabama 2023 tax rate") != key_terms("Alabama 2023 exclusion rate")
+    print("✓ Answer cache key terms test passed!")
+
+def test_answer_cache():
+    with tempfile.TemporaryDirectory() as directory:
+        version_path = os.path.join(directory, 'corpus_version')
+        write_corpus_version(['doc_1'], version_path)
+        cache = AnswerCache(max_entries=2, threshold=0.97, ttl=3600, version_path=version_path)
+        cache.put("Explain apportionment rules", [1.0, 0.0, 0.0], "<p>apportionment</p>")
+        # a near-duplicate question is a hit, a different one a miss
+        answer, similarity = cache.get("explain the apportionment rules", [0.99, 0.05, 0.0])
+        print(f'similarity: {similarity:.4f}')
+        assert answer == "<p>apportionment</p>" and similarity > 0.97
+        assert cache.get("Summarize NOL rules", [0.0, 1.0, 0.0])[0] is None
+        # the same embedding with another state is a miss
+        cache.put("Alabama 2023 rate", [0.0, 0.0, 1.0], "<p>6.5%</p>")
+        assert cache.get("Alaska 2023 rate", [0.0, 0.0, 1.0])[0] is None
+        assert cache.get("Alabama 2023 rate", [0.0, 0.0, 1.0])[0] == "<p>6.5%</p>"
+        # a full cache evicts the least recently used answer
+        cache.put("Summarize NOL rules", [0.0, 1.0, 0.0], "<p>NOL</p>")
+        assert cache.get("Explain apportionment rules", [1.0, 0.0, 0.0])[0] is None
+        assert cache.get("Alabama 2023 rate", [0.0, 0.0, 1.0])[0] == "<p>6.5%</p>"
+        # a new corpus version empties the cache
+        write_corpus_version(['doc_1', 'doc_2'], version_path)
+        assert cache.get("Alabama 2023 rate", [0.0, 0.0, 1.0])[0] is None
+        assert cache.invalidations == 1
+    print("✓ Answer cache test passed!")
+
+def test_query_analyzer():
+    analysis = analyze_question("Compare the West Virginia and Texas 2023 compliance tax rate")
+    assert analysis == {'states': ['West Virginia', 'Texas'], 'topics': ['tax_rate'], 'years': ['2023'], 'periods': ['compliance']}
+    assert metadata_filter(analysis) == {'state': {'$in': ['West Virginia', 'Texas']}, 'topic': {'$in': ['tax_rate']},
+                                         'year': {'$in': ['2023', ANY_YEAR]}, 'period': {'$in': ['compliance']}}
+    # "current" only narrows topics that have periods
+    assert 'period' not in metadata_filter(analyze_question("current nexus threshold in Ohio"))
+    assert analyze_question("How are NOLs treated in Ohio?")['topics'] == ['cfp', 'limitation', 'pre_post']
+    assert analyze_question("Is the exclusion rate for Subpart F income 100%?")['topics'] == ['exclusion']
+    assert metadata_filter(analyze_question("What can you do?")) is None
+    # the sheets' "Foreign" and "Other" rows are not states named by "foreign dividends" or "other states"
+    assert analyze_question("What is the exclusion rate for foreign dividends?")['states'] == []
+    assert analyze_question("How does the Texas 2023 tax rate compare with other states?")['states'] == ['Texas']
+
+    manifest = {
+        'rate_2022': {'state': 'Ohio', 'topic': 'tax_rate', 'year': '2022', 'period': 'current', 'text': "2022 current"},
+        'rate_2023': {'state': 'Ohio', 'topic': 'tax_rate', 'year': '2023', 'period': 'current', 'text': "2023 current"},
+        'rate_2023_deferred': {'state': 'Ohio', 'topic': 'tax_rate', 'year': '2023', 'period': 'deferred', 'text': "2023 deferred"},
+        'nexus': {'state': 'Ohio', 'topic': 'nexus', 'year': ANY_YEAR, 'text': "nexus"},
+    }
+    path = os.path.join(tempfile.mkdtemp(), 'manifest.json')
+    ingest.save_manifest(path, manifest)
+    fact_index = FactIndex(path)
+    lookup = lambda question: sorted(doc['text'] for doc in fact_index.lookup(analyze_question(question)) or [])
+    assert len(fact_index) == 4
+    assert lookup("Ohio 2023 tax rate") == ["2023 current", "2023 deferred"]
+    assert lookup("Ohio 2023 deferred tax rate") == ["2023 deferred"]
+    assert lookup("Ohio 2023 nexus threshold") == ["nexus"]  # facts that do not vary by year match any year
+    assert lookup("Ohio tax rate") == ["2022 current", "2023 current", "2023 deferred"]
+    assert lookup("What is the tax rate?") == [] and lookup("Texas tax rate") == []
+    print("✓ Query analyzer test passed!")
+
+def test_comparative_retrieval():
+    # a question comparing a state with others needs the other states' facts, not only the exact lookup
+    manifest = {f"rate_{state}": {'state': state, 'topic': 'tax_rate', 'year': '2023', 'period': 'current', 'text': f"{state}'s 2023 tax rate is {rate}"}
+                for state, rate in (('Texas', '0.75%'), ('Ohio', '0.26%'), ('Alabama', '6.5%'))}
+    path = os.path.join(tempfile.mkdtemp(), 'manifest.json')
+    ingest.save_manifest(path, manifest)
+    indexes = backend.fact_index, backend.lexical_index
+    backend.fact_index, backend.lexical_index = FactIndex(path), LexicalIndex(path)
+    try:
+        states = lambda question: sorted(doc['state'] for doc in backend.retrieve_docs(question, None))
+        assert states("What is the Texas 2023 tax rate?") == ['Texas']
+        assert states("Which states have a higher 2023 tax rate than Texas?") == ['Alabama', 'Ohio', 'Texas']
+        assert states("How does Texas's 2023 tax rate compare with other states?") == ['Alabama', 'Ohio', 'Texas']
+    finally:
+        backend.fact_index, backend.lexical_index = indexes
+    print("✓ Comparative retrieval test passed!")
+
+def test_state_codes():
+    # postal codes that are also words only name a state with state or tax context around them
+    cases = {
+        "What is the CA tax rate?": ['California'],
+        "Compare CA, OR and WA": ['California', 'Oregon', 'Washington'],
+        "What is the rate in OR?": ['Oregon'],
+        "OK tax rate for 2023": ['Oklahoma'],
+        "What is IN's apportionment method?": ['Indiana'],
+        "IS NEXUS DIFFERENT IN TX OR CA": ['Texas', 'California'],
+        "Tell ME the NY rate": ['New York'],
+        "OK, what is the TX rate?": ['Texas'],
+        "Please help ME with OH": [],
+        "CAT tax rate": [],
+    }
+    for question, states in cases.items():
+        found = analyze_question(question)['states']
+        assert found == states, f"{question!r}: expected {states}, got {found}"
+    print("✓ State code test passed!")
+
+def test_answer_templates():
+    manifest = {
+        'cfp_oh': {'state': 'Ohio', 'topic': 'cfp', 'year': '2023', 'value': 'Unlimited'},
+        'cfp_tx': {'state': 'Texas', 'topic': 'cfp', 'year': '2023', 'value': 20.0},
+        'limitation_oh': {'state': 'Ohio', 'topic': 'limitation', 'year': '2023', 'value': 1},
+        'limitation_tx': {'state': 'Texas', 'topic': 'limitation', 'year': '2023', 'value': 0.8},
+        'nexus_oh': {'state': 'Ohio', 'topic': 'nexus', 'year': ANY_YEAR, 'dollar_threshold': 500000.0, 'transaction_threshold': 200, 'and_or': 'and'},
+        'nexus_tx': {'state': 'Texas', 'topic': 'nexus', 'year': ANY_YEAR},
+        'exclusion_subpart_f': {'state': 'Ohio', 'topic': 'exclusion', 'year': '2023', 'category': 'Subpart F', 'value': 0.5},
+        'exclusion_fdii': {'state': 'Ohio', 'topic': 'exclusion', 'year': '2023', 'category': 'FDII', 'value': 'N/A'},
+        'exclusion_ohio_dividends': {'state': 'Ohio', 'topic': 'exclusion', 'year': '2023', 'category': 'Foreign Dividends', 'value': 0.7},
+        'exclusion_foreign_dividends': {'state': 'Foreign', 'topic': 'exclusion', 'year': '2023', 'category': 'Foreign Dividends', 'value': 0.3},
+    }
+    path = os.path.join(tempfile.mkdtemp(), 'manifest.json')
+    ingest.save_manifest(path, manifest)
+    fact_index = FactIndex(path)
+    answer = lambda question: structured_answer(question, analyze_question(question), fact_index)
+
+    assert format_percent(0.065) == "6.5%" and format_percent("N/A") == "N/A"
+    assert format_number(500000.0) == "500,000" and format_number(1.5) == "1.5"
+    assert answer("Ohio 2023 carryforward period") == "<p>The Ohio 2023 NOL carryforward period is unlimited.</p>"
+    assert answer("Texas and Ohio 2023 carryforward period") == (
+        "<ul><li>The Ohio 2023 NOL carryforward period is unlimited.</li><li>The Texas 2023 NOL carryforward period is 20 years.</li></ul>")
+    assert answer("Ohio 2023 NOL limitation") == "<p>Ohio can utilize an unlimited amount of NOLs in 2023.</p>"
+    assert answer("Texas 2023 NOL limitation") == "<p>The Texas 2023 NOL utilization limitation is 80% of state taxable income.</p>"
+    assert answer("Ohio nexus threshold") == "<p>Ohio's economic nexus threshold is $500,000 in sales and 200 transactions.</p>"
+    assert answer("Ohio 2023 Subpart F exclusion") == "<p>The Ohio 2023 exclusion rate for Subpart F is 50% of Subpart F income.</p>"
+    # "foreign dividends" does not add the sheet's Foreign row, and that row is never rendered as a state
+    assert answer("Ohio 2023 exclusion rate for foreign dividends") == (
+        "<p>The Ohio 2023 exclusion rate for Foreign Dividends is 70% of Foreign Dividends income.</p>")
+    foreign = {'states': ['Ohio', 'Foreign'], 'topics': ['exclusion'], 'years': ['2023'], 'periods': []}
+    assert structured_answer("Ohio and Foreign 2023 foreign dividends exclusion", foreign, fact_index) is None
+    # nothing on file, a missing year and open-ended questions are left to retrieval
+    assert answer("Texas nexus threshold") is None
+    assert answer("Ohio 2021 carryforward period") is None
+    assert answer("Explain the Ohio 2023 carryforward period") is None
+    print("✓ Answer templates test passed!")
+
+def test_research_year_columns():
+    # cells are matched to columns by id, whatever their order, and every tax year column is kept
+    columns = [{'id': 1, 'title': 'State', 'index': 0, 'primary': True}, {'id': 2, 'title': 'Provision', 'index': 1},
+               {'id': 3, 'title': '2022', 'index': 2}, {'id': 4, 'title': '2023', 'index': 3}]
+    rows = [{'cells': [{'columnId': 4, 'value': 0.07}, {'columnId': 1, 'value': 'Alabama comp'}, {'columnId': 3, 'value': 0.065}, {'columnId': 2, 'value': 'compliance'}]}]
+    research._sheets['tax_rates_sheet'] = {'digest': 'test', 'data': {'columns': columns, 'rows': rows}}
+    rates = research.import_tax_rates_from_ss()
+    del research._sheets['tax_rates_sheet']
+
+    print(rates.to_dict('records'))
+    assert rates.to_dict('records') == [{'state': 'Alabama', 'period': 'compliance', 'year': '2022', 'value': 0.065},
+                                        {'state': 'Alabama', 'period': 'compliance', 'year': '2023', 'value': 0.07}]
+    print("✓ Research loader test passed!")
+
+def test_structured_tax_rate_answer():
+    # facts come from the provision year's column (2022): compliance is 2022, current provision 2023, deferred the
+    # future rate; pinned against the recorded sheets so "the Alabama 2023 tax rate" stays the baseline 4.78%
+    sheets = load_recorded_sheets()
+    for sheet in ('tax_rates_sheet', 'methods_sheet'):
+        research._sheets[sheet] = {'digest': 'answer-test', 'data': sheets[sheet]}
+    try:
+        docs = backend.get_tax_rate_data() + backend.get_methodology_data()
+    finally:
+        for sheet in ('tax_rates_sheet', 'methods_sheet'):
+            del research._sheets[sheet]
+    texts = [doc['text'] for doc in docs]
+    assert "Alabama's 2022 compliance tax rate is 5.9%" in texts  # rounded, not 5.8999999999999995%
+    assert "Alabama's 2023 current provision tax rate is 4.78%" in texts
+    assert "Alabama's deferred (future) tax rate is 3.55%" in texts
+    assert not any(text.startswith("Alabama's 2024") or text.startswith("Alabama's 2021") for text in texts)
+    path = os.path.join(tempfile.mkdtemp(), 'manifest.json')
+    ingest.save_manifest(path, {doc['id']: ingest.document_metadata(doc) for doc in docs})
+    fact_index = FactIndex(path)
+    answer = lambda question: structured_answer(question, analyze_question(question), fact_index)
+
+    assert answer("What is the Alabama 2023 tax rate?") == "<p>The Alabama 2023 current provision tax rate is 4.78%.</p>"
+    assert answer("What is the Alabama 2022 tax rate?") == "<p>The Alabama 2022 compliance tax rate is 5.9%.</p>"
+    assert answer("What is the Alabama compliance tax rate?") == "<p>The Alabama 2022 compliance tax rate is 5.9%.</p>"
+    assert answer("What is the Alabama deferred tax rate?") == "<p>The Alabama deferred (future) tax rate is 3.55%.</p>"
+    assert answer("What is the Alabama 2023 compliance tax rate?") is None  # not on file; left to retrieval
+    assert answer("What is the Alabama tax rate?") is None  # several periods on file; left to retrieval
+    print("✓ Structured tax rate answer test passed!")
+
 
 if __name__ == '__main__':
-    test_chatbot()
\ No newline at end of file
+    test_chatbot()
+    test_healthz()
+    test_readyz()
+    test_readyz_probe()
+    test_chatbot_batch_validation()
+    test_chatbot_retrieval_error()
+    test_metrics()
+    test_chatbot_batch_trace()
+    test_single_flight()
+    test_circuit_breaker()
+    test_with_backoff()
+    test_local_index()
+    test_embedding_cache()
+    test_code_fence_filter()
+    test_lexical_index()
+    test_ingest_sync()
+    test_context_builder()
+    test_answer_cache_key_terms()
+    test_answer_cache()
+    test_query_analyzer()
+    test_comparative_retrieval()
+    test_state_codes()
+    test_answer_templates()
+    test_research_year_columns()
+    test_structured_tax_rate_answer()
\ No newline at end of file
@@ -0,0 +1,218 @@
+'''
+Resilient calls to the upstream services (OpenAI embeddings and completions, the vector index).
+
+Every upstream call on the request path goes through `call()`, which
+    1. coalesces identical in-flight calls into one (single-flight): when a dozen people
+       paste the same question within seconds, one embedding, one vector query and one
+       completion are made and every waiting request gets the same result;
+    2. bounds each attempt with a per-call timeout (passed to the client by the caller);
+    3. retries rate limits, timeouts and 5xx responses with jittered exponential backoff;
+    4. stops calling an upstream that keeps failing (circuit breaker) until a cool-down
+       has passed, so requests fail fast instead of queueing behind a dead service.
+Failures surface as UpstreamError, which the app turns into a degraded answer
+(lexical retrieval, the retrieved facts without a completion) rather than a 500.
+Coalescing and breaker state are per process, i.e. per gunicorn worker.
+'''
+import os
+import random
+import threading
+import time
+
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+import clients
+
+MAX_RETRIES = 6  # offline jobs (ingest) can afford to wait out a rate limit
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# transport failures of the Pinecone, httpx and urllib3 clients, matched by name across SDK versions
+TRANSIENT_ERROR_NAMES = ('Timeout', 'ConnectionError', 'ProtocolError', 'MaxRetryError')
+
+EMBEDDING_TIMEOUT = float(os.environ.get('EMBEDDING_TIMEOUT', 10))
+VECTOR_QUERY_TIMEOUT = float(os.environ.get('VECTOR_QUERY_TIMEOUT', 5))
+COMPLETION_TIMEOUT = float(os.environ.get('COMPLETION_TIMEOUT', 60))
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))  # requests have a user waiting, so retry briefly
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', 5))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', 30))
+
+
+class UpstreamError(Exception):
+    '''an upstream call failed after retries, or was not attempted because its circuit is open'''
+
+    def __init__(self, upstream, cause=None):
+        self.upstream = upstream
+        self.cause = cause
+        super().__init__(f"{upstream}: {type(cause).__name__}: {cause}" if cause else upstream)
+
+
+class CircuitOpenError(UpstreamError):
+    '''the upstream failed repeatedly and is not called again until its cool-down has passed'''
+
+    def __init__(self, upstream):
+        Exception.__init__(self, f"{upstream} circuit is open")
+        self.upstream = upstream
+        self.cause = None
+
+
+######################################################################################################
+#                              Retries
+######################################################################################################
+
+def is_retryable(error):
+    '''rate limits, timeouts, connection failures and 5xx responses from OpenAI or Pinecone are worth retrying'''
+    if isinstance(error, (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError, TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, 'status', None) or getattr(error, 'status_code', None)
+    return status in RETRYABLE_STATUS or any(name in type(error).__name__ for name in TRANSIENT_ERROR_NAMES)
+
+def with_backoff(fn, *args, retries=MAX_RETRIES, base_delay=1.0, max_delay=30.0, **kwargs):
+    '''call fn, retrying retryable errors with jittered exponential backoff'''
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = min(base_delay * 2 ** attempt, max_delay) * random.uniform(0.5, 1.0)
+            print(f"{type(e).__name__}: retrying in {delay:.1f}s (attempt {attempt + 1}/{retries})")
+            time.sleep(delay)
+
+
+######################################################################################################
+#                              Circuit breaker and single-flight
+######################################################################################################
+
+class CircuitBreaker:
+    '''opens after `failure_threshold` consecutive failed calls; once `reset_timeout` seconds have passed,
+    one trial call is let through (half-open) and its outcome closes or re-opens the circuit'''
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def before_call(self):
+        '''raise CircuitOpenError unless a call may go through now'''
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at >= self.reset_timeout and not self.trial_running:
+                self.trial_running = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(self.name)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"Circuit for {self.name} opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def end_call(self):
+        '''let another trial through if this call ended without an outcome (a GreenletExit or gevent Timeout)'''
+        with self._lock:
+            self.trial_running = False
+
+    def stats(self):
+        return {'state': self.state, 'consecutive_failures': self.failures, 'rejected': self.rejected}
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''run one call per key at a time; concurrent callers with the same key wait for it and share its result or error'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+breakers = {name: CircuitBreaker(name) for name in ('embeddings', 'vector', 'completion')}
+_single_flight = SingleFlight()
+
+
+def call(name, fn, *args, key=None, **kwargs):
+    '''fn(*args, **kwargs) against upstream `name` with its circuit breaker and brief retries; calls with the same
+    key that overlap in time are made once. Raises UpstreamError.'''
+    breaker = breakers[name]
+
+    def attempt():
+        breaker.before_call()
+        try:
+            result = with_backoff(fn, *args, retries=UPSTREAM_RETRIES, base_delay=0.25, max_delay=2.0, **kwargs)
+        except Exception as e:
+            if is_retryable(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()  # the upstream answered; the request itself was bad
+            raise UpstreamError(name, e) from e
+        finally:
+            breaker.end_call()
+        breaker.record_success()
+        return result
+
+    if key is None:
+        return attempt()
+    return _single_flight.do((name, key), attempt)
+
+def openai_client(timeout):
+    '''the shared OpenAI client with a per-call timeout and without its own retries (call() retries)'''
+    return clients.get_openai_client().with_options(timeout=timeout, max_retries=0)
+
+def stats():
+    return {
+        'breakers': {name: breaker.stats() for name, breaker in breakers.items()},
+        'calls': _single_flight.calls,
+        'coalesced': _single_flight.coalesced,
+    }
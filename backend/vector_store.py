@@ -0,0 +1,189 @@
+'''
+In-process NumPy vector index, used as an alternative to the hosted Pinecone index.
+
+The corpus is only a few thousand short sentences, so exact cosine search over a
+pre-normalized float32 matrix is faster than a network round trip. The matrix is
+saved as a .npy file and opened memory-mapped, so every gunicorn worker shares the
+same pages from the OS page cache instead of holding its own copy.
+
+LocalIndex mirrors the parts of the Pinecone Index API the app uses (upsert/delete/query),
+so it can be passed to the ingest pipeline and to search_similar_docs unchanged.
+'''
+import json
+import os
+import threading
+
+import numpy as np
+
+VECTOR_STORE_DIR = os.environ.get('VECTOR_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vector_store'))
+EMBEDDINGS_FILE = 'embeddings.npy'
+DOCUMENTS_FILE = 'documents.json'
+
+
+def normalize(vectors):
+    '''L2-normalize rows as float32 so cosine similarity becomes a dot product'''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def filter_mask(column, size, metadata_filter):
+    '''boolean row mask for the subset of Pinecone's filter language the app uses: {field: value | {"$eq"|"$in": ...}};
+    column(field) returns that metadata field for every row as an object array'''
+    mask = np.ones(size, dtype=bool)
+    for field, condition in metadata_filter.items():
+        if isinstance(condition, dict):
+            allowed = condition.get('$in', [condition['$eq']] if '$eq' in condition else [])
+        else:
+            allowed = [condition]
+        mask &= np.isin(column(field), np.array(allowed, dtype=object))
+    return mask
+
+
+class LocalIndex:
+    '''exact top-k cosine search over a pre-normalized float32 embedding matrix'''
+
+    def __init__(self, embeddings=None, ids=None, metadata=None):
+        self.embeddings = embeddings
+        self.ids = list(ids or [])
+        self.metadata = list(metadata or [])
+        self._positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        self._pending = {}  # id -> (normalized embedding, metadata) waiting to be merged into the matrix
+        self._columns = {}  # metadata field -> object array, used for filtering
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        self._merge_pending()
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, directory=VECTOR_STORE_DIR, mmap=True):
+        '''open a saved index; the embedding matrix is memory-mapped read-only by default'''
+        embeddings = np.load(os.path.join(directory, EMBEDDINGS_FILE), mmap_mode='r' if mmap else None)
+        with open(os.path.join(directory, DOCUMENTS_FILE)) as f:
+            documents = json.load(f)
+        return cls(embeddings, documents['ids'], documents['metadata'])
+
+    def save(self, directory=VECTOR_STORE_DIR):
+        '''write the index atomically so running workers never see a half-written file'''
+        self._merge_pending()
+        os.makedirs(directory, exist_ok=True)
+        embeddings = self.embeddings if self.embeddings is not None else np.zeros((0, 0), dtype=np.float32)
+        tmp_embeddings = os.path.join(directory, EMBEDDINGS_FILE + '.tmp')
+        tmp_documents = os.path.join(directory, DOCUMENTS_FILE + '.tmp')
+        with open(tmp_embeddings, 'wb') as f:
+            np.save(f, np.ascontiguousarray(embeddings, dtype=np.float32))
+        with open(tmp_documents, 'w') as f:
+            json.dump({'ids': self.ids, 'metadata': self.metadata}, f)
+        # documents first: a reader that sees the new matrix must also see the new ids
+        os.replace(tmp_documents, os.path.join(directory, DOCUMENTS_FILE))
+        os.replace(tmp_embeddings, os.path.join(directory, EMBEDDINGS_FILE))
+
+    def upsert(self, vectors):
+        '''add or replace (id, embedding, metadata) tuples; safe to call from the ingest worker pool'''
+        rows = normalize([embedding for _, embedding, _ in vectors])
+        with self._lock:
+            for (doc_id, _, meta), row in zip(vectors, rows):
+                self._pending[doc_id] = (row, meta)
+        return {'upserted_count': len(vectors)}
+
+    def delete(self, ids=None, delete_all=False):
+        '''remove vectors by id (or everything), mirroring Pinecone's Index.delete'''
+        self._merge_pending()
+        with self._lock:
+            if delete_all:
+                keep = []
+            else:
+                removed = set(ids or [])
+                keep = [i for i, doc_id in enumerate(self.ids) if doc_id not in removed]
+            self.embeddings = np.array(self.embeddings[keep], dtype=np.float32) if keep else None
+            self.ids = [self.ids[i] for i in keep]
+            self.metadata = [self.metadata[i] for i in keep]
+            self._positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+            self._columns = {}
+        return {}
+
+    def describe_index_stats(self, **kwargs):
+        '''vector count and dimension, mirroring Pinecone's Index.describe_index_stats'''
+        self._merge_pending()
+        dimension = self.embeddings.shape[1] if self.embeddings is not None and len(self.ids) else 0
+        return {'total_vector_count': len(self.ids), 'dimension': dimension}
+
+    def _merge_pending(self):
+        with self._lock:
+            if not self._pending:
+                return
+            new_rows = []
+            embeddings = np.array(self.embeddings, dtype=np.float32) if self.embeddings is not None else None
+            for doc_id, (row, meta) in self._pending.items():
+                position = self._positions.get(doc_id)
+                if position is not None:
+                    embeddings[position] = row
+                    self.metadata[position] = meta
+                else:
+                    self._positions[doc_id] = len(self.ids)
+                    self.ids.append(doc_id)
+                    self.metadata.append(meta)
+                    new_rows.append(row)
+            if new_rows:
+                new_rows = np.vstack(new_rows)
+                embeddings = new_rows if embeddings is None or embeddings.size == 0 else np.vstack([embeddings, new_rows])
+            self.embeddings = embeddings
+            self._pending = {}
+            self._columns = {}
+
+    def _column(self, field):
+        '''metadata field as an object array, cached until the index changes'''
+        column = self._columns.get(field)
+        if column is None:
+            column = np.array([meta.get(field) for meta in self.metadata], dtype=object)
+            self._columns[field] = column
+        return column
+
+    def _filter_mask(self, metadata_filter):
+        return filter_mask(self._column, len(self.ids), metadata_filter)
+
+    def query(self, vector, top_k, include_metadata=True, filter=None, **kwargs):
+        '''vectorized cosine top-k, optionally restricted by a metadata filter; returns a Pinecone-shaped {"matches": [...]} result'''
+        self._merge_pending()
+        if self.embeddings is None or len(self.ids) == 0:
+            return {'matches': []}
+        scores = self.embeddings @ normalize(vector)
+        if filter:
+            rows = np.flatnonzero(self._filter_mask(filter))
+        else:
+            rows = None
+        if rows is not None:
+            top_k = min(top_k, len(rows))
+            if top_k == 0:
+                return {'matches': []}
+            candidates = rows[np.argpartition(-scores[rows], top_k - 1)[:top_k]] if top_k < len(rows) else rows
+        elif top_k < len(scores):
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+        ranked = candidates[np.argsort(-scores[candidates])]
+        return {'matches': [
+            {'id': self.ids[i], 'score': float(scores[i]), 'metadata': self.metadata[i] if include_metadata else {}}
+            for i in ranked
+        ]}
+
+
+######################################################################################################
+#                              Shared per-process instance
+######################################################################################################
+
+_local_index = None
+_local_index_mtime = None
+_local_index_lock = threading.Lock()
+
+def get_local_index(directory=VECTOR_STORE_DIR):
+    '''return the saved local index, reloading it when ingest has written a newer copy'''
+    global _local_index, _local_index_mtime
+    mtime = os.stat(os.path.join(directory, EMBEDDINGS_FILE)).st_mtime_ns
+    if _local_index is None or mtime != _local_index_mtime:
+        with _local_index_lock:
+            if _local_index is None or mtime != _local_index_mtime:
+                _local_index = LocalIndex.load(directory)
+                _local_index_mtime = mtime
+    return _local_index
@@ -35,20 +35,85 @@ function App() {
             });
         }, []);
 
+    //replace the content of the most recent bot message (used while an answer is streaming in)
+    const updateLastMessage = (content) => {
+        setMessages((prevMessages) => {
+            const updated = [...prevMessages];
+            updated[updated.length - 1] = { ...updated[updated.length - 1], content: content };
+            return updated;
+        });
+    };
+
+    //parse one Server-Sent Event block ("event: ...\ndata: {...}") into its name and JSON payload
+    const parseEvent = (block) => {
+        let event = "message";
+        let data = "";
+        block.split("\n").forEach((line) => {
+            if (line.startsWith("event:")) event = line.slice(6).trim();
+            else if (line.startsWith("data:")) data += line.slice(5).trim();
+        });
+        return { event, data: data ? JSON.parse(data) : {} };
+    };
+
+    //stream the answer from /chatbot/stream, rendering the partial HTML as it arrives
+    async function streamAnswer(question) {
+        const response = await fetch(ENDPOINT + "/chatbot/stream", {
+            method: "POST",
+            cache: "no-cache",
+            headers: {"content-type":"application/json"},
+            body: JSON.stringify({question: question, chat_history: chatbotHistory})
+        });
+        //errors answered before the stream starts (bad request, service unavailable) come back as JSON [message, history]
+        if (!response.ok || !(response.headers.get("content-type") || "").startsWith("text/event-stream")) {
+            const data = await response.json().catch(() => null);
+            if (!Array.isArray(data) || !data[0]) throw new Error(`${response.status} ${response.statusText}`);
+            addMessage(data[0], 'bot');
+            return;
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let answer = "";
+        addMessage("", 'bot');
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const blocks = buffer.split("\n\n");
+            buffer = blocks.pop();
+            for (const block of blocks) {
+                const { event, data } = parseEvent(block);
+                if (event === "error") {
+                    updateLastMessage(data.message);
+                } else if (event === "done") {
+                    setChatbotHistory(data.history);
+                    console.debug(`time to first token ${Math.round(data.ttft_ms)}ms, total ${Math.round(data.total_ms)}ms`);
+                } else if (data.delta) {
+                    answer += data.delta;
+                    updateLastMessage(answer);
+                }
+            }
+        }
+    }
+
     //form submission handler
     function onSubmit(e) {
         e.preventDefault();
         addMessage(userMessage, 'user');
-        fetch(ENDPOINT + "/chatbot", {
-            method: "POST",
-            cache: "no-cache",
-            headers: {"content-type":"application/json"},
-            body: JSON.stringify({question: userMessage, chat_history: chatbotHistory})
-          })
-            .then((response) => response.json())
-            .then((responseData) => (addMessage(responseData[0], 'bot'),
-                setChatbotHistory(responseData[1])
-                ));
+        if (window.ReadableStream && window.TextDecoder) {
+            streamAnswer(userMessage).catch((error) => addMessage(`<p>Sorry, an error occurred: ${error}</p>`, 'bot'));
+        } else {
+            fetch(ENDPOINT + "/chatbot", {
+                method: "POST",
+                cache: "no-cache",
+                headers: {"content-type":"application/json"},
+                body: JSON.stringify({question: userMessage, chat_history: chatbotHistory})
+              })
+                .then((response) => response.json())
+                .then((responseData) => (addMessage(responseData[0], 'bot'),
+                    setChatbotHistory(responseData[1])
+                    ));
+        }
         setUserMessage("")
     }   
     